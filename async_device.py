@@ -0,0 +1,128 @@
+"""
+asyncio front-end for Device.
+
+Every call of an AsyncDevice runs on its own single worker thread, so the blocking
+CH341 calls of one programmer never stall the event loop and never run concurrently.
+
+    device = AsyncDevice(main.Device())
+    await device.open(0)
+    data = await device.read_pages(0, 64, progress=print)
+    async for first_page, chunk in device.stream_read(0, 4096):
+        ...
+    await device.close()
+
+Progress events are dicts (page, done, total, elapsed_s) passed to the progress callable
+on the event loop after every page; queue.put_nowait of an asyncio.Queue works as one.
+Cancelling the awaiting task aborts the operation: the worker stops after the current
+page and CH341AbortRead/CH341AbortWrite cut short the transfer in flight.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+
+
+class AsyncDevice:
+
+    def __init__(self, device=None):
+        self.device = device if device is not None else main.Device()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ch341")
+
+    async def run(self, func, *args, progress=None, total=None):
+        """
+        Run func(*args) (normally a Device method) on the device thread and return its result.
+        progress and total set up the page progress events, see the module docstring.
+        """
+        loop = asyncio.get_running_loop()
+        device = self.device
+        running = threading.Event()
+
+        def job():
+            device.abort_event.clear()
+            running.set()
+            if progress is not None:
+                done, t_start = 0, time.perf_counter()
+
+                def page_done(page):
+                    nonlocal done
+                    done += 1
+                    event = {"page": page, "done": done, "total": total, "elapsed_s": time.perf_counter() - t_start}
+                    loop.call_soon_threadsafe(progress, event)
+
+                device.progress = page_done
+            try:
+                return func(*args)
+            finally:
+                device.progress = None
+                running.clear()
+
+        future = loop.run_in_executor(self._executor, job)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # A job still queued is dropped by the cancellation, only a running one is aborted
+            if running.is_set():
+                device.abort()
+            raise
+
+    async def open(self, i_index, **options):
+        return await self.run(lambda: self.device.open(i_index, **options))
+
+    async def close(self):
+        try:
+            await self.run(self.device.close)
+        finally:
+            self._executor.shutdown(wait=True)
+
+    async def read_pages(self, start_page, end_page, progress=None):
+        """Read pages [start_page, end_page) with their OOB into a new bytearray."""
+        buffer = bytearray((end_page - start_page) * self.device.PAGE_SIZE)
+        await self.run(self.device.read_into, buffer, start_page, end_page,
+                       progress=progress, total=end_page - start_page)
+        return buffer
+
+    async def stream_read(self, start_page=0, end_page=None, chunk_pages=None, progress=None):
+        """
+        Async generator of (first page, chunk) for the range, chunk_pages (a block by default)
+        at a time. The next chunk is read while the current one is being consumed.
+        """
+        if end_page is None:
+            end_page = self.device.CHIP_SIZE // self.device.PAGE_SIZE
+        chunk_pages = chunk_pages or self.device.PAGES_PER_BLOCK
+
+        def page_done(event):
+            event["done"] = event["page"] - start_page + 1
+            progress(event)
+
+        async def read(first):
+            last = min(first + chunk_pages, end_page)
+            chunk = bytearray((last - first) * self.device.PAGE_SIZE)
+            await self.run(self.device.read_into, chunk, first, last,
+                           progress=page_done if progress else None, total=end_page - start_page)
+            return chunk
+
+        pending = asyncio.ensure_future(read(start_page)) if start_page < end_page else None
+        try:
+            for first in range(start_page, end_page, chunk_pages):
+                chunk = await pending
+                next_first = first + chunk_pages
+                pending = asyncio.ensure_future(read(next_first)) if next_first < end_page else None
+                yield first, chunk
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+
+    async def read_to_file(self, file, start_page=0, end_page=None, progress=None):
+        if end_page is None:
+            end_page = self.device.CHIP_SIZE // self.device.PAGE_SIZE
+        return await self.run(self.device.read_to_file, file, start_page, end_page,
+                              progress=progress, total=end_page - start_page)
+
+    async def write_page(self, start_page, file, progress=None, **options):
+        return await self.run(lambda: self.device.write_page(start_page, file, **options), progress=progress)
+
+    async def verify(self, source, start_page=None, stop_on_mismatch=False, progress=None):
+        return await self.run(self.device.verify, source, start_page, stop_on_mismatch, progress=progress)
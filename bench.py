@@ -0,0 +1,647 @@
+"""
+Read/write throughput benchmarks against the simulated programmer (simulator.py),
+so they run on any host without a CH341 attached.
+
+    python bench.py [pages]
+
+The suite runs the main Device operations against a model of the link with USB latency
+and SPI clock, and stores the results as JSON to compare against an earlier run:
+
+    python bench.py suite [--pages N] [--usb-latency S] [--spi-clock HZ] [--json FILE] [--compare FILE]
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import main
+from simulator import SimulatedCH341, SimulatedNand
+
+
+def open_device(backend=None, **geometry):
+    main.load_backend(backend or SimulatedCH341())
+    device = main.Device(BLOCKS_COUNT=1024, **geometry)
+    device.probe_file = None  # calibrate against this simulated link every time
+    with quiet():
+        device.open(0)
+    return device
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        yield
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def measure(name, pages, func, memory=True):
+    # tracemalloc slows every allocation down, so the peak is taken in a second, untimed run
+    t_start = time.perf_counter()
+    with quiet():
+        func()
+    elapsed = time.perf_counter() - t_start
+
+    result = {
+        "name": name,
+        "pages": pages,
+        "seconds": elapsed,
+        "pages_per_sec": pages / elapsed if elapsed else float('inf'),
+    }
+
+    if memory:
+        tracemalloc.start()
+        with quiet():
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_alloc_mb"] = peak / 1024 / 1024
+
+    return result
+
+
+def bench_read_page(device, pages):
+    return measure("read_page", pages, lambda: device.read_page(0, pages, None, False))
+
+
+def bench_read_into_mmap(device, pages):
+    path = os.path.join(tempfile.mkdtemp(), 'dump.bin')
+
+    def run():
+        mm = device.util.map_file(path, pages * device.PAGE_SIZE)
+        device.read_into(mm, 0, pages)
+        mm.close()
+
+    result = measure("read_into(mmap)", pages, run)
+    os.remove(path)
+    return result
+
+
+def bench_read_to_file(device, pages):
+    path = os.path.join(tempfile.mkdtemp(), 'dump.bin')
+    result = measure("read_to_file", pages, lambda: device.read_to_file(path, 0, pages))
+    os.remove(path)
+    return result
+
+
+def bench_stream_read(device, pages):
+    def run():
+        for _ in device.stream_read(0, pages):
+            pass
+    return measure("stream_read", pages, run)
+
+
+def bench_batching(pages=50, usb_latency=0.001):
+    """
+    Page time of the old CS-toggling transfer sequence (Set_D5_D0 + StreamSPI4 for the command,
+    then again for the data) against the batched read_page path, with a modeled USB round trip.
+    """
+    sim = SimulatedCH341(usb_latency=usb_latency)
+    device = open_device(sim)  # open() calibrates page_time_ms on the batched path
+    buffer = bytearray(device.PAGE_SIZE)
+
+    calls, t_start = sim.usb_calls, time.perf_counter()
+    with quiet():
+        for page in range(pages):
+            command = bytes([main.READ_DATA]) + (page * device.PAGE_SIZE).to_bytes(4, 'big')
+            device.write_spi_341(0, 0, len(command), command)
+            device.read_spi_341(1, 0, device.PAGE_SIZE, buffer)
+    unbatched_ms = (time.perf_counter() - t_start) * 1000 / pages
+    unbatched_calls = (sim.usb_calls - calls) / pages
+
+    calls, t_start = sim.usb_calls, time.perf_counter()
+    with quiet():
+        device.read_page(0, pages, None, False)
+    batched_ms = (time.perf_counter() - t_start) * 1000 / pages
+    batched_calls = (sim.usb_calls - calls) / pages
+
+    print(f"USB latency {usb_latency * 1000:.1f} ms")
+    print(f"unbatched: {unbatched_ms:6.2f} ms/page {unbatched_calls:5.1f} USB calls/page")
+    print(f"batched:   {batched_ms:6.2f} ms/page {batched_calls:5.1f} USB calls/page")
+    print(f"page_time_ms calibration: {device.page_time_ms:.2f} ms, {unbatched_ms / device.page_time_ms:.1f}x faster than unbatched")
+
+    return {
+        "unbatched_ms": unbatched_ms,
+        "unbatched_calls": unbatched_calls,
+        "batched_ms": batched_ms,
+        "batched_calls": batched_calls,
+        "page_time_ms": device.page_time_ms,
+    }
+
+
+def bench_sustained_read(pages=512, usb_latency=0.0, t_rd=60e-6):
+    """
+    Page Read + Read From Cache per page against the Page Read Cache Sequential pipeline,
+    where the array read of the next page overlaps the USB transfer of the current one.
+    """
+    results = []
+    for cache_read in (False, True):
+        sim = SimulatedCH341([SimulatedNand(cache_read=cache_read, t_rd=t_rd)], usb_latency=usb_latency)
+        device = open_device(sim, CACHE_READ=cache_read)
+        calls = sim.usb_calls
+        result = measure("cache read" if cache_read else "page read", pages,
+                         lambda: device.read_page(0, pages, None, False), memory=False)
+        result["usb_calls_per_page"] = (sim.usb_calls - calls) / pages
+        results.append(result)
+
+    print(f"USB latency {usb_latency * 1000:.2f} ms, tRD {t_rd * 1e6:.0f} us")
+    for r in results:
+        print(f"{r['name']:<12} {r['pages_per_sec']:8.0f} pages/s {r['usb_calls_per_page']:5.2f} USB calls/page")
+    return results
+
+
+def bench_dual_io(pages=256, usb_latency=0.0):
+    """
+    Read From Cache on one line (0x0B through CH341StreamSPI4) against dual output
+    (0x3B through CH341StreamSPI5, two bits per clock), with the SPI clocks spent per page.
+    """
+    results = []
+    for spi_io in (main.SPI_IO_SINGLE, main.SPI_IO_DOUBLE):
+        sim = SimulatedCH341(usb_latency=usb_latency)
+        main.load_backend(sim)
+        device = main.Device(BLOCKS_COUNT=1024)
+        device.probe_file = None
+        with quiet():
+            device.open(0, spi_io=spi_io)
+
+        calls = sim.usb_calls
+        result = measure("dual" if spi_io else "single", pages,
+                         lambda: device.read_page(0, pages, None, False), memory=False)
+        result["usb_calls_per_page"] = (sim.usb_calls - calls) / pages
+        # Data in phase of Read From Cache: 8 clocks per byte on one line, 4 on two
+        result["spi_clocks_per_page"] = (4 + device.PAGE_SIZE // (2 if spi_io else 1)) * 8
+        results.append(result)
+
+    print(f"USB latency {usb_latency * 1000:.2f} ms")
+    for r in results:
+        print(f"{r['name']:<8} {r['pages_per_sec']:8.0f} pages/s {r['usb_calls_per_page']:5.2f} USB calls/page "
+              f"{r['spi_clocks_per_page']:6d} SPI clocks/page")
+    return results
+
+
+def bench_differential_write(pages=512, changed=4):
+    """
+    Reflashing an image with a few changed pages: erasing and programming everything against
+    write_differential, once reading the flash back for the comparison and once from a manifest.
+    """
+    old = os.urandom(pages * main.Device().PAGE_SIZE)
+    image = bytearray(old)
+    page_size = len(old) // pages
+    for i in range(changed):
+        image[(pages // 2 + i) * page_size] ^= 0xFF
+
+    def full_write(device):
+        for block in range(-(-pages // device.PAGES_PER_BLOCK)):
+            device.erase_block(block)
+        for page in range(pages):
+            device.program_page(page, image[page * page_size:(page + 1) * page_size])
+
+    results = []
+    runs = (
+        ("full", full_write),
+        ("differential", lambda device: device.write_differential(0, image)),
+        ("manifest", lambda device: device.write_differential(0, image, manifest)),
+    )
+    for name, run in runs:
+        sim = SimulatedCH341()
+        device = open_device(sim)
+        manifest = os.path.join(tempfile.mkdtemp(), 'manifest.json')
+        device.write_differential(0, old, manifest)
+
+        calls = sim.usb_calls
+        result = measure(name, pages, lambda: run(device), memory=False)
+        result["usb_calls"] = sim.usb_calls - calls
+        results.append(result)
+
+    print(f"{pages} pages, {changed} changed")
+    for r in results:
+        print(f"{r['name']:<14} {r['seconds']:7.3f} s {r['usb_calls']:7d} USB calls")
+    return results
+
+
+def bench_write_memory(size_mb=128):
+    """
+    Peak allocations while writing a size_mb image from a file, against the image size.
+    The simulated chip drops the programmed data so only the write path is measured.
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'image.bin')
+    with open(path, 'wb') as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    pages = -(-size_mb * 1024 * 1024 // main.Device().PAGE_SIZE)
+    results = []
+    for name, write in (
+        ("write_page", lambda device: device.write_page(0, path, verify_write=False)),
+        ("write_differential", lambda device: device.write_differential(0, path)),
+    ):
+        device = open_device(SimulatedCH341([SimulatedNand(store=False, t_prog=0)]))
+        device.typical_times["program"] = 0
+        tracemalloc.start()
+        t_start = time.perf_counter()
+        with quiet():
+            write(device)
+        elapsed = time.perf_counter() - t_start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append({"name": name, "pages": pages, "seconds": elapsed, "peak_alloc_mb": peak / 1024 / 1024})
+
+    os.remove(path)
+
+    print(f"{size_mb} MiB image")
+    for r in results:
+        print(f"{r['name']:<20} {r['peak_alloc_mb']:8.2f} MB peak alloc ({r['seconds']:.0f} s with tracemalloc)")
+    return results
+
+
+def bench_program(pages=256, usb_latency=0.0005):
+    """
+    Sustained program throughput: one program_page (Write Enable, Program Load, Program
+    Execute and status polls as separate transfers) per page against the program_pages pipeline.
+    """
+    results = []
+    for name in ("program_page", "program_pages"):
+        sim = SimulatedCH341(usb_latency=usb_latency)
+        device = open_device(sim)
+        device.unlock()
+        page_size = device.PAGE_SIZE
+        image = os.urandom(pages * page_size)
+
+        def run():
+            if name == "program_page":
+                for page in range(pages):
+                    device.program_page(page, image[page * page_size:(page + 1) * page_size])
+            else:
+                device.program_pages((page, image[page * page_size:(page + 1) * page_size]) for page in range(pages))
+
+        calls = sim.usb_calls
+        result = measure(name, pages, run, memory=False)
+        result["usb_calls_per_page"] = (sim.usb_calls - calls) / pages
+        results.append(result)
+
+    print(f"USB latency {usb_latency * 1000:.2f} ms")
+    for r in results:
+        print(f"{r['name']:<14} {r['pages_per_sec']:8.0f} pages/s {r['usb_calls_per_page']:5.2f} USB calls/page")
+    return results
+
+
+def bench_open(usb_latency=0.0005):
+    """Device.open() with nothing known about the programmer, then again with its probe cached."""
+    probe_file = os.path.join(tempfile.mkdtemp(), 'probe.json')
+    sim = SimulatedCH341(usb_latency=usb_latency)
+    main.load_backend(sim)
+
+    results = []
+    for name in ("first open", "cached open"):
+        device = main.Device()
+        device.probe_file = probe_file
+        calls, t_start = sim.usb_calls, time.perf_counter()
+        with quiet():
+            device.open(0)
+        results.append({"name": name, "seconds": time.perf_counter() - t_start, "usb_calls": sim.usb_calls - calls})
+        with quiet():
+            device.close()
+
+    os.remove(probe_file)
+
+    print(f"USB latency {usb_latency * 1000:.2f} ms, chip {device.chip_name} ({device.jedec_id})")
+    for r in results:
+        print(f"{r['name']:<12} {r['seconds'] * 1000:7.1f} ms {r['usb_calls']:4d} USB calls")
+    return results
+
+
+def bench_metrics_overhead(pages=1024, runs=5, usb_latency=0.001, spi_clock=1.5e6):
+    """
+    CPU time per page read with metrics collection off and on (best of runs, on a zero latency
+    link so only the host side counts), against the page time of the modeled link.
+    """
+    def cpu_per_page(enabled):
+        main.enable_metrics(enabled)
+        best = None
+        for _ in range(runs):
+            device = open_device()
+            buffer = bytearray(pages * device.PAGE_SIZE)
+            t_start = time.process_time()
+            device.read_into(buffer, 0, pages)
+            elapsed = time.process_time() - t_start
+            best = elapsed if best is None else min(best, elapsed)
+        return best / pages
+
+    off, on = cpu_per_page(False), cpu_per_page(True)
+    main.enable_metrics(False)
+
+    device = open_device(SimulatedCH341(usb_latency=usb_latency, spi_clock=spi_clock))
+    t_start = time.perf_counter()
+    device.read_into(bytearray(16 * device.PAGE_SIZE), 0, 16)
+    page_s = (time.perf_counter() - t_start) / 16
+
+    print(f"metrics off {off * 1e6:6.1f} us/page, on {on * 1e6:6.1f} us/page CPU")
+    print(f"+{(on - off) * 1e6:.1f} us/page is {(on - off) / page_s:.2%} of a {page_s * 1000:.1f} ms page "
+          f"(USB latency {usb_latency * 1000:.1f} ms, SPI clock {spi_clock / 1e6:.1f} MHz)")
+    return {"off_s": off, "on_s": on, "page_s": page_s}
+
+
+def bench_flaky_link(pages=512, error_rates=(0.0, 0.005, 0.02)):
+    """Read throughput and recovery cost when a fraction of the USB transfers fail."""
+    results = []
+    for error_rate in error_rates:
+        sim = SimulatedCH341(seed=0)
+        device = open_device(sim)
+        sim.error_rate = error_rate
+        with open(os.devnull, 'w') as null, contextlib.redirect_stderr(null):
+            result = measure(f"{error_rate:.1%} errors", pages,
+                             lambda: device.read_page(0, pages, None, False), memory=False)
+        result.update(device.recovery_stats)
+        results.append(result)
+
+    for r in results:
+        mean_ms = r["recovery_s"] / r["recovered"] * 1000 if r["recovered"] else 0.0
+        print(f"{r['name']:<12} {r['pages_per_sec']:8.0f} pages/s {r['errors']:4d} errors "
+              f"{r['retries']:4d} retries {mean_ms:6.2f} ms mean recovery")
+    return results
+
+
+def bench_bad_block_scan(bad_blocks=(3, 700)):
+    """
+    Finding the bad blocks from their one-byte markers against reading the whole first page
+    of every block, and splitting data from OOB for a block of raw pages.
+    """
+    sim = SimulatedCH341([SimulatedNand(bad_blocks=bad_blocks)])
+    device = open_device(sim)
+    blocks = device.CHIP_SIZE // device.BLOCK_SIZE
+
+    def full_pages():
+        page = bytearray(device.PAGE_SIZE)
+        for block in range(blocks):
+            device.read_into(page, block * device.PAGES_PER_BLOCK, block * device.PAGES_PER_BLOCK + 1)
+
+    results = []
+    for name, run in (("first pages", full_pages), ("bad block scan", device.scan_bad_blocks)):
+        calls = sim.usb_calls
+        result = measure(name, blocks, run, memory=False)
+        result["usb_calls"] = sim.usb_calls - calls
+        results.append(result)
+
+    raw = os.urandom(device.PAGES_PER_BLOCK * device.PAGE_SIZE)
+    split = measure("split_pages", device.PAGES_PER_BLOCK, lambda: device.split_pages(raw), memory=False)
+
+    print(f"{blocks} blocks, bad: {device.scan_bad_blocks()}")
+    for r in results:
+        print(f"{r['name']:<16} {r['seconds'] * 1000:8.1f} ms {r['usb_calls']:6d} USB calls")
+    print(f"split_pages ({'numpy' if main._optional('numpy') else 'join'}) {split['pages_per_sec']:10.0f} pages/s")
+    return results + [split]
+
+
+def bench_page_cache(usb_latency=0.0005):
+    """
+    The zloader/uboot/uboot_mirr partition reads twice, headers first and then the whole
+    partitions, with and without the page cache.
+    """
+    sim = SimulatedCH341(usb_latency=usb_latency)
+    device = open_device(sim)
+    device.bad_block_table()  # the bad block scan is not part of what is measured
+    reads = [(offset, 4096) for offset in (0, 1024 * 128, 1024 * 1024)]
+    reads += [(0, 1024 * 128), (1024 * 128, 1024 * 1024), (1024 * 1024, 1024 * 1024)]
+
+    def partitions():
+        for offset, size in reads:
+            device.read_bytes(offset, size)
+
+    results = []
+    for name in ("uncached", "cached"):
+        if name == "cached":
+            cache = device.enable_page_cache()
+        calls = sim.usb_calls
+        result = measure(name, 0, lambda: (partitions(), partitions()), memory=False)
+        result["usb_calls"] = sim.usb_calls - calls
+        results.append(result)
+    device.disable_page_cache()
+
+    print(f"USB latency {usb_latency * 1000:.2f} ms, {len(reads)} reads twice")
+    for r in results:
+        print(f"{r['name']:<10} {r['seconds'] * 1000:8.1f} ms {r['usb_calls']:6d} USB calls")
+    stats = cache.stats()
+    print(f"hit rate {stats['hit_rate']:.0%}, {stats['pages']} pages cached")
+    return results
+
+
+class TimedBackend:
+    """Backend wrapper adding up the time spent inside the CH341 API (backend_s)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.backend_s = 0.0
+
+    def __getattr__(self, name):
+        func = getattr(self.backend, name)
+
+        def timed(*args):
+            t_start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self.backend_s += time.perf_counter() - t_start
+
+        return timed
+
+
+def _suite_cases(pages):
+    # name -> (setup(device) returning the operation to time, pages it handles)
+    def read_page(device):
+        return lambda: device.read_page(0, pages, None, False)
+
+    def read_bytes(device):
+        device.bad_blocks = set()  # the bad block scan is not part of what is measured
+        return lambda: device.read_bytes(0, pages * device.PAGE_DATA_SIZE)
+
+    def write_page(device):
+        image = os.urandom(pages * device.PAGE_SIZE)
+        return lambda: device.write_page(0, image)
+
+    def erase_spi_chip_25(device):
+        return device.erase_spi_chip_25
+
+    return {
+        "read_page": (read_page, pages),
+        "read_bytes": (read_bytes, pages),
+        "write_page": (write_page, pages),
+        "erase_spi_chip_25": (erase_spi_chip_25, 0),
+    }
+
+
+def _suite_run(setup, usb_latency, spi_clock, chip_times=True):
+    times = {} if chip_times else {"t_rd": 0, "t_rcbsy": 0, "t_prog": 0, "t_bers": 0}
+    sim = SimulatedCH341([SimulatedNand(**times)], usb_latency=usb_latency, spi_clock=spi_clock)
+    timed = TimedBackend(sim)
+    device = open_device(timed)
+    if not chip_times:
+        device.typical_times = dict.fromkeys(device.typical_times, 0)
+
+    run = setup(device)
+    calls, link_s, backend_s = sim.usb_calls, sim.link_s, timed.backend_s
+    t_start = time.perf_counter()
+    with quiet():
+        run()
+    elapsed = time.perf_counter() - t_start
+    return sim, device, run, {
+        "seconds": elapsed,
+        "usb_calls": sim.usb_calls - calls,
+        "link_s": sim.link_s - link_s,
+        "backend_s": timed.backend_s - backend_s,
+    }
+
+
+def suite(pages=256, usb_latency=0.001, spi_clock=1.5e6):
+    """
+    Time read_page, read_bytes, write_page and erase_spi_chip_25 against the simulated
+    programmer, with usb_latency per USB transaction and SPI transfers at spi_clock.
+
+    For every operation: pages/s and USB calls per page on the modeled link, the modeled
+    USB + SPI time, Python overhead per page (time outside the CH341 API with the link and
+    the chip at zero latency) and peak allocations.
+    """
+    results = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "model": {"pages": pages, "usb_latency": usb_latency, "spi_clock": spi_clock},
+        "cases": {},
+    }
+
+    for name, (setup, count) in _suite_cases(pages).items():
+        _, _, _, model = _suite_run(setup, usb_latency, spi_clock)
+        _, _, run, host = _suite_run(setup, 0.0, None, chip_times=False)
+
+        tracemalloc.start()
+        with quiet():
+            run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        per_page = count or 1
+        results["cases"][name] = {
+            "pages": count,
+            "seconds": model["seconds"],
+            "pages_per_sec": count / model["seconds"] if count else None,
+            "usb_calls_per_page": model["usb_calls"] / per_page,
+            "link_s": model["link_s"],
+            "python_overhead_ms_per_page": (host["seconds"] - host["backend_s"]) * 1000 / per_page,
+            "peak_alloc_mb": peak / 1024 / 1024,
+        }
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_suite(results, baseline=None, tolerance=0.1):
+    """Print suite() results, with the change against baseline (an earlier suite() result) when given."""
+    model = results["model"]
+    print(f"commit {results['commit']}, {model['pages']} pages, USB latency {model['usb_latency'] * 1000:.2f} ms, "
+          f"SPI clock {model['spi_clock'] / 1e6 if model['spi_clock'] else 0:.2f} MHz")
+    print(f"{'operation':<18} {'pages/s':>9} {'USB/page':>9} {'link s':>8} {'py ms/page':>11} {'peak MB':>8}")
+
+    for name, r in results["cases"].items():
+        rate = f"{r['pages_per_sec']:9.0f}" if r["pages_per_sec"] else f"{r['seconds']:8.2f}s"
+        line = (f"{name:<18} {rate} {r['usb_calls_per_page']:9.2f} {r['link_s']:8.3f} "
+                f"{r['python_overhead_ms_per_page']:11.3f} {r['peak_alloc_mb']:8.2f}")
+
+        old = (baseline or {}).get("cases", {}).get(name)
+        if old:
+            if r["pages_per_sec"] and old["pages_per_sec"]:
+                change = r["pages_per_sec"] / old["pages_per_sec"] - 1
+            else:
+                change = old["seconds"] / r["seconds"] - 1
+            line += f"  {change:+.1%} vs {baseline['commit']}"
+            if change < -tolerance:
+                line += "  REGRESSION"
+        print(line)
+
+
+def report(results):
+    print(f"{'benchmark':<20} {'pages':>7} {'pages/s':>10} {'peak alloc':>12}")
+    for r in results:
+        print(f"{r['name']:<20} {r['pages']:>7} {r['pages_per_sec']:>10.0f} {r['peak_alloc_mb']:>9.2f} MB")
+    rss = peak_rss_mb()
+    if rss is not None:
+        print(f"peak RSS: {rss:.1f} MB")
+
+
+def main_suite(argv):
+    parser = argparse.ArgumentParser(prog="bench.py suite")
+    parser.add_argument("--pages", type=int, default=256)
+    parser.add_argument("--usb-latency", type=float, default=0.001, help="seconds per USB transaction")
+    parser.add_argument("--spi-clock", type=float, default=1.5e6, help="Hz")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    results = suite(args.pages, args.usb_latency, args.spi_clock)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_suite(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+
+    if sys.argv[1:2] == ["suite"]:
+        main_suite(sys.argv[2:])
+        sys.exit()
+
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+
+    device = open_device()
+    report([
+        bench_read_page(device, pages),
+        bench_read_into_mmap(device, pages),
+        bench_read_to_file(device, pages),
+        bench_stream_read(device, pages),
+    ])
+    print()
+    bench_batching()
+    print()
+    bench_sustained_read()
+    bench_sustained_read(usb_latency=0.0002)
+    print()
+    bench_dual_io()
+    print()
+    bench_differential_write()
+    print()
+    bench_write_memory()
+    print()
+    bench_program()
+    print()
+    bench_open()
+    print()
+    bench_metrics_overhead()
+    print()
+    bench_flaky_link()
+    print()
+    bench_bad_block_scan()
+    print()
+    bench_page_cache()
@@ -0,0 +1,192 @@
+"""
+Run the same job on several CH341 programmers at once, one worker process per device.
+
+    fleet = Fleet([0, 1, 2, 3])
+    report = fleet.run("read", "dump_{index}.bin", 0, 4096)
+    print_report(report)
+    fleet.close()
+
+Each worker binds its own backend, opens its device index once and keeps it open
+between jobs. Files may contain {index}, which is replaced by the device index.
+Any backend load_backend() accepts can be used, a SimulatedCH341 with N chips
+gives N simulated programmers (each worker gets its own copy of it).
+
+    python fleet.py [devices] [pages]
+"""
+import contextlib
+import multiprocessing
+import os
+import sys
+import time
+
+import main
+
+
+def _job_pages(device, action, file, start_page, end_page):
+    if action == "read":
+        return end_page - start_page
+    if isinstance(file, (str, os.PathLike)):
+        return -(-os.path.getsize(file) // device.PAGE_SIZE)
+    return None
+
+
+def _run_job(device, job):
+    action, file, start_page, end_page, options = job
+
+    if end_page is None:
+        end_page = device.CHIP_SIZE // device.PAGE_SIZE
+    if isinstance(file, str):
+        file = file.format(index=device.index)
+
+    result = {
+        "index": device.index,
+        "status": "ok",
+        "pages": _job_pages(device, action, file, start_page, end_page),
+    }
+    errors = device.recovery_stats["errors"]
+
+    t_start = time.perf_counter()
+    try:
+        if action == "read":
+            device.read_to_file(file, start_page, end_page)
+        elif action == "write":
+            result["write"] = device.write_page(start_page, file, verify_write=False, **options)
+        elif action == "verify":
+            result["mismatched"] = device.verify(file, start_page)
+            if result["mismatched"]:
+                result["status"] = "mismatch"
+        else:
+            raise ValueError(f"Unknown job: {action}")
+    except Exception as error:
+        result["status"] = "error"
+        result["error"] = f"{type(error).__name__}: {error}"
+
+    result["seconds"] = time.perf_counter() - t_start
+    result["usb_errors"] = device.recovery_stats["errors"] - errors
+    if result["pages"] and result["status"] != "error":
+        result["pages_per_sec"] = result["pages"] / result["seconds"]
+    return result
+
+
+def _worker(index, backend, device_options, connection):
+
+    with open(os.devnull, 'w') as null:
+        try:
+            main.load_backend(backend)
+            device = main.Device(**device_options)
+            with contextlib.redirect_stdout(null):
+                device.open(index)
+        except Exception as error:
+            connection.send(f"{type(error).__name__}: {error}")
+            return
+        connection.send(None)
+
+        while True:
+            job = connection.recv()
+            if job is None:
+                break
+            with contextlib.redirect_stdout(null):
+                connection.send(_run_job(device, job))
+
+        with contextlib.redirect_stdout(null):
+            device.close()
+    connection.close()
+
+
+class Fleet:
+    """
+    One worker process per CH341 device index, all driven together.
+    device_options are passed to Device() in every worker.
+    Devices that fail to open are left out and listed in failed.
+    """
+
+    def __init__(self, indexes, backend=None, **device_options):
+
+        self.workers = {}
+        self.failed = {}
+
+        for index in indexes:
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker, args=(index, backend, device_options, child), daemon=True)
+            process.start()
+            self.workers[index] = (process, connection)
+
+        for index, (process, connection) in list(self.workers.items()):
+            error = connection.recv()
+            if error is not None:
+                self.failed[index] = error
+                process.join()
+                del self.workers[index]
+
+    @property
+    def indexes(self):
+        return list(self.workers)
+
+    def run(self, action, file, start_page=0, end_page=None, **options):
+        """
+        Run a job on every device in parallel and wait for all of them.
+
+        action is "read" (dump the range to file), "write" (Device.write_page from file,
+        options such as differential=True are passed on) or "verify" (compare the flash with
+        file). Returns a report: aggregate pages, wall clock seconds and pages_per_sec, and
+        per device its status ("ok", "mismatch" or "error"), pages, seconds, pages_per_sec,
+        the number of USB errors recovered from and error/mismatched when relevant.
+        """
+        t_start = time.perf_counter()
+        for _, connection in self.workers.values():
+            connection.send((action, file, start_page, end_page, options))
+
+        devices = [connection.recv() for _, connection in self.workers.values()]
+        seconds = time.perf_counter() - t_start
+
+        pages = sum(d["pages"] or 0 for d in devices if d["status"] != "error")
+        return {
+            "action": action,
+            "devices": devices,
+            "pages": pages,
+            "seconds": seconds,
+            "pages_per_sec": pages / seconds if seconds else float('inf'),
+            "ok": all(d["status"] == "ok" for d in devices),
+        }
+
+    def close(self):
+        for process, connection in self.workers.values():
+            connection.send(None)
+        for process, connection in self.workers.values():
+            process.join()
+            connection.close()
+        self.workers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def print_report(report):
+    print(f"{report['action']}: {report['pages']} pages in {report['seconds']:.2f} s, {report['pages_per_sec']:.0f} pages/s")
+    for d in report["devices"]:
+        rate = f"{d['pages_per_sec']:8.0f} pages/s" if "pages_per_sec" in d else " " * 16
+        detail = d.get("error") or (f"{len(d['mismatched'])} pages differ" if d.get("mismatched") else "")
+        print(f"  #{d['index']:<3} {d['status']:<9} {rate} {d['usb_errors']:3d} USB errors  {detail}")
+
+
+if __name__ == '__main__':
+
+    from simulator import SimulatedCH341, SimulatedNand
+    import tempfile
+
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+
+    image = os.path.join(tempfile.mkdtemp(), 'image.bin')
+    with open(image, 'wb') as f:
+        f.write(os.urandom(pages * main.Device().PAGE_SIZE))
+
+    # Programmers spend most of their time waiting on USB, modeled here with usb_latency
+    backend = SimulatedCH341([SimulatedNand() for _ in range(devices)], usb_latency=0.0005)
+    with Fleet(range(devices), backend) as fleet:
+        print_report(fleet.run("write", image, differential=True))
+        print_report(fleet.run("verify", image))
+        print_report(fleet.run("read", os.path.join(os.path.dirname(image), 'dump_{index}.bin'), 0, pages))
@@ -0,0 +1,264 @@
+"""
+CH341A transport over libusb (through pyusb), for hosts without CH341.DLL.
+
+LibusbCH341 implements the subset of the CH341.DLL API used by main.py by
+building the CH341A command packets described in CH341DLL.H and exchanging them
+on the bulk endpoints. Bind it with main.load_backend("libusb").
+
+Requires pyusb (pip install pyusb) and read/write access to the USB device.
+"""
+import functools
+
+try:
+    import usb.core
+    import usb.util
+except ImportError:  # pragma: no cover - optional dependency
+    usb = None
+
+
+CH341_VENDOR_ID = 0x1A86
+CH341_PRODUCT_ID = 0x5512
+
+mCH341_PACKET_LENGTH = 32
+mCH341_ENDP_DATA_UP = 0x82
+mCH341_ENDP_DATA_DOWN = 0x02
+mCH341_VENDOR_READ = 0xC0
+mCH341_VENDOR_WRITE = 0x40
+
+mCH341A_CMD_SPI_STREAM = 0xA8
+mCH341A_CMD_I2C_STREAM = 0xAA
+mCH341A_CMD_UIO_STREAM = 0xAB
+mCH341A_BUF_CLEAR = 0xB2
+mCH341A_GET_VER = 0x5F
+
+mCH341A_CMD_I2C_STM_SET = 0x60
+mCH341A_CMD_I2C_STM_MS = 0x50
+mCH341A_CMD_I2C_STM_DLY = 0x0F
+mCH341A_CMD_I2C_STM_END = 0x00
+
+mCH341A_CMD_UIO_STM_DIR = 0x40
+mCH341A_CMD_UIO_STM_OUT = 0x80
+mCH341A_CMD_UIO_STM_END = 0x20
+
+USB_TIMEOUT_MS = 1000
+
+# The CH341A shifts SPI bytes out LSB first; the DLL swaps bit order in software
+# when bit 7 of the stream mode asks for MSB first, so do the same here.
+_REVERSE_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+
+def _usb_call(failed=False):
+    # A timed out or stalled transfer fails the call the way CH341.DLL does, returning
+    # failed instead of raising, so main.CH341 raises CH341Error and Device retries it
+    def decorate(func):
+        @functools.wraps(func)
+        def call(*args):
+            try:
+                return func(*args)
+            except usb.core.USBError:
+                return failed
+        return call
+    return decorate
+
+
+class LibusbCH341:
+
+    supports_dual_io = False # see CH341StreamSPI5
+
+    def __init__(self):
+        if usb is None:
+            raise RuntimeError("The libusb backend needs pyusb (pip install pyusb)")
+
+        self.devices = {}
+        self.modes = {}
+        self.pins = {}
+
+    def _find(self):
+        return list(usb.core.find(find_all=True, idVendor=CH341_VENDOR_ID, idProduct=CH341_PRODUCT_ID))
+
+    def _write(self, iIndex, data):
+        self.devices[iIndex].write(mCH341_ENDP_DATA_DOWN, data, USB_TIMEOUT_MS)
+
+    def _read(self, iIndex, length):
+        data = bytearray()
+        while len(data) < length:
+            data += self.devices[iIndex].read(mCH341_ENDP_DATA_UP, length - len(data), USB_TIMEOUT_MS)
+        return data
+
+    def _set_pins(self, iIndex, direction, data):
+        self._write(iIndex, bytes([
+            mCH341A_CMD_UIO_STREAM,
+            mCH341A_CMD_UIO_STM_OUT | (data & 0x3F),
+            mCH341A_CMD_UIO_STM_DIR | (direction & 0x3F),
+            mCH341A_CMD_UIO_STM_END,
+        ]))
+        self.pins[iIndex] = (direction & 0x3F, data & 0x3F)
+
+    def CH341OpenDevice(self, iIndex):
+        devices = self._find()
+        if iIndex >= len(devices):
+            return -1
+
+        dev = devices[iIndex]
+        try:
+            if dev.is_kernel_driver_active(0):
+                dev.detach_kernel_driver(0)
+        except (NotImplementedError, usb.core.USBError):
+            pass
+        dev.set_configuration()
+        usb.util.claim_interface(dev, 0)
+
+        self.devices[iIndex] = dev
+        self.modes[iIndex] = 0
+        self.pins[iIndex] = (0, 0)
+        return iIndex + 1
+
+    def CH341CloseDevice(self, iIndex):
+        dev = self.devices.pop(iIndex, None)
+        if dev is not None:
+            usb.util.release_interface(dev, 0)
+            usb.util.dispose_resources(dev)
+
+    def CH341GetDeviceName(self, iIndex):
+        # The CH341A has no serial number, the USB port path tells programmers apart
+        dev = self.devices.get(iIndex)
+        if dev is None:
+            return None
+        ports = ".".join(str(port) for port in (dev.port_numbers or ()))
+        return f"usb:{dev.bus}-{ports}".encode()
+
+    def CH341GetVersion(self):
+        return 0
+
+    def CH341GetDrvVersion(self):
+        return 0
+
+    @_usb_call(0)
+    def CH341GetVerIC(self, iIndex):
+        if iIndex not in self.devices:
+            return 0
+        version = self.devices[iIndex].ctrl_transfer(mCH341_VENDOR_READ, mCH341A_GET_VER, 0, 0, 2, USB_TIMEOUT_MS)
+        return version[0]
+
+    def CH341SetExclusive(self, iIndex, iExclusive):
+        # Claiming the interface already makes the device exclusive
+        return iIndex in self.devices
+
+    @_usb_call()
+    def CH341SetStream(self, iIndex, iMode):
+        if iIndex not in self.devices:
+            return False
+        self._write(iIndex, bytes([
+            mCH341A_CMD_I2C_STREAM,
+            mCH341A_CMD_I2C_STM_SET | (iMode & 0x07),
+            mCH341A_CMD_I2C_STM_END,
+        ]))
+        self.modes[iIndex] = iMode
+        return True
+
+    @_usb_call()
+    def CH341SetDelaymS(self, iIndex, iDelay):
+        if iIndex not in self.devices:
+            return False
+        command = bytearray([mCH341A_CMD_I2C_STREAM])
+        while iDelay > 0:
+            step = min(iDelay, mCH341A_CMD_I2C_STM_DLY)
+            command.append(mCH341A_CMD_I2C_STM_MS | step)
+            iDelay -= step
+            if len(command) == mCH341_PACKET_LENGTH - 1:
+                self._write(iIndex, command + bytes([mCH341A_CMD_I2C_STM_END]))
+                command = bytearray([mCH341A_CMD_I2C_STREAM])
+        if len(command) > 1:
+            self._write(iIndex, command + bytes([mCH341A_CMD_I2C_STM_END]))
+        return True
+
+    @_usb_call()
+    def CH341Set_D5_D0(self, iIndex, iSetDirOut, iSetDataOut):
+        if iIndex not in self.devices:
+            return False
+        self._set_pins(iIndex, iSetDirOut, iSetDataOut)
+        return True
+
+    @_usb_call()
+    def CH341StreamSPI4(self, iIndex, iChipSelect, iLength, ioBuffer):
+        if iIndex not in self.devices:
+            return False
+
+        view = memoryview(ioBuffer).cast('B')[:iLength]
+        msb_first = self.modes[iIndex] & 0x80
+        data = bytes(view)
+        if msb_first:
+            data = data.translate(_REVERSE_BITS)
+
+        if iChipSelect & 0x80:
+            direction, pins = self.pins[iIndex]
+            self._set_pins(iIndex, direction | 0x07, (pins | 0x07) & ~(1 << (iChipSelect & 0x03)))
+
+        # Every packet carries up to 31 bytes behind the SPI stream command and
+        # is answered with the same number of bytes read from DIN.
+        step = mCH341_PACKET_LENGTH - 1
+        packets = bytearray()
+        for offset in range(0, iLength, step):
+            packets.append(mCH341A_CMD_SPI_STREAM)
+            packets += data[offset:offset + step]
+        self._write(iIndex, packets)
+        answer = bytes(self._read(iIndex, iLength))
+
+        if iChipSelect & 0x80:
+            self._set_pins(iIndex, direction | 0x07, pins | 0x07)
+
+        if not view.readonly:
+            view[:] = answer.translate(_REVERSE_BITS) if msb_first else answer
+
+        return True
+
+    def CH341StreamSPI5(self, iIndex, iChipSelect, iLength, ioBuffer, ioBuffer2):
+        # The DLL bit-bangs the second data line through the UIO stream, which is not
+        # implemented here. Failing with False would look like a flaky link and be retried.
+        raise NotImplementedError("The libusb backend has no dual I/O, open the device with SPI_IO_SINGLE")
+
+    @_usb_call()
+    def CH341ResetRead(self, iIndex):
+        if iIndex not in self.devices:
+            return False
+        self.devices[iIndex].clear_halt(mCH341_ENDP_DATA_UP)
+        return True
+
+    @_usb_call()
+    def CH341ResetWrite(self, iIndex):
+        if iIndex not in self.devices:
+            return False
+        self.devices[iIndex].clear_halt(mCH341_ENDP_DATA_DOWN)
+        return True
+
+    @_usb_call()
+    def CH341FlushBuffer(self, iIndex):
+        if iIndex not in self.devices:
+            return False
+        self.devices[iIndex].ctrl_transfer(mCH341_VENDOR_WRITE, mCH341A_BUF_CLEAR, 0, 0, None, USB_TIMEOUT_MS)
+        return True
+
+    def CH341AbortRead(self, iIndex):
+        # pyusb transfers are synchronous, the one in flight ends with its timeout
+        return iIndex in self.devices
+
+    def CH341AbortWrite(self, iIndex):
+        return iIndex in self.devices
+
+    @_usb_call()
+    def CH341WriteRead(self, iIndex, iWriteLength, iWriteBuffer, iReadStep, iReadTimes, oReadLength, oReadBuffer):
+        if iIndex not in self.devices:
+            return False
+
+        self._write(iIndex, bytes(memoryview(iWriteBuffer).cast('B')[:iWriteLength]))
+
+        answer = bytearray()
+        for _ in range(iReadTimes):
+            chunk = self.devices[iIndex].read(mCH341_ENDP_DATA_UP, iReadStep, USB_TIMEOUT_MS)
+            answer += chunk
+            if len(chunk) < iReadStep:
+                break
+
+        memoryview(oReadBuffer).cast('B')[:len(answer)] = answer
+        oReadLength._obj.value = len(answer)
+        return True
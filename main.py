@@ -1,14 +1,38 @@
+import contextlib
+import bisect
+import collections
 import ctypes
+import hashlib
+import importlib
+import itertools
+import json
 from ctypes import c_ulong, cast, byref, Structure#,create_string_buffer
-from ctypes import POINTER, c_uint, c_bool, c_void_p, c_byte, c_char, c_char_p
+from ctypes import POINTER, c_uint, c_bool, c_void_p, c_byte, c_ubyte, c_char, c_char_p
+import logging
+import mmap
+import os
+import sys
 import struct
-from io import BytesIO, BufferedReader, SEEK_END, SEEK_SET
+import threading
 import time
 import zlib
 
+# Optional dependencies, imported on first use so importing this module stays quick:
+# numpy speeds up splitting data and OOB, xxhash replaces CRC32 in page_checksum()
+_OPTIONAL = {}
 
 
-CH341DLL = ctypes.WinDLL("CH341")
+def _optional(name):
+    if name not in _OPTIONAL:
+        try:
+            _OPTIONAL[name] = importlib.import_module(name)
+        except ImportError:
+            _OPTIONAL[name] = None
+    return _OPTIONAL[name]
+
+
+
+CH341DLL = None # bound on first use, see load_backend()
 
 
 
@@ -29,18 +53,120 @@ READ_FROM_CACHE_X2 = 0x3B
 READ_FROM_CACHE = 0x0B
 READ_DATA = 3
 
+# SPI-NAND
+PAGE_READ = 0x13
+PAGE_READ_CACHE_SEQUENTIAL = 0x31
+PAGE_READ_CACHE_LAST = 0x3F
+PROGRAM_LOAD = 0x02
+PROGRAM_EXECUTE = 0x10
+BLOCK_ERASE = 0xD8
+GET_FEATURE = 0x0F
+READ_ID = 0x9F
+SET_FEATURE = 0x1F
+
+FEATURE_PROTECTION = 0xA0
+FEATURE_CONFIG = 0xB0
+FEATURE_STATUS = 0xC0
+
+STATUS_OIP = 0x01 # operation in progress
+STATUS_WEL = 0x02 # write enable latch
+STATUS_E_FAIL = 0x04
+STATUS_P_FAIL = 0x08
+STATUS_ECCS = 0x30
+
+# ECC status of a page read (STATUS_ECCS >> 4)
+ECC_OK = 0
+ECC_CORRECTED = 1
+ECC_UNCORRECTABLE = 2
+
+BAD_BLOCK_MARKER_OK = 0xFF # first OOB byte of the first page of a good block
+
+# Datasheet typical array operation times (seconds), slept before the first status poll
+T_READ = 25e-6 # tRD
+T_PROGRAM = 300e-6 # tPROG
+T_ERASE = 3e-3 # tBERS
+POLL_INTERVAL = 50e-6 # first backoff step once the typical time has passed, doubled per poll
+POLL_SLEEP_MIN = 200e-6 # shorter delays are not slept, the USB round trip of the poll is the delay
+POLL_TIMEOUT = 1.0
+CHIP_ERASE_TIMEOUT = 200.0
+
 ENABLE_4BIT_MODE = 183
 DISABLE_4BIT_MODE = 233
 VENDOR_READ = 0xC0
 
+# CH341SetStream iMode bits, combined as speed | spi_io | spi_bit_order
 SPEED_LOW = 0b00000000 #  20KHz
-SPEED_STANDARD = 0b01000000 # 100KHz
-SPEED_FAST = 0b10000000 # 400KHz
-SPEED_HIGH = 0b11000000 # 750KHz
+SPEED_STANDARD = 0b00000001 # 100KHz
+SPEED_FAST = 0b00000010 # 400KHz
+SPEED_HIGH = 0b00000011 # 750KHz
 SPI_IO_SINGLE = 0b00000000 # single input and single output
-SPI_IO_DOUBLE = 0b00100000 # double input and double output
+SPI_IO_DOUBLE = 0b00000100 # double input and double output
 SPI_BIT_ORDER_LITTLE = 0b00000000 # little-endian (Low end first)
-SPI_BIT_ORDER_BIG = 0b00000001 # big-endian (High end first)
+SPI_BIT_ORDER_BIG = 0b10000000 # big-endian (High end first)
+
+# CH341A command stream (see CH341DLL.H), used to batch several SPI transactions into one CH341WriteRead
+mCH341_PACKET_LENGTH = 32
+mMAX_BUFFER_LENGTH = 0x1000
+mCH341A_CMD_SPI_STREAM = 0xA8
+mCH341A_CMD_UIO_STREAM = 0xAB
+mCH341A_CMD_UIO_STM_DIR = 0x40
+mCH341A_CMD_UIO_STM_OUT = 0x80
+mCH341A_CMD_UIO_STM_END = 0x20
+
+# Known SPI-NAND chips by JEDEC ID (manufacturer and device byte of Read ID, see
+# Device.read_jedec_id). Sizes are bytes, times are datasheet typicals in seconds.
+CHIPS = {
+    "e521": {"name": "DS35M1GA", "page_size": 2048, "oob_size": 64, "pages_per_block": 64, "blocks": 1024,
+             "t_read": 25e-6, "t_program": 300e-6, "t_erase": 3e-3, "cache_read": False},
+    "e571": {"name": "DS35Q1GA", "page_size": 2048, "oob_size": 64, "pages_per_block": 64, "blocks": 1024,
+             "t_read": 25e-6, "t_program": 300e-6, "t_erase": 3e-3, "cache_read": False},
+    "efaa": {"name": "W25N01GV", "page_size": 2048, "oob_size": 64, "pages_per_block": 64, "blocks": 1024,
+             "t_read": 60e-6, "t_program": 250e-6, "t_erase": 2e-3, "cache_read": False},
+}
+DEFAULT_CHIP = "e521" # geometry of a Device before open() identifies the chip
+
+TRACE_OFF = 0
+TRACE_TRANSACTIONS = 1 # opcode, address, length and duration of every SPI transaction
+TRACE_DATA = 2 # as above, plus head/tail of the data phase and its CRC32
+
+log = logging.getLogger("ch341")
+
+# Dump image container, see DumpImage. Little-endian throughout: the header, then the
+# zlib chunks, then one (chunk, slot) entry per page and one (offset, length, crc32) per chunk
+DUMP_MAGIC = b"CH341IMG"
+DUMP_VERSION = 1
+DUMP_CHUNK_PAGES = 16 # pages compressed together, a random access decompresses one chunk
+DUMP_ELIDED = 0xFFFFFFFF # chunk number of an erased page, which is not stored
+_DUMP_HEADER = struct.Struct("<8sHIIII8sIIIQQ") # magic, version, page/OOB size, pages per block, blocks, JEDEC ID,
+                                                # start page, pages, chunk pages, page index and chunk table offsets
+_DUMP_PAGE = struct.Struct("<IH")
+_DUMP_CHUNK = struct.Struct("<QII")
+
+# Transient USB failures are retried after a pipe reset, see Device.retries
+RETRIES = 3
+RETRY_BACKOFF = 0.005 # doubled after every failed attempt
+_TRANSFER_FUNCTIONS = {"CH341SetStream", "CH341Set_D5_D0", "CH341StreamSPI4", "CH341StreamSPI5", "CH341WriteRead", "CH341SetDelaymS"}
+
+
+def _cache_dir():
+    # Per-user cache directory for what is worth keeping between runs, nothing goes to the working directory
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser(os.path.join("~", "AppData", "Local"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache"))
+    return os.path.join(base, "ch341")
+
+
+class CH341Error(RuntimeError):
+    """A CH341 API call failed, function is its name."""
+
+    def __init__(self, function, detail=None):
+        super().__init__(f"{function}: {detail}" if detail else function)
+        self.function = function
+
+
+class OperationAborted(Exception):
+    """Device.abort() stopped the operation in progress."""
 
 """
 0x29, 1 - 00101001
@@ -51,66 +177,352 @@ SPI_BIT_ORDER_BIG = 0b00000001 # big-endian (High end first)
 """
 
 
-class CH341:
+def _load_windll():
+
+    dll = ctypes.WinDLL("CH341")
 
-    CH341DLL.CH341OpenDevice.argtypes = [c_uint]
-    CH341DLL.CH341OpenDevice.restype = c_void_p
+    dll.CH341OpenDevice.argtypes = [c_uint]
+    dll.CH341OpenDevice.restype = c_void_p
 
-    CH341DLL.CH341CloseDevice.argtypes = [c_uint]
-    CH341DLL.CH341CloseDevice.restype = None
+    dll.CH341CloseDevice.argtypes = [c_uint]
+    dll.CH341CloseDevice.restype = None
 
-    CH341DLL.CH341GetVersion.argtypes = []
-    CH341DLL.CH341GetVersion.restype = None
+    dll.CH341GetVersion.argtypes = []
+    dll.CH341GetVersion.restype = None
 
-    CH341DLL.CH341GetDeviceName.argtypes = [c_ulong]
-    CH341DLL.CH341GetDeviceName.restype = c_void_p 
+    dll.CH341GetDeviceName.argtypes = [c_ulong]
+    dll.CH341GetDeviceName.restype = c_void_p
 
-    CH341DLL.CH341DriverCommand.argtypes = [c_uint, c_void_p]
-    CH341DLL.CH341DriverCommand.restype = None
+    dll.CH341DriverCommand.argtypes = [c_uint, c_void_p]
+    dll.CH341DriverCommand.restype = None
 
-    CH341DLL.CH341SetDeviceNotify.argtypes = [c_uint, c_void_p, c_void_p]
-    CH341DLL.CH341SetDeviceNotify.restype = c_uint
+    dll.CH341SetDeviceNotify.argtypes = [c_uint, c_void_p, c_void_p]
+    dll.CH341SetDeviceNotify.restype = c_uint
 
-    CH341DLL.CH341WriteData.argtypes = [c_uint, c_void_p, c_void_p]
-    CH341DLL.CH341WriteData.restype = c_bool
+    dll.CH341WriteData.argtypes = [c_uint, c_void_p, c_void_p]
+    dll.CH341WriteData.restype = c_bool
 
-    CH341DLL.CH341GetVerIC.argtypes = [c_uint]
-    CH341DLL.CH341GetVerIC.restype = c_uint
+    dll.CH341GetVerIC.argtypes = [c_uint]
+    dll.CH341GetVerIC.restype = c_uint
 
-    CH341DLL.CH341SetStream.argtypes = [c_ulong, c_ulong]
-    CH341DLL.CH341SetStream.restype = c_bool
+    dll.CH341SetStream.argtypes = [c_ulong, c_ulong]
+    dll.CH341SetStream.restype = c_bool
 
-    CH341DLL.CH341Set_D5_D0.argtypes = [c_ulong, c_ulong, c_ulong]
-    CH341DLL.CH341Set_D5_D0.restype = c_bool
+    dll.CH341Set_D5_D0.argtypes = [c_ulong, c_ulong, c_ulong]
+    dll.CH341Set_D5_D0.restype = c_bool
 
-    CH341DLL.CH341SetDelaymS.argtypes = [c_uint, c_uint]
-    CH341DLL.CH341SetDelaymS.restype = c_bool
+    dll.CH341SetDelaymS.argtypes = [c_uint, c_uint]
+    dll.CH341SetDelaymS.restype = c_bool
 
-    CH341DLL.CH341SetExclusive.argtypes = [c_uint, c_uint]
-    CH341DLL.CH341SetExclusive.restype = c_bool
+    dll.CH341SetExclusive.argtypes = [c_uint, c_uint]
+    dll.CH341SetExclusive.restype = c_bool
 
-    CH341DLL.CH341StreamSPI5.argtypes = [c_uint, c_uint, c_uint, c_void_p, c_void_p]
-    CH341DLL.CH341StreamSPI5.restype = c_bool
+    dll.CH341StreamSPI5.argtypes = [c_uint, c_uint, c_uint, c_void_p, c_void_p]
+    dll.CH341StreamSPI5.restype = c_bool
 
-    CH341DLL.CH341StreamSPI4.argtypes = [c_uint, c_uint, c_uint, c_void_p]
-    CH341DLL.CH341StreamSPI4.restype = c_bool
+    dll.CH341StreamSPI4.argtypes = [c_uint, c_uint, c_uint, c_void_p]
+    dll.CH341StreamSPI4.restype = c_bool
 
-    CH341DLL.CH341BitStreamSPI.argtypes = [c_uint, c_uint, c_void_p]
-    CH341DLL.CH341BitStreamSPI.restype = c_bool
+    dll.CH341BitStreamSPI.argtypes = [c_uint, c_uint, c_void_p]
+    dll.CH341BitStreamSPI.restype = c_bool
 
-    CH341DLL.CH341StreamSPI3.argtypes = [c_uint, c_uint, c_uint, c_void_p]
-    CH341DLL.CH341StreamSPI3.restype = c_bool
+    dll.CH341StreamSPI3.argtypes = [c_uint, c_uint, c_uint, c_void_p]
+    dll.CH341StreamSPI3.restype = c_bool
 
-    CH341DLL.CH341WriteRead.argtypes = [
-        c_ulong,                
-        c_ulong,                
-        c_void_p,               
-        c_ulong,                
-        c_ulong,                
-        c_ulong,       
-        c_void_p                
+    dll.CH341WriteRead.argtypes = [
+        c_ulong,
+        c_ulong,
+        c_void_p,
+        c_ulong,
+        c_ulong,
+        c_void_p,
+        c_void_p
     ]
-    CH341DLL.CH341WriteRead.restype = c_bool
+    dll.CH341WriteRead.restype = c_bool
+
+    dll.CH341ResetRead.argtypes = [c_uint]
+    dll.CH341ResetRead.restype = c_bool
+
+    dll.CH341ResetWrite.argtypes = [c_uint]
+    dll.CH341ResetWrite.restype = c_bool
+
+    dll.CH341FlushBuffer.argtypes = [c_uint]
+    dll.CH341FlushBuffer.restype = c_bool
+
+    dll.CH341AbortRead.argtypes = [c_uint]
+    dll.CH341AbortRead.restype = c_bool
+
+    dll.CH341AbortWrite.argtypes = [c_uint]
+    dll.CH341AbortWrite.restype = c_bool
+
+    return dll
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the hot paths, kept only while enabled
+    (see enable_metrics()). Series are a name plus a tuple of (label, value) pairs.
+
+    ch341_call_seconds{function}          every CH341 API call
+    ch341_spi_bytes_total                 bytes clocked over SPI
+    ch341_usb_bytes_total{direction}      bytes of the CH341WriteRead command streams
+    ch341_busy_wait_seconds{operation}    issue to ready of array operations
+    ch341_status_polls_total{operation}   status polls spent waiting
+    ch341_retries_total{function}         transfers retried after a USB error
+    ch341_page_seconds                    end to end time of every page read or programmed
+    ch341_disk_write_seconds              writes of read data to files
+    ch341_disk_bytes_total                bytes written to files
+    ch341_page_cache_total{result}        page cache lookups, hit or miss
+    """
+
+    BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0, 3.0, 10.0)
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+
+    def reset(self):
+        # Zeroed in place, hot paths keep the histograms they looked up
+        self.counters = dict.fromkeys(self.counters, 0)
+        for histogram in self.histograms.values():
+            histogram.__init__()
+
+    def count(self, name, value=1, labels=()):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name, labels=()):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = _Histogram()
+        return histogram
+
+    def observe(self, name, seconds, labels=()):
+        self.histogram(name, labels).observe(seconds)
+
+    def mean(self, name, labels=()):
+        histogram = self.histograms.get((name, labels))
+        return histogram.sum / histogram.count if histogram and histogram.count else None
+
+    def snapshot(self):
+        """
+        {"counters": {name: {labels: value}}, "histograms": {name: {labels: {"count", "sum",
+        "buckets": {upper bound: cumulative count}}}}}, labels as 'key=value,...' strings.
+        """
+        counters = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            counters.setdefault(name, {})[_label_string(labels)] = value
+
+        histograms = {}
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            cumulative = list(itertools.accumulate(histogram.buckets))
+            histograms.setdefault(name, {})[_label_string(labels)] = {
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "buckets": dict(zip([str(bound) for bound in self.BUCKETS] + ["+Inf"], cumulative)),
+            }
+
+        return {"counters": counters, "histograms": histograms}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1)
+
+    def to_prometheus(self):
+        """Prometheus text exposition format."""
+        lines = []
+        typed = set()
+
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_prometheus_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            bounds = [str(bound) for bound in self.BUCKETS] + ["+Inf"]
+            for bound, cumulative in zip(bounds, itertools.accumulate(histogram.buckets)):
+                lines.append(f"{name}_bucket{_prometheus_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_prometheus_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_prometheus_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+class _Histogram:
+    # Per bucket counts of Metrics.BUCKETS (the last one is +Inf), count and sum
+
+    __slots__ = ("buckets", "count", "sum")
+
+    def __init__(self):
+        self.buckets = [0] * (len(Metrics.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(Metrics.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+def _label_string(labels):
+    return ",".join(f"{key}={value}" for key, value in labels)
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class _MeteredBackend:
+    # Times every CH341 API call of the wrapped backend into metrics
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        func = getattr(self.backend, name)
+        if not callable(func):
+            return func
+        observe = metrics.histogram("ch341_call_seconds", (("function", name),)).observe
+        perf_counter = time.perf_counter
+
+        def metered(*args):
+            t_start = perf_counter()
+            try:
+                return func(*args)
+            finally:
+                observe(perf_counter() - t_start)
+
+        # Bound once, later lookups don't come through __getattr__
+        setattr(self, name, metered)
+        return metered
+
+
+metrics = Metrics()
+
+
+def enable_metrics(enabled=True):
+    """
+    Start (or stop) collecting metrics, see Metrics. Returns the module's Metrics instance.
+    The CH341 API calls are timed by wrapping the backend, now and on later load_backend().
+    """
+    global CH341DLL
+
+    metrics.enabled = enabled
+    if CH341DLL is not None:
+        backend = CH341DLL.backend if isinstance(CH341DLL, _MeteredBackend) else CH341DLL
+        CH341DLL = _MeteredBackend(backend) if enabled else backend
+    return metrics
+
+
+def load_backend(backend=None):
+    """
+    Bind the CH341 API to a transport backend and return it.
+
+    backend is one of:
+        "dll"    - the vendor CH341.DLL through ctypes (Windows)
+        "libusb" - direct USB access through pyusb (Linux/macOS), see libusb_backend.py
+        "sim"    - in-process CH341 + DS35M1GA model, see simulator.py
+        or any object exposing the CH341DLL functions used here.
+
+    When omitted, $CH341_BACKEND is used, then "dll" on Windows and "libusb" elsewhere.
+    """
+    global CH341DLL
+
+    if backend is None:
+        backend = os.environ.get("CH341_BACKEND") or ("dll" if sys.platform == "win32" else "libusb")
+
+    if backend == "dll":
+        backend = _load_windll()
+    elif backend == "libusb":
+        from libusb_backend import LibusbCH341
+        backend = LibusbCH341()
+    elif backend == "sim":
+        from simulator import SimulatedCH341
+        backend = SimulatedCH341()
+    elif isinstance(backend, str):
+        raise ValueError(f"Unknown CH341 backend: {backend}")
+
+    CH341DLL = _MeteredBackend(backend) if metrics.enabled else backend
+    return backend
+
+
+def _dll():
+    if CH341DLL is None:
+        load_backend()
+    return CH341DLL
+
+
+def _io_buffer(buffer):
+    # bytearray/memoryview buffers are handed to the backend in place, so data read
+    # from DIN lands directly in them. bytes are passed through as output-only.
+    if isinstance(buffer, (bytearray, memoryview)):
+        return (c_ubyte * len(buffer)).from_buffer(buffer)
+    return buffer
+
+
+class CH341:
+
+    @staticmethod
+    def openDevice(iIndex):
+        """
+        HANDLE WINAPI CH341OpenDevice( // Open the CH341 device and return the handle. If an error occurs, it will be invalid.
+        ULONG iIndex );                // Specify CH341 device serial number, 0 corresponds to the first device
+        """
+        handle = _dll().CH341OpenDevice(iIndex)
+        return handle is not None and handle > 0
+
+    @staticmethod
+    def closeDevice(iIndex):
+        """
+        VOID WINAPI CH341CloseDevice( // Shut down the CH341 device
+        ULONG iIndex );               // Specify CH341 device serial number
+        """
+        _dll().CH341CloseDevice(iIndex)
+
+    @staticmethod
+    def setExclusive(iIndex, iExclusive):
+        """
+        BOOL WINAPI CH341SetExclusive( // Set exclusive use of the current CH341 device
+        ULONG iIndex,                  // Specify CH341 device serial number
+        ULONG iExclusive );            // 0 means the device can be shared, non-zero means exclusive use
+        """
+        if not _dll().CH341SetExclusive(iIndex, iExclusive):
+            raise CH341Error("CH341SetExclusive")
+
+    @staticmethod
+    def getVerIC(iIndex):
+        """
+        ULONG WINAPI CH341GetVerIC( // Get the version of CH341 chip, return: 0=Invalid device, 0x10=CH341, 0x20=CH341A
+        ULONG iIndex );             // Specify CH341 device serial number
+        """
+        return _dll().CH341GetVerIC(iIndex)
+
+    @staticmethod
+    def getDeviceName(iIndex):
+        """
+        PVOID WINAPI CH341GetDeviceName( // Return the device name of the CH341, NULL on error
+        ULONG iIndex );                  // Specify CH341 device serial number
+        """
+        name = _dll().CH341GetDeviceName(iIndex)
+        if not name:
+            return None
+        if not isinstance(name, bytes):  # char pointer from the DLL
+            name = cast(name, c_char_p).value
+        return name.decode(errors='replace')
+
+    @staticmethod
+    def getVersion():
+        return _dll().CH341GetVersion()
+
+    @staticmethod
+    def getDrvVersion():
+        return _dll().CH341GetDrvVersion()
 
     @staticmethod
     def setStream(iIndex, iMode):
@@ -134,8 +546,8 @@ class CH341:
          
          Other bits reserved, must be 0
         """
-        if not CH341DLL.CH341SetStream(c_ulong(iIndex), c_ulong(iMode)):
-            raise RuntimeError("CH341SetStream")
+        if not _dll().CH341SetStream(iIndex, iMode):
+            raise CH341Error("CH341SetStream")
 
     @staticmethod
     def setD5D0(iIndex, iSetDirOut, iSetDataOut):
@@ -147,8 +559,8 @@ class CH341:
             ULONG           iSetDataOut );  // Set the output data of each pin of D5-D0. If the I/O direction is output, then when a certain bit is cleared to 0, the corresponding pin outputs a low level, and when a certain bit is set to 1, the corresponding pin outputs a high level.
         // Bit 5-bit 0 of the above data correspond to the D5-D0 pins of CH341 respectively.
         """ 
-        if not CH341DLL.CH341Set_D5_D0(c_ulong(iIndex), c_ulong(iSetDirOut), c_ulong(iSetDataOut)):
-            raise RuntimeError("CH341Set_D5_D0")
+        if not _dll().CH341Set_D5_D0(iIndex, iSetDirOut, iSetDataOut):
+            raise CH341Error("CH341Set_D5_D0")
 
     @staticmethod
     def streamSPI4(iIndex, iChipSelect, iLength, ioBuffer):
@@ -160,8 +572,40 @@ class CH341:
         ULONG           iLength,  // Number of data bytes to be transmitted
         PVOID           ioBuffer );  // Point to a buffer, place the data to be written from DOUT, and return the data read from DIN
         """
-        if not CH341DLL.CH341StreamSPI4(c_ulong(iIndex), c_ulong(iChipSelect), c_ulong(iLength), ioBuffer):
-            raise RuntimeError("CH341StreamSPI4")
+        if not _dll().CH341StreamSPI4(iIndex, iChipSelect, iLength, _io_buffer(ioBuffer)):
+            raise CH341Error("CH341StreamSPI4")
+
+    @staticmethod
+    def writeRead(iIndex, iWriteLength, iWriteBuffer, iReadStep, iReadTimes, oReadBuffer):
+        """
+        BOOL WINAPI CH341WriteRead( // Execute data flow command, output first and then input
+        ULONG iIndex,           // Specify CH341 device serial number
+        ULONG iWriteLength,     // Write length, the length to be written
+        PVOID iWriteBuffer,     // Points to a buffer to place the data to be written.
+        ULONG iReadStep,        // The length of a single block to be read, the total length to be read is (iReadStep*iReadTimes)
+        ULONG iReadTimes,       // Number of times to prepare for reading
+        PULONG oReadLength,     // Points to the length unit, and returns the actual read length.
+        PVOID oReadBuffer );    // Points to a buffer large enough to save the read data
+
+        Returns the actual read length.
+        """
+        oReadLength = c_ulong(0)
+        if not _dll().CH341WriteRead(iIndex, iWriteLength, _io_buffer(iWriteBuffer), iReadStep, iReadTimes, byref(oReadLength), _io_buffer(oReadBuffer)):
+            raise CH341Error("CH341WriteRead")
+        return oReadLength.value
+
+    @staticmethod
+    def streamSPI5(iIndex, iChipSelect, iLength, ioBuffer, ioBuffer2):
+        """
+        BOOL    WINAPI  CH341StreamSPI5(  // Process SPI data stream, 5-wire interface, the clock line is DCK/D3 pin, the output data line is DOUT/D5 and DOUT2/D4 pin, the input data line is DIN/D7 and DIN2/D6 pin pin, the chip select line is D0/D1/D2, the speed is about 30K bytes*2
+        ULONG           iIndex,  // Specify CH341 device serial number
+        ULONG           iChipSelect,  // Chip select control, if bit 7 is 0, the chip select control is ignored, if bit 7 is 1, the parameters are valid: Bit 1 and bit 0 are 00/01/10, respectively, select the D0/D1/D2 pin as low level. valid chip select
+        ULONG           iLength,  // Number of data bytes to be transmitted
+        PVOID           ioBuffer,  // Points to a buffer to place the data to be written from DOUT. After returning, the data is read from DIN.
+        PVOID           ioBuffer2 );  // Point to the second buffer, place the data to be written from DOUT2, and return the data read from DIN2
+        """
+        if not _dll().CH341StreamSPI5(iIndex, iChipSelect, iLength, _io_buffer(ioBuffer), _io_buffer(ioBuffer2)):
+            raise CH341Error("CH341StreamSPI5")
 
     @staticmethod
     def setDelaymS(iIndex, iDelay):
@@ -170,19 +614,708 @@ class CH341:
         ULONG iIndex,               //Specify CH341 device serial number
         ULONG iDelay );             //Specify the number of milliseconds of delay   
         """
-        if not CH341DLL.CH341SetDelaymS(c_uint(iIndex), c_uint(iDelay)):
-            raise RuntimeError("CH341SetDelaymS")
+        if not _dll().CH341SetDelaymS(iIndex, iDelay):
+            raise CH341Error("CH341SetDelaymS")
+
+    @staticmethod
+    def resetRead(iIndex):
+        """
+        BOOL WINAPI CH341ResetRead( // Reset data block read operation
+        ULONG iIndex );             // Specify CH341 device serial number
+        """
+        if not _dll().CH341ResetRead(iIndex):
+            raise CH341Error("CH341ResetRead")
+
+    @staticmethod
+    def resetWrite(iIndex):
+        """
+        BOOL WINAPI CH341ResetWrite( // Reset data block write operation
+        ULONG iIndex );              // Specify CH341 device serial number
+        """
+        if not _dll().CH341ResetWrite(iIndex):
+            raise CH341Error("CH341ResetWrite")
+
+    @staticmethod
+    def flushBuffer(iIndex):
+        """
+        BOOL WINAPI CH341FlushBuffer( // Clear the buffer of CH341
+        ULONG iIndex );               // Specify CH341 device serial number
+        """
+        if not _dll().CH341FlushBuffer(iIndex):
+            raise CH341Error("CH341FlushBuffer")
+
+    @staticmethod
+    def abortRead(iIndex):
+        """
+        BOOL WINAPI CH341AbortRead( // Abort the data block read operation
+        ULONG iIndex );             // Specify CH341 device serial number
+        """
+        return bool(_dll().CH341AbortRead(iIndex))
+
+    @staticmethod
+    def abortWrite(iIndex):
+        """
+        BOOL WINAPI CH341AbortWrite( // Abort the data block write operation
+        ULONG iIndex );              // Specify CH341 device serial number
+        """
+        return bool(_dll().CH341AbortWrite(iIndex))
+
+# The CH341A shifts raw stream bytes LSB first, SPI flash expects MSB first
+_REVERSE_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+# Dual I/O reads: CH341StreamSPI5 returns the bits seen on flash IO1 (DIN/D7) in the first
+# buffer and on flash IO0 (DIN2/D6) in the second. Each flash byte takes four clocks, bits
+# 7,5,3,1 on IO1 and 6,4,2,0 on IO0, so one byte of each buffer holds two flash bytes:
+# the high nibbles make the first one and the low nibbles the second.
+def _interleave_nibbles(io1, io0):
+    value = 0
+    for i in range(4):
+        value |= ((io1 >> (3 - i)) & 1) << (7 - 2 * i)
+        value |= ((io0 >> (3 - i)) & 1) << (6 - 2 * i)
+    return value
+
+_DUAL_MERGE = bytes(_interleave_nibbles(i >> 4, i & 0x0F) for i in range(256))
+
+
+def _merge_dual(io1, io0, out):
+    """Rebuild len(out) flash bytes from the IO1/IO0 bit streams of a dual I/O read."""
+    length = len(io1)
+    a = int.from_bytes(io1, 'big')
+    b = int.from_bytes(io0, 'big')
+    high = 0xF0 * int.from_bytes(b'\x01' * length, 'big')
+    low = high >> 4
+
+    first = ((a & high) | ((b & high) >> 4)).to_bytes(length, 'big').translate(_DUAL_MERGE)
+    second = (((a & low) << 4) | (b & low)).to_bytes(length, 'big').translate(_DUAL_MERGE)
+
+    out[0::2] = first[:(len(out) + 1) // 2]
+    out[1::2] = second[:len(out) // 2]
+
+
+def _find_all(data, value):
+    position = data.find(value)
+    while position != -1:
+        yield position
+        position = data.find(value, position + 1)
+
+
+def page_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def page_checksum(data):
+    # Cheap per-page check value for verification, not for deciding what to skip (see page_digest)
+    xxhash = _optional("xxhash")
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(data)
+    return zlib.crc32(data)
+
+
+def bit_flips(data, expected):
+    """Number of bits that differ between two equally long buffers."""
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(expected, 'big')).bit_count()
+
+
+# D0 (CS) low/high with D5-D0 as outputs
+_UIO_SELECT = bytes([mCH341A_CMD_UIO_STM_OUT | 0x00, mCH341A_CMD_UIO_STM_DIR | 0x3F])
+_UIO_DESELECT = bytes([mCH341A_CMD_UIO_STM_OUT | 0x01, mCH341A_CMD_UIO_STM_DIR | 0x3F])
+
+
+class SpiBatch:
+    """
+    Queue of chip-select framed SPI transactions sent with as few USB round trips as possible.
+
+    A transaction is the command phase (opcode, address and dummy bytes), an optional data out
+    phase and an optional data in phase, all inside one CS low period. Instead of toggling CS
+    with CH341Set_D5_D0 and streaming each phase separately, a lone transaction is sent with a
+    single CH341StreamSPI4 call that lets the CH341 drive CS, and consecutive transactions that
+    end in a data in phase are packed into one CH341A command stream (CS toggles included) and
+    run with a single CH341WriteRead. Data in phases can be padded with extra clocks, which is
+    what makes packing them safe; anything else is sent on its own.
+    """
+
+    SPI_STEP = mCH341_PACKET_LENGTH - 1
+
+    def __init__(self, index=0):
+        self.index = index
+        self.transactions = []
+        self.usb_calls = 0
+        self._buffer = bytearray()
+        self._answer = bytearray()
+
+    def add(self, command, write=None, read=0, into=None):
+        """
+        Queue a transaction. read bytes are clocked in after command and write; they are copied
+        into `into` when given, otherwise returned as bytes by execute().
+        """
+        self.transactions.append((bytes(command), write, read, into))
+        return self
+
+    def clear(self):
+        self.transactions = []
+
+    def execute(self):
+        """
+        Send the queued transactions in order and clear the queue.
+        Returns the data in phase of each transaction (None when it has none).
+        """
+        return self.send(self.prepare())
+
+    def prepare(self):
+        """
+        Group and encode the queued transactions for send() and clear the queue, so the
+        host side work can be done ahead of time. A prepared batch can be sent again.
+        """
+        parts = []
+        run = []
+        write_len = read_len = 0
+
+        for transaction in self.transactions:
+
+            command, write, read, into = transaction
+            if not read:
+                parts += self._encode_run(run)
+                run, write_len, read_len = [], 0, 0
+                parts.append((transaction, None))
+                continue
+
+            padded = -(-(len(command) + len(write or b'') + read) // self.SPI_STEP) * self.SPI_STEP
+            packets = padded // self.SPI_STEP
+            if run and (write_len + mCH341_PACKET_LENGTH * (packets + 2) > mMAX_BUFFER_LENGTH or
+                        read_len + padded > mMAX_BUFFER_LENGTH):
+                parts += self._encode_run(run)
+                run, write_len, read_len = [], 0, 0
+
+            run.append(transaction)
+            write_len += mCH341_PACKET_LENGTH * (packets + 1)
+            read_len += padded
+
+        parts += self._encode_run(run)
+        prepared = (self.transactions, parts)
+        self.clear()
+        return prepared
+
+    def send(self, prepared):
+        """Send a batch returned by prepare(), returns what execute() does."""
+        results = []
+        for transaction, encoded in prepared[1]:
+            if encoded is None:
+                results.append(self._send_one(transaction))
+            else:
+                results += self._send_run(*encoded)
+        return results
+
+    def _scratch(self, length):
+        if len(self._buffer) < length:
+            self._buffer = bytearray(length)
+        return memoryview(self._buffer)[:length]
+
+    def _result(self, data, into):
+        if into is None:
+            return bytes(data)
+        memoryview(into).cast('B')[:len(data)] = data
+        return into
+
+    def _send_one(self, transaction):
+
+        command, write, read, into = transaction
+        header = len(command) + len(write or b'')
+        length = header + read
+
+        buffer = self._scratch(length)
+        buffer[:len(command)] = command
+        if write:
+            buffer[len(command):header] = write
+        buffer[header:] = b'\xff' * read
+
+        CH341.streamSPI4(self.index, 0x80, length, buffer)
+        self.usb_calls += 1
+        if metrics.enabled:
+            metrics.count("ch341_spi_bytes_total", length)
+
+        return self._result(buffer[header:], into) if read else None
+
+    def _encode_run(self, run):
+        # One CH341A command stream for the whole run, a lone transaction is sent as it is
+        if not run:
+            return []
+        if len(run) == 1:
+            return [(run[0], None)]
+
+        stream = bytearray()
+        spans = []
+        offset = 0
+
+        for i, (command, write, read, into) in enumerate(run):
+
+            uio = _UIO_SELECT if i == 0 else _UIO_DESELECT + _UIO_SELECT
+            stream += bytes([mCH341A_CMD_UIO_STREAM]) + uio + bytes([mCH341A_CMD_UIO_STM_END])
+            stream += bytes(mCH341_PACKET_LENGTH - 2 - len(uio))
+
+            header = command + bytes(write or b'')
+            padded = -(-(len(header) + read) // self.SPI_STEP) * self.SPI_STEP
+            payload = (header + b'\xff' * (padded - len(header))).translate(_REVERSE_BITS)
+            for start in range(0, padded, self.SPI_STEP):
+                stream.append(mCH341A_CMD_SPI_STREAM)
+                stream += payload[start:start + self.SPI_STEP]
+
+            spans.append((offset + len(header), read, into))
+            offset += padded
+
+        stream += bytes([mCH341A_CMD_UIO_STREAM]) + _UIO_DESELECT + bytes([mCH341A_CMD_UIO_STM_END])
+
+        return [(None, (bytes(stream), spans, offset))]
+
+    def _send_run(self, stream, spans, offset):
+
+        # Sized to the answer exactly, so it is bit-reversed as a whole in one translate()
+        if len(self._answer) != offset:
+            self._answer = bytearray(offset)
+        answer = self._answer
+        length = CH341.writeRead(self.index, len(stream), stream, self.SPI_STEP, offset // self.SPI_STEP, answer)
+        self.usb_calls += 1
+        if metrics.enabled:
+            metrics.count("ch341_spi_bytes_total", offset)
+            metrics.count("ch341_usb_bytes_total", len(stream), (("direction", "out"),))
+            metrics.count("ch341_usb_bytes_total", offset, (("direction", "in"),))
+        if length != offset:
+            raise CH341Error("CH341WriteRead", f"expected {offset} bytes, got {length}")
+
+        data = memoryview(answer.translate(_REVERSE_BITS))
+        return [self._result(data[start:start + read], into) for start, read, into in spans]
+
+
+class PageCache:
+    """
+    Read-through cache of raw pages (data and OOB) with their ECC status, keyed by physical
+    page and evicted least recently used first once the pages exceed max_bytes. With
+    directory, every cached page is also kept there as a file, so pages evicted from memory,
+    or cached by an earlier run, are read back from disk instead of the chip. The directory
+    is only valid for one chip: it must not be written with another tool in between.
+    Device.enable_page_cache() attaches one; program_page(), program_pages() and
+    erase_block() drop the pages they change, and Device.open() calls bind(), which starts
+    over unless it is the same programmer and chip ID.
+    """
+
+    def __init__(self, max_bytes, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.pages = collections.OrderedDict() # page -> (ECC status, data), oldest first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, page):
+        return os.path.join(self.directory, f"{page:07d}.page")
+
+    def bind(self, programmer, chip_id):
+        """
+        Take the cache over for chip_id on programmer (device name). Memory is always
+        dropped, another chip may be in the socket; the directory only when it was filled
+        for another programmer or chip ID.
+        """
+        self.pages.clear()
+        self.size = 0
+        if self.directory is None:
+            return
+
+        identity = {"programmer": programmer, "chip_id": chip_id}
+        path = os.path.join(self.directory, "chip.json")
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            saved = None
+        if saved != identity:
+            self.clear()
+            with open(path, 'w') as f:
+                json.dump(identity, f)
+
+    def get(self, page):
+        """(ECC status, data) of page, or None on a miss."""
+        entry = self.pages.get(page)
+        if entry is not None:
+            self.pages.move_to_end(page)
+        elif self.directory is not None:
+            try:
+                with open(self._path(page), 'rb') as f:
+                    stored = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                entry = (stored[0], stored[1:])
+                self._keep(page, entry)
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if metrics.enabled:
+            metrics.count("ch341_page_cache_total", 1, (("result", "miss" if entry is None else "hit"),))
+        return entry
+
+    def put(self, page, data, status=ECC_OK):
+        entry = (status, bytes(data))
+        self._keep(page, entry)
+        if self.directory is not None:
+            # Renamed into place, so an interrupted write never leaves a torn page behind
+            path = self._path(page)
+            with open(path + ".tmp", 'wb') as f:
+                f.write(bytes([status]))
+                f.write(entry[1])
+            os.replace(path + ".tmp", path)
+
+    def _keep(self, page, entry):
+        old = self.pages.pop(page, None)
+        if old is not None:
+            self.size -= len(old[1])
+        self.pages[page] = entry
+        self.size += len(entry[1])
+        while self.size > self.max_bytes and self.pages:
+            _, (_, data) = self.pages.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+
+    def invalidate(self, start_page, end_page=None):
+        """Drop pages [start_page, end_page), just start_page when end_page is None."""
+        for page in range(start_page, start_page + 1 if end_page is None else end_page):
+            entry = self.pages.pop(page, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+            if self.directory is not None:
+                try:
+                    os.remove(self._path(page))
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        self.pages.clear()
+        self.size = 0
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith(".page"):
+                    os.remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        """hits, misses, hit_rate, evictions, pages and bytes held in memory."""
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions, "pages": len(self.pages), "bytes": self.size}
+
+
+class DumpImage:
+    """
+    Read side of the dump image container written by DumpImage.write() (Device.dump_image()
+    from the chip). The file is memory mapped and only the chunk holding a page is inflated,
+    the last one is kept for the pages next to it. Pages are numbered as on the chip, from
+    start_page to start_page + len(image); erased pages are not stored and read as 0xFF.
+
+        with DumpImage("dump.img") as image:
+            image.page(n), image.data(n), image.oob(n)
+    """
+
+    def __init__(self, file_name):
+        self._file = open(file_name, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self._file.close()
+            raise ValueError(f"{file_name} is not a dump image")
+
+        if self._map[:len(DUMP_MAGIC)] != DUMP_MAGIC or len(self._map) < _DUMP_HEADER.size:
+            self.close()
+            raise ValueError(f"{file_name} is not a dump image")
+        (_, version, self.page_size, self.oob_size, self.pages_per_block, self.blocks, jedec_id,
+         self.start_page, self.page_count, self.chunk_pages, self._index_at, self._chunks_at) = _DUMP_HEADER.unpack_from(self._map)
+        if version != DUMP_VERSION:
+            self.close()
+            raise ValueError(f"{file_name}: unsupported dump image version {version}")
+
+        self.jedec_id = jedec_id.rstrip(b'\0').decode('ascii') or None
+        self.data_size = self.page_size - self.oob_size
+        self._erased = b'\xff' * self.page_size
+        self._inflated = (None, None)
+
+    @staticmethod
+    def is_image(file_name):
+        try:
+            with open(file_name, 'rb') as f:
+                return f.read(len(DUMP_MAGIC)) == DUMP_MAGIC
+        except (FileNotFoundError, IsADirectoryError):
+            return False
+
+    @classmethod
+    def write(cls, file_name, pages, page_size, oob_size, pages_per_block, blocks, jedec_id=None,
+              start_page=0, chunk_pages=DUMP_CHUNK_PAGES, level=6):
+        """
+        Write pages (an iterable of raw pages, e.g. Util.iter_pages of a raw dump) as a dump
+        image. Returns the number of pages, elided (erased) pages and bytes written.
+        """
+        erased = b'\xff' * page_size
+        index = bytearray()
+        chunks = bytearray()
+        stats = {"pages": 0, "elided": 0, "bytes": 0}
+
+        with open(file_name, 'wb') as f:
+            f.write(bytes(_DUMP_HEADER.size))
+            offset = _DUMP_HEADER.size
+            chunk = bytearray()
+
+            def flush():
+                nonlocal offset
+                packed = zlib.compress(chunk, level)
+                chunks.extend(_DUMP_CHUNK.pack(offset, len(packed), zlib.crc32(chunk)))
+                Util().write_chunk(f, packed)
+                offset += len(packed)
+                chunk.clear()
+
+            for page in pages:
+                if len(page) < page_size:
+                    page = bytes(page) + erased[len(page):]
+                stats["pages"] += 1
+                if page == erased:
+                    index.extend(_DUMP_PAGE.pack(DUMP_ELIDED, 0))
+                    stats["elided"] += 1
+                    continue
+                index.extend(_DUMP_PAGE.pack(len(chunks) // _DUMP_CHUNK.size, len(chunk) // page_size))
+                chunk += page
+                if len(chunk) == chunk_pages * page_size:
+                    flush()
+            if chunk:
+                flush()
+
+            f.write(index)
+            f.write(chunks)
+            stats["bytes"] = f.tell()
+            f.seek(0)
+            f.write(_DUMP_HEADER.pack(DUMP_MAGIC, DUMP_VERSION, page_size, oob_size, pages_per_block, blocks,
+                                      (jedec_id or "").encode('ascii'), start_page, stats["pages"], chunk_pages,
+                                      offset, offset + len(index)))
+        return stats
+
+    def __len__(self):
+        return self.page_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _entry(self, page):
+        if not self.start_page <= page < self.start_page + self.page_count:
+            raise IndexError(f"page {page} is not in the image ({self.start_page} to {self.start_page + self.page_count - 1})")
+        return _DUMP_PAGE.unpack_from(self._map, self._index_at + (page - self.start_page) * _DUMP_PAGE.size)
+
+    def _chunk(self, chunk):
+        if self._inflated[0] != chunk:
+            offset, length, crc = _DUMP_CHUNK.unpack_from(self._map, self._chunks_at + chunk * _DUMP_CHUNK.size)
+            data = zlib.decompress(self._map[offset:offset + length])
+            if zlib.crc32(data) != crc:
+                raise ValueError(f"dump image chunk {chunk} is corrupt")
+            self._inflated = (chunk, memoryview(data))
+        return self._inflated[1]
+
+    def elided(self, page):
+        """True when page was erased and is not stored."""
+        return self._entry(page)[0] == DUMP_ELIDED
+
+    def page(self, page):
+        """Raw page (data and OOB), read-only."""
+        chunk, slot = self._entry(page)
+        if chunk == DUMP_ELIDED:
+            return memoryview(self._erased)
+        return self._chunk(chunk)[slot * self.page_size:(slot + 1) * self.page_size]
+
+    def data(self, page):
+        return self.page(page)[:self.data_size]
+
+    def oob(self, page):
+        return self.page(page)[self.data_size:]
+
+    def iter_pages(self):
+        """Every page in order, each chunk is inflated once."""
+        for page in range(self.start_page, self.start_page + self.page_count):
+            yield self.page(page)
+
 
 class Util:
 
     def write_to(self, file_name='out.bin', data=None):
         with open(file_name, 'wb') as f:
-            f.write(data)
+            self.write_chunk(f, data)
+
+    def write_chunk(self, f, data):
+        # Written and flushed right away, so an interrupted read keeps what was read so far
+        t_start = time.perf_counter()
+        f.write(data)
+        f.flush()
+        if metrics.enabled:
+            metrics.observe("ch341_disk_write_seconds", time.perf_counter() - t_start)
+            metrics.count("ch341_disk_bytes_total", len(data))
+
+    def map_file(self, file_name='out.bin', size=0):
+        # Writable memory map of a freshly sized file, usable as a Device.read_into() target
+        with open(file_name, 'w+b') as f:
+            f.truncate(size)
+            return mmap.mmap(f.fileno(), size)
 
     def read_from(self, file_name='out.bin'):
         with open(file_name, 'rb') as f:
             return f.read()
 
+    def iter_pages(self, source, page_size):
+        """
+        Yield source page_size bytes at a time, the last chunk possibly shorter.
+        source is a path, a binary file object, a bytes-like object (sliced without copying),
+        an iterable of bytes-like chunks of any size or a DumpImage (also given by its path),
+        whose erased pages come without being stored or inflated. Files and iterables are read into
+        one reusable buffer, so each page is only valid until the next one is requested.
+        """
+        if isinstance(source, DumpImage):
+            yield from source.iter_pages()
+            return
+
+        if isinstance(source, (str, os.PathLike)):
+            if DumpImage.is_image(source):
+                with DumpImage(source) as image:
+                    yield from image.iter_pages()
+                return
+            with open(source, 'rb') as f:
+                yield from self.iter_pages(f, page_size)
+            return
+
+        try:
+            data = memoryview(source).cast('B')
+        except TypeError:
+            data = None
+
+        if data is not None:
+            for offset in range(0, len(data), page_size):
+                yield data[offset:offset + page_size]
+            return
+
+        buffer = memoryview(bytearray(page_size))
+        filled = 0
+
+        if hasattr(source, 'readinto'):
+            while True:
+                # Raw files and pipes may return less than asked for
+                count = source.readinto(buffer[filled:])
+                if not count:
+                    break
+                filled += count
+                if filled == page_size:
+                    yield buffer
+                    filled = 0
+        else:
+            for chunk in source:
+                chunk = memoryview(chunk).cast('B')
+                while chunk:
+                    count = min(len(chunk), page_size - filled)
+                    buffer[filled:filled + count] = chunk[:count]
+                    filled += count
+                    chunk = chunk[count:]
+                    if filled == page_size:
+                        yield buffer
+                        filled = 0
+
+        if filled:
+            yield buffer[:filled]
+
+    def image_start(self, source):
+        """First page of source when it is a DumpImage (or the path of one), otherwise None."""
+        if isinstance(source, DumpImage):
+            return source.start_page
+        if isinstance(source, (str, os.PathLike)) and DumpImage.is_image(source):
+            with DumpImage(source) as image:
+                return image.start_page
+        return None
+
+    def load_journal(self, file_name, header):
+        """
+        Block -> CRC32 map of a dump journal, empty if it is missing or was written with another
+        header. Lines are "block crc32" in hex; a torn last line is ignored.
+        """
+        journal = {}
+        try:
+            with open(file_name) as f:
+                if f.readline().rstrip('\n') != header:
+                    return {}
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and line.endswith('\n'):
+                        journal[int(fields[0], 16)] = int(fields[1], 16)
+        except FileNotFoundError:
+            pass
+        return journal
+
+    def load_manifest(self, file_name, page_size, programmer=None, chip_id=None):
+        """
+        Page number -> digest map saved by save_manifest, empty if missing or saved for another
+        page size, programmer (device name) or chip ID.
+        """
+        try:
+            with open(file_name) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {}
+        if (manifest.get("page_size") != page_size or manifest.get("programmer") != programmer or
+                manifest.get("chip_id") != chip_id):
+            return {}
+        return {int(page): bytes.fromhex(digest) for page, digest in manifest["pages"].items()}
+
+    def save_manifest(self, file_name, page_size, digests, programmer=None, chip_id=None):
+        with open(file_name, 'w') as f:
+            json.dump({
+                "page_size": page_size,
+                "programmer": programmer,
+                "chip_id": chip_id,
+                "pages": {str(page): digest.hex() for page, digest in sorted(digests.items())},
+            }, f)
+
+    def load_bbt(self, file_name, programmer, chip_id, blocks):
+        """Bad block numbers saved by save_bbt, None if missing or for another programmer, chip or geometry."""
+        try:
+            with open(file_name) as f:
+                bbt = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if bbt.get("programmer") != programmer or bbt.get("chip_id") != chip_id or bbt.get("blocks") != blocks:
+            return None
+        return set(bbt["bad"])
+
+    def save_bbt(self, file_name, programmer, chip_id, blocks, bad):
+        with open(file_name, 'w') as f:
+            json.dump({"programmer": programmer, "chip_id": chip_id, "blocks": blocks, "bad": sorted(bad)}, f)
+
+    def load_probe(self, file_name, programmer):
+        """What save_probe stored for programmer, None if there is nothing."""
+        try:
+            with open(file_name) as f:
+                return json.load(f).get(programmer)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_probe(self, file_name, programmer, probe):
+        # One file for all programmers, keyed by device name
+        try:
+            with open(file_name) as f:
+                probes = json.load(f)
+        except (FileNotFoundError, ValueError):
+            probes = {}
+        probes[programmer] = probe
+        os.makedirs(os.path.dirname(file_name) or os.curdir, exist_ok=True)
+        with open(file_name, 'w') as f:
+            json.dump(probes, f, indent=1, sort_keys=True)
+
     def convert_size(self, byte_size):
         if byte_size < 1024:
             return f"{byte_size} Bytes"
@@ -212,7 +1345,67 @@ class Util:
 
 class Device:
     
-    def __init__(self, OOB_SIZE=64, PAGE_SIZE=2048+64, BLOCK_SIZE=135168, BLOCKS_COUNT=1024):
+    def __init__(self, OOB_SIZE=None, PAGE_SIZE=None, BLOCK_SIZE=None, BLOCKS_COUNT=None, CACHE_READ=None):
+
+        # Geometry that isn't given is taken from CHIPS once open() has read the JEDEC ID
+        self.geometry_given = any(size is not None for size in (OOB_SIZE, PAGE_SIZE, BLOCK_SIZE, BLOCKS_COUNT))
+        self.cache_read_given = CACHE_READ is not None
+
+        chip = CHIPS[DEFAULT_CHIP]
+        page_size = chip["page_size"] + chip["oob_size"]
+        self.set_geometry(
+            chip["oob_size"] if OOB_SIZE is None else OOB_SIZE,
+            page_size if PAGE_SIZE is None else PAGE_SIZE,
+            page_size * chip["pages_per_block"] if BLOCK_SIZE is None else BLOCK_SIZE,
+            chip["blocks"] if BLOCKS_COUNT is None else BLOCKS_COUNT,
+        )
+        self.CACHE_READ = chip["cache_read"] if CACHE_READ is None else CACHE_READ # chip supports Page Read Cache Sequential/Last (0x31/0x3F)
+        self.jedec_id = None # set by open()
+        self.chip_name = None
+
+        self.spi_mode = SPI_BIT_ORDER_BIG # CH341SetStream mode, see open()
+        self._dual_buffers = (bytearray(), bytearray())
+
+        self.util = Util()
+        self.index = 0 # CH341 device index, set by open()
+        self.batch = SpiBatch(self.index)
+
+        # wait_ready() schedule and per-operation latency stats
+        self.typical_times = {"read": T_READ, "program": T_PROGRAM, "erase": T_ERASE}
+        self.wait_stats = {}
+        self._issued_at = 0.0
+
+        # Transient USB failures: retries per transaction and what they cost, see _recover()
+        self.retries = RETRIES
+        self.recovery_stats = {"errors": 0, "retries": 0, "recovered": 0, "failed": 0,
+                               "recovery_s": 0.0, "max_recovery_s": 0.0, "by_function": {}}
+
+        # Called with the page number after every page read or programmed; abort() from
+        # another thread stops the operation at the next page
+        self.progress = None
+        self.abort_event = threading.Event()
+        self._page_at = 0.0 # start of the page in progress, for the ch341_page_seconds metric
+
+        # Probe and page_time_ms calibration of each programmer, reused by open(), see probe();
+        # kept in the user cache directory, None keeps nothing
+        self.probe_file = os.path.join(_cache_dir(), "probe.json")
+        self.page_time_ms = None
+
+        # Optional read-through cache of raw pages, see enable_page_cache()
+        self.page_cache = None
+        self.is_open = False
+
+        # Bad block table, scanned on first use after open() by bad_block_table(); bbt_file
+        # (opt-in) keeps it on disk for a programmer that stays wired to one chip
+        self.bad_blocks = None
+        self.bbt_file = None
+
+        self.trace_level = TRACE_OFF
+        self.trace_callback = None
+        self._trace_start = 0
+        self._trace_command = None
+
+    def set_geometry(self, OOB_SIZE, PAGE_SIZE, BLOCK_SIZE, BLOCKS_COUNT):
 
         self.PAGE_SIZE = PAGE_SIZE
         self.BLOCK_SIZE = BLOCK_SIZE
@@ -222,7 +1415,56 @@ class Device:
         self.PAGES_PER_BLOCK = int(BLOCK_SIZE/PAGE_SIZE)
         self.CHIP_SIZE = BLOCK_SIZE * BLOCKS_COUNT
 
-        self.util = Util()
+    def apply_chip(self, chip):
+        """Take geometry, typical times and cache read support from a CHIPS entry."""
+        page_size = chip["page_size"] + chip["oob_size"]
+        self.set_geometry(chip["oob_size"], page_size, page_size * chip["pages_per_block"], chip["blocks"])
+        self.typical_times.update(read=chip["t_read"], program=chip["t_program"], erase=chip["t_erase"])
+        if not self.cache_read_given:
+            self.CACHE_READ = chip["cache_read"]
+        self.chip_name = chip["name"]
+
+    def set_trace(self, level=TRACE_TRANSACTIONS, callback=None):
+        """
+        Enable per-transaction tracing. Each SPI transaction (CS low to CS high) produces
+        an event dict with opcode, address, length (data phase bytes) and duration_ns;
+        TRACE_DATA adds head, tail and crc32 of the data phase. duration_ns is the time of
+        the USB call that carried the transaction, the same for all transactions SpiBatch
+        packs into one CH341WriteRead.
+        Events go to callback(event) when given, otherwise to the "ch341" logger at DEBUG level.
+        """
+        self.trace_level = level
+        self.trace_callback = callback
+
+    def _trace_begin(self, buffer, buffer_len):
+        self._trace_start = time.perf_counter_ns()
+        self._trace_command = bytes(buffer[:buffer_len])
+
+    def _trace_end(self, buffer_len, buffer, duration_ns=None):
+
+        command = self._trace_command or b''
+        self._trace_command = None
+
+        if self.trace_callback is None and not log.isEnabledFor(logging.DEBUG):
+            return
+
+        event = {
+            "opcode": command[0] if command else None,
+            "address": int.from_bytes(command[1:], 'big') if len(command) > 1 else None,
+            "length": buffer_len,
+            "duration_ns": time.perf_counter_ns() - self._trace_start if duration_ns is None else duration_ns,
+        }
+
+        if self.trace_level >= TRACE_DATA and buffer is not None:
+            data = buffer[:buffer_len]
+            event["head"] = self.byte_to_hex_string(data[0:10])
+            event["tail"] = self.byte_to_hex_string(data[-10:])
+            event["crc32"] = zlib.crc32(data)
+
+        if self.trace_callback is not None:
+            self.trace_callback(event)
+        else:
+            log.debug("SPI %s", " ".join(f"{k}={v}" for k, v in event.items()))
 
     def byte_to_hex_string(self, values):
         
@@ -232,15 +1474,12 @@ class Device:
         return hex_str
     
     def read_register_spi_25(self, register, operationCode=5):
-        self.write_spi_341(0, 0, 1, bytes([operationCode]))
-        return self.read_spi_341(1, 0, 1, register)
+        self.batch.add(bytes([operationCode]), read=1, into=register)
+        self.spi_execute()
+        return 1
 
     def is_spi_25_busy(self):
-
-        buffer = bytes([255])
-        self.read_register_spi_25(buffer, READ_STATUS_REG1);
-
-        return buffer[0] != 255
+        return bool(self.get_feature(FEATURE_STATUS) & STATUS_OIP)
         
     def unlock_spi_chip_25(self):
         
@@ -249,10 +1488,10 @@ class Device:
         self.IsRunning = True 
         self.enable_write();
         
-        self.write_spi_341(1, 0, 1, bytes([152]))
+        self.write_spi_341(1, self.index, 1, bytes([152]))
 
         print("Unlocking...")
-        self.is_spi_25_busy()
+        self.wait_ready("program")
         
         self.disable_write()
         self.stop_spi_mode_25()
@@ -261,18 +1500,54 @@ class Device:
         print("Chip is unlocked.")
         
 
+    def spi_command(self, *command):
+        self.batch.add(bytes(command))
+        self.spi_execute()
+        # Array operations start at CS high, wait_ready() counts their latency from here
+        self._issued_at = time.perf_counter()
+
+    def spi_execute(self, prepared=None):
+        """
+        Send the transactions queued on self.batch, or a batch made earlier with
+        SpiBatch.prepare(), tracing each of them when enabled.
+        Returns the data in phase of every transaction, see SpiBatch.execute().
+        """
+        if prepared is None:
+            prepared = self.batch.prepare()
+        if not self.trace_level:
+            return self.batch.send(prepared)
+
+        # Timed one USB call at a time: transactions packed into the same CH341WriteRead
+        # share its duration
+        transactions = iter(prepared[0])
+        results = []
+        for part in prepared[1]:
+            start = time.perf_counter_ns()
+            sent = self.batch.send((None, [part]))
+            duration_ns = time.perf_counter_ns() - start
+            # sent first: zip stops on it without taking the next part's transaction
+            for result, (command, write, read, into) in zip(sent, transactions):
+                self._trace_command = command
+                if read:
+                    self._trace_end(read, result, duration_ns)
+                else:
+                    self._trace_end(len(write or b''), write, duration_ns)
+            results += sent
+
+        return results
+
     def enable_write(self):
-        self.write_spi_341(1, 0, 1, bytes([WRITE_ENABLE]))
+        self.spi_command(WRITE_ENABLE)
 
     def disable_write(self):
-        self.write_spi_341(1, 0, 1, bytes([WRITE_DISABLE]))
+        self.spi_command(WRITE_DISABLE)
         
 
     def enable_4bit_mode(self):
-        self.write_spi_341(1, 0, 1, bytes([ENABLE_4BIT_MODE]))
+        self.spi_command(ENABLE_4BIT_MODE)
 
     def disable_4bit_mode(self):
-        self.write_spi_341(1, 0, 1, bytes([DISABLE_4BIT_MODE]))
+        self.spi_command(DISABLE_4BIT_MODE)
 
 
     def read_spi_chip_id_341(self):
@@ -306,10 +1581,10 @@ class Device:
         maf_id, dev_type, dev_cap = result[1], result[2], result[3]
 
         buffer = bytes([0x9F, 0])
-        self.write_spi_341(0, 0, 2, buffer)
+        self.write_spi_341(0, self.index, 2, buffer)
 
-        buffer = bytes([0]*3)
-        self.read_spi_341(1, 0, 3, buffer)
+        buffer = bytearray(3)
+        self.read_spi_341(1, self.index, 3, buffer)
         result = struct.unpack("3B", buffer)
 
         manufacturer_id = self.byte_to_hex_string([result[0]])
@@ -348,31 +1623,31 @@ class Device:
         Memory Density/Capacity (1 byte)
         '''
         buffer = bytes([0x9F])
-        self.write_spi_341(0, 0, 1, buffer);
-        buffer = bytes([0]*3)
-        self.read_spi_341(1, 0, 3, buffer);
+        self.write_spi_341(0, self.index, 1, buffer);
+        buffer = bytearray(3)
+        self.read_spi_341(1, self.index, 3, buffer);
         str_id[0] = struct.unpack("3B", buffer)
         
         #  Read Manufacturer ID and Device ID (Legacy)
         buffer = bytes([0x90, 0, 0, 0])
-        self.write_spi_341(0, 0, 4, buffer);
-        buffer = bytes([0, 0])
-        self.read_spi_341(1, 0, 2, buffer);
+        self.write_spi_341(0, self.index, 4, buffer);
+        buffer = bytearray(2)
+        self.read_spi_341(1, self.index, 2, buffer);
         str_id[1] = struct.unpack("BB", buffer)
         # print(buffer)
 
         # Read Manufacturer and Device ID (Alternate)
         buffer = bytes([0xAB, 0, 0, 0])
-        self.write_spi_341(0, 0, 4, buffer);
-        buffer = bytes([0])
-        self.read_spi_341(1, 0, 2, buffer);
+        self.write_spi_341(0, self.index, 4, buffer);
+        buffer = bytearray(1)
+        self.read_spi_341(1, self.index, 2, buffer);
         str_id[2] = struct.unpack("B", buffer)
         # print(buffer)
 
         buffer = bytes([0x15])
-        self.write_spi_341(0, 0, 1, buffer);
-        buffer = bytes([0, 0])
-        self.read_spi_341(1, 0, 2, buffer);
+        self.write_spi_341(0, self.index, 1, buffer);
+        buffer = bytearray(2)
+        self.read_spi_341(1, self.index, 2, buffer);
         str_id[3] = struct.unpack("BB", buffer)
         # print(buffer)
 
@@ -384,40 +1659,53 @@ class Device:
 
         # buffer_pointer = ctypes.cast(buffer, c_void_p)
         
+        if self.trace_level and self._trace_command is None:
+            self._trace_begin(b'', 0)
+
         CH341.setD5D0(index, 63, 0)
         CH341.streamSPI4(index, 0, buffer_len, buffer)
-        print(self.byte_to_hex_string(buffer[0:10]), self.byte_to_hex_string(buffer[-10:]), zlib.crc32(buffer))
-
 
         if value == 1:
             CH341.setD5D0(index, 63, 1)
 
+            if self.trace_level:
+                self._trace_end(buffer_len, buffer)
+
         return buffer_len
 
     def write_spi_341(self, value, index, buffer_len, buffer):
 
+        if self.trace_level and self._trace_command is None:
+            self._trace_begin(buffer, buffer_len)
+
         CH341.setD5D0(index, 41, 0)
         CH341.streamSPI4(index, 0, buffer_len, buffer)
         
         if value == 1:
             CH341.setD5D0(index, 41, 1)
+
+            if self.trace_level:
+                self._trace_end(0, None)
         
         return buffer_len
 
     def erase_spi_chip_25(self):
+        if self.page_cache is not None:
+            self.page_cache.clear()
         self.start_spi_mode_25()
         self.enable_write()
 
-        self.write_spi_341(1, 0, 1, bytes([0x62])) # ATMEL
-        self.write_spi_341(1, 0, 1, bytes([0x60])) # SST
-        self.write_spi_341(1, 0, 1, bytes([0xC7])) # STANDARD
+        self.write_spi_341(1, self.index, 1, bytes([0x62])) # ATMEL
+        self.write_spi_341(1, self.index, 1, bytes([0x60])) # SST
+        self.write_spi_341(1, self.index, 1, bytes([0xC7])) # STANDARD
 
-        while (self.is_spi_25_busy()):
-            pass
+        status = self.wait_ready("erase", timeout=CHIP_ERASE_TIMEOUT)
 
         self.disable_write()
         self.stop_spi_mode_25()
 
+        self.check_status(status, STATUS_E_FAIL, "Chip erase")
+
 
     def read_32bit_address_spi25_341(self, address, page_size, buffer):
 
@@ -438,13 +1726,11 @@ class Device:
         byte_3 = (address >> 8) & 0xFF   # Third byte
         byte_4 = address & 0xFF          # Least significant byte
         
-        print(f"Extracted bytes: {byte_1:02X} {byte_2:02X} {byte_3:02X} {byte_4:02X}")
         spi_write_buffer = bytes([READ_DATA, byte_1, byte_2, byte_3, byte_4])
 
-        self.write_spi_341(0, 0, 5, spi_write_buffer)
-
-        res = self.read_spi_341(1, 0, page_size, buffer)
-        return res
+        self.batch.add(spi_write_buffer, read=page_size, into=buffer)
+        self.spi_execute()
+        return page_size
 
     def read_16bit_address_spi25_341(self, address, page_size, buffer):
 
@@ -455,11 +1741,9 @@ class Device:
             address & 0x000000FF                          # Extract the least significant byte
         ])
     
-        self.write_spi_341(0, 0, len(spi_write_buffer), spi_write_buffer)
-
-        res = self.read_spi_341(1, 0, page_size, buffer)
-
-        return res
+        self.batch.add(spi_write_buffer, read=page_size, into=buffer)
+        self.spi_execute()
+        return page_size
 
     def write_32bit_address_spi25_341(self, address, page_size, buffer):
         # print(f"Writing {hex(address)} to {hex(address + page_size)}")
@@ -471,151 +1755,1090 @@ class Device:
             address & 0x000000FF                          # Extract the least significant byte
         ])
 
-        self.write_spi_341(0, 0, 5, spi_write_buffer)
-
-        res = self.read_spi_341(1, 0, page_size, buffer)
+        self.batch.add(spi_write_buffer, write=buffer[:page_size])
+        self.spi_execute()
 
-        CH341.setDelaymS(0, 2)
-        return res
+        CH341.setDelaymS(self.index, 2)
+        return page_size
 
 
     def stop_spi_mode_25(self):
         
-        CH341.setD5D0(0, 0, 0)
+        CH341.setD5D0(self.index, 0, 0)
 
     def start_spi_mode_25(self):
         
-        CH341.setStream(0, 0x80)
-        CH341.setDelaymS(0, 0x32)
+        CH341.setStream(self.index, self.spi_mode)
+        CH341.setDelaymS(self.index, 0x32)
 
         buffer = bytes([0xAB])
-        self.write_spi_341(1, 0, 1, buffer)
+        self.write_spi_341(1, self.index, 1, buffer)
 
-        CH341.setDelaymS(0, 2)
+        CH341.setDelaymS(self.index, 2)
 
 
-    def read_page(self, start_page=0, end_page=1, file='out.bin', verbouse=True):
-        
-        FLASH_SIZE_128BIT = 16777216;
-        bytesRead = 0
+    def read_into(self, buf, start_page=0, end_page=1, ecc=None):
+        """
+        Read pages [start_page, end_page) directly into buf, which can be any writable
+        buffer (bytearray, memoryview, mmap) of at least (end_page - start_page) * PAGE_SIZE bytes.
+        Each page ends up in its slice of buf, no per-page result is returned. Pages read
+        together with their status polls in one CH341WriteRead come back bit-reversed: the
+        answer is translated once into a new buffer and each page copied from it into buf.
+        Ranges of more than one page use the cache read pipeline when the chip supports it.
+        When ecc is given (a writable buffer of one byte per page), the ECC status of every
+        page (ECC_OK, ECC_CORRECTED, ECC_UNCORRECTABLE) is stored in it.
+        Returns the number of bytes read.
+        """
+        view = memoryview(buf).cast('B')
+        if len(view) < (end_page - start_page) * self.PAGE_SIZE:
+            raise ValueError(f"Buffer too small: {len(view)} bytes for {(end_page - start_page) * self.PAGE_SIZE} bytes")
+
+        self._page_at = time.perf_counter()
+        if self.page_cache is not None:
+            return self._read_into_through_cache(view, start_page, end_page, ecc)
+        return self._read_into_device(view, start_page, end_page, ecc)
+
+    def _read_into_device(self, view, start_page, end_page, ecc=None):
+
+        if self.CACHE_READ and end_page - start_page > 1:
+            return self._read_into_cached(view, start_page, end_page, ecc)
+
+        offset = 0
+        for page in range(start_page, end_page):
+            status = self._retry(self._read_page_into, page, view[offset:offset + self.PAGE_SIZE])
+            if ecc is not None:
+                ecc[page - start_page] = (status & STATUS_ECCS) >> 4
+            offset += self.PAGE_SIZE
+            self._page_done(page)
+
+        return offset
+
+    def _read_into_through_cache(self, view, start_page, end_page, ecc=None):
+
+        # Cached pages are copied out, every run of missing pages is read from the chip in
+        # one go (so it still uses the cache read pipeline) and then added to the cache
+        cache = self.page_cache
+        statuses = bytearray(end_page - start_page)
+        missing = []
+        for page in range(start_page, end_page):
+            entry = cache.get(page)
+            if entry is None:
+                missing.append(page)
+                continue
+            offset = (page - start_page) * self.PAGE_SIZE
+            statuses[page - start_page], view[offset:offset + self.PAGE_SIZE] = entry
+            self._page_done(page)
+
+        for _, run in itertools.groupby(enumerate(missing), lambda item: item[1] - item[0]):
+            run = [page for _, page in run]
+            first, last = run[0], run[-1] + 1
+            offset = (first - start_page) * self.PAGE_SIZE
+            pages = view[offset:offset + (last - first) * self.PAGE_SIZE]
+            self._read_into_device(pages, first, last, memoryview(statuses)[first - start_page:])
+            for page in run:
+                offset = (page - first) * self.PAGE_SIZE
+                cache.put(page, pages[offset:offset + self.PAGE_SIZE], statuses[page - start_page])
+
+        if ecc is not None:
+            ecc[:end_page - start_page] = statuses
+        return (end_page - start_page) * self.PAGE_SIZE
+
+    def enable_page_cache(self, max_bytes=64 * 1024 * 1024, directory=None):
+        """
+        Serve repeated reads of the same pages from a PageCache of up to max_bytes of pages
+        instead of the chip, optionally backed by directory. Returns the cache, whose
+        stats() report the hit rate. disable_page_cache() detaches it.
+        """
+        self.page_cache = PageCache(max_bytes, directory)
+        if self.is_open:
+            self._bind_page_cache()
+        return self.page_cache
+
+    def _bind_page_cache(self):
+        programmer = CH341.getDeviceName(self.index) or f"#{self.index}"
+        self.page_cache.bind(programmer, self.read_jedec_id())
+
+    def disable_page_cache(self):
+        self.page_cache = None
+
+    def _read_page_into(self, page, buffer):
+        self.page_read_to_cache(page)
+        # The page lands straight in its slice of the caller's buffer
+        return self.read_from_cache(buffer)
+
+    def _read_into_cached(self, view, start_page, end_page, ecc=None):
+
+        # After a failure the pipeline starts over at the page that didn't make it
+        page, failures = start_page, 0
+        while page < end_page:
+            try:
+                for status in self._cache_read(view[(page - start_page) * self.PAGE_SIZE:], page, end_page):
+                    if ecc is not None:
+                        ecc[page - start_page] = (status & STATUS_ECCS) >> 4
+                    page += 1
+                    if failures:
+                        self._recovered(failed_at)
+                        failures = 0
+                    self._page_done(page - 1)
+            except CH341Error as error:
+                failures += 1
+                if failures == 1:
+                    failed_at = time.perf_counter()
+                self._recover(error, failures)
+
+        return (end_page - start_page) * self.PAGE_SIZE
+
+    def _cache_read(self, view, start_page, end_page):
+
+        # Page Read Cache Sequential moves the loaded page to the data register and starts
+        # loading the next one into the cache, so the array read of page N+1 runs while
+        # page N is shifted out over USB. Yields the status of every page read.
+        self.page_read_to_cache(start_page)
+        command = bytes([READ_FROM_CACHE, 0, 0, 0])
+        ready = False
+
+        offset = 0
+        for page in range(start_page, end_page):
+            if not ready:
+                self.wait_ready()
+            self.spi_command(PAGE_READ_CACHE_SEQUENTIAL if page < end_page - 1 else PAGE_READ_CACHE_LAST)
+
+            if self.spi_mode & SPI_IO_DOUBLE:
+                status = self._read_from_cache_dual(view[offset:offset + self.PAGE_SIZE])
+                offset += self.PAGE_SIZE
+                yield status
+                continue
+
+            # Status before the data validates it, status after tells if the next page has
+            # already been loaded, which saves a separate poll before the next 0x31
+            while True:
+                self.batch.add(bytes([GET_FEATURE, FEATURE_STATUS]), read=1)
+                self.batch.add(command, read=self.PAGE_SIZE, into=view[offset:offset + self.PAGE_SIZE])
+                self.batch.add(bytes([GET_FEATURE, FEATURE_STATUS]), read=1)
+                before, _, after = self.spi_execute()
+                if not before[0] & STATUS_OIP:
+                    break
+                self.wait_ready("read")
+
+            ready = not after[0] & STATUS_OIP
+            offset += self.PAGE_SIZE
+            yield before[0]
+
+    def get_feature(self, address):
+        self.batch.add(bytes([GET_FEATURE, address]), read=1)
+        return self.spi_execute()[0][0]
+
+    def set_feature(self, address, value):
+        self.batch.add(bytes([SET_FEATURE, address, value]))
+        self.spi_execute()
+
+    def wait_ready(self, operation="read", timeout=POLL_TIMEOUT):
+        """
+        Wait until the operation in progress (OIP) is over and return the status register.
 
-        address = 0
-        iPageSize = self.PAGE_SIZE
-        iChipSize = self.CHIP_SIZE
+        Nothing is polled before the datasheet typical time of the operation (typical_times)
+        has passed since it was issued, after that the delay between polls starts at
+        POLL_INTERVAL and doubles up to a quarter of the typical time. Raises TimeoutError
+        when the chip is still busy after timeout seconds.
+        """
+        typical = self.typical_times.get(operation, T_READ)
+        deadline = self._issued_at + timeout
+        delay = self._issued_at + typical - time.perf_counter()
+        interval = POLL_INTERVAL
+        polls = 0
+
+        while True:
+            if delay >= POLL_SLEEP_MIN:
+                time.sleep(delay)
+
+            status = self.get_feature(FEATURE_STATUS)
+            polls += 1
+            if not status & STATUS_OIP:
+                self._record_wait(operation, polls)
+                return status
+
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"{operation} still in progress after {timeout} s (status 0x{status:02X})")
+
+            delay = interval
+            interval = min(interval * 2, max(typical / 4, POLL_INTERVAL))
+
+    def _record_wait(self, operation, polls, issued_at=None):
+        latency = time.perf_counter() - (self._issued_at if issued_at is None else issued_at)
+        stats = self.wait_stats.get(operation)
+        if stats is None:
+            stats = self.wait_stats[operation] = {"count": 0, "polls": 0, "total_s": 0.0, "min_s": latency, "max_s": latency}
+        stats["count"] += 1
+        stats["polls"] += polls
+        stats["total_s"] += latency
+        stats["min_s"] = min(stats["min_s"], latency)
+        stats["max_s"] = max(stats["max_s"], latency)
+        if metrics.enabled:
+            metrics.observe("ch341_busy_wait_seconds", latency, (("operation", operation),))
+            metrics.count("ch341_status_polls_total", polls, (("operation", operation),))
+
+    def latency_stats(self):
+        """
+        Per-operation ("read", "program", "erase") latency from issue to ready as seen by the
+        status polls: count, polls, total_s, min_s, max_s and mean_s.
+        """
+        return {operation: dict(stats, mean_s=stats["total_s"] / stats["count"])
+                for operation, stats in self.wait_stats.items()}
+
+    def _page_done(self, page):
+        if metrics.enabled:
+            now = time.perf_counter()
+            metrics.observe("ch341_page_seconds", now - self._page_at)
+            self._page_at = now
+        if self.abort_event.is_set():
+            self.abort_event.clear()
+            raise OperationAborted(f"Aborted after page {page}")
+        if self.progress is not None:
+            self.progress(page)
+
+    def abort(self):
+        """
+        Stop the operation running in another thread: it raises OperationAborted after the
+        current page. CH341AbortRead/CH341AbortWrite cut short a transfer in flight.
+        """
+        self.abort_event.set()
+        CH341.abortRead(self.index)
+        CH341.abortWrite(self.index)
+
+    def _retry(self, func, *args):
+        """Return func(*args), recovering the link and calling it again after transient CH341 failures."""
+        failures = 0
+        while True:
+            try:
+                result = func(*args)
+            except CH341Error as error:
+                failures += 1
+                if failures == 1:
+                    failed_at = time.perf_counter()
+                self._recover(error, failures)
+                continue
+
+            if failures:
+                self._recovered(failed_at)
+            return result
+
+    def _recover(self, error, failures):
+        """
+        Reset the USB pipes after a failed transfer so the transaction can be sent again.
+        Re-raises error when it isn't a transfer failure, the programmer is gone or the
+        retries are used up.
+        """
+        if self.abort_event.is_set():
+            # The transfer failed because it was aborted on purpose
+            self.abort_event.clear()
+            raise OperationAborted(str(error)) from error
+
+        stats = self.recovery_stats
+        stats["errors"] += 1
+        stats["by_function"][error.function] = stats["by_function"].get(error.function, 0) + 1
+
+        if failures > self.retries or error.function not in _TRANSFER_FUNCTIONS or not CH341.getVerIC(self.index):
+            stats["failed"] += 1
+            raise error
+
+        log.warning("%s, retrying (%d of %d)", error, failures, self.retries)
+        if metrics.enabled:
+            metrics.count("ch341_retries_total", 1, (("function", error.function),))
+        self.batch.clear()
+        for reset in (CH341.resetWrite, CH341.resetRead, CH341.flushBuffer):
+            try:
+                reset(self.index)
+            except CH341Error:
+                pass
+
+        time.sleep(RETRY_BACKOFF * 2 ** (failures - 1))
+
+        try:
+            # CS high ends the command that was cut off, then whatever array operation
+            # it may have started is let finish
+            CH341.setD5D0(self.index, 0x3F, 0x01)
+            self.wait_ready()
+        except CH341Error:
+            pass  # the retry fails again and is counted
+
+        stats["retries"] += 1
+
+    def _recovered(self, failed_at):
+        latency = time.perf_counter() - failed_at
+        stats = self.recovery_stats
+        stats["recovered"] += 1
+        stats["recovery_s"] += latency
+        stats["max_recovery_s"] = max(stats["max_recovery_s"], latency)
 
-        if start_page != None and end_page != None and end_page > 0:
-            address = start_page * self.PAGE_SIZE
-            iPageSize = self.PAGE_SIZE
-            iChipSize = end_page * self.PAGE_SIZE
+    @staticmethod
+    def check_status(status, fail_bit, operation):
+        if status & fail_bit:
+            raise RuntimeError(f"{operation} failed (status 0x{status:02X})")
 
-        
-        ms = BytesIO()
+    def page_read_to_cache(self, page):
+        self.spi_command(PAGE_READ, (page >> 16) & 0xFF, (page >> 8) & 0xFF, page & 0xFF)
 
+    def read_from_cache(self, buffer, column=0):
+        """
+        Read len(buffer) bytes of the cache register from column into buffer.
+        The status poll and the cache read go out in a single USB transaction; the read
+        is repeated if the chip turned out to be still busy when it was polled.
+        """
+        if self.spi_mode & SPI_IO_DOUBLE:
+            return self._read_from_cache_dual(buffer, column)
+
+        length = len(buffer)
+        command = bytes([READ_FROM_CACHE, (column >> 8) & 0xFF, column & 0xFF, 0])
+
+        waited = False
+        while True:
+            self.batch.add(bytes([GET_FEATURE, FEATURE_STATUS]), read=1)
+            self.batch.add(command, read=length, into=buffer)
+            status = self.spi_execute()[0][0]
+            if not status & STATUS_OIP:
+                if not waited:
+                    self._record_wait("read", 1)
+                return status
+            # Still loading: back off on the cheap status poll before reading the page again
+            self.wait_ready("read")
+            waited = True
+
+    def _read_from_cache_dual(self, buffer, column=0):
+
+        # Dual output can't share a USB transaction with the status poll, so wait first
+        status = self.wait_ready()
+
+        # Command, column and dummy byte are clocked out on DOUT (IO0) one bit per clock,
+        # then IO1/IO0 carry two data bits per clock into the two buffers.
+        length = len(buffer)
+        command = bytes([READ_FROM_CACHE_X2, (column >> 8) & 0xFF, column & 0xFF, 0])
+        total = len(command) + (length + 1) // 2
+
+        if len(self._dual_buffers[0]) != total:
+            self._dual_buffers = (bytearray(total), bytearray(total))
+        io1, io0 = self._dual_buffers
+        io1[:len(command)] = command
+        io1[len(command):] = b'\xff' * (total - len(command))
+        io0[:] = b'\xff' * total
+
+        if self.trace_level:
+            self._trace_begin(command, len(command))
+
+        CH341.streamSPI5(self.index, 0x80, total, io1, io0)
+        _merge_dual(memoryview(io1)[len(command):], memoryview(io0)[len(command):], memoryview(buffer).cast('B'))
+
+        if self.trace_level:
+            self._trace_end(length, buffer)
+
+        return status
 
-        if (self.CHIP_SIZE > FLASH_SIZE_128BIT):
-            self.enable_4bit_mode()
+    def read_page(self, start_page=0, end_page=1, file='out.bin', verbouse=True):
+
+        if start_page == None or end_page == None or end_page <= 0:
+            start_page, end_page = 0, self.CHIP_SIZE // self.PAGE_SIZE
 
         if verbouse:
             print(f"Reading from page {start_page} to {end_page}")
-            print(f"Reading time: {self.util.format_time(self.page_time_ms*(end_page - start_page))}")
+            # Measured page time once there are metrics, the open() calibration until then
+            page_s = metrics.mean("ch341_page_seconds") if metrics.enabled else None
+            page_time_ms = page_s * 1000 if page_s else self.page_time_ms
+            if page_time_ms is not None:
+                print(f"Reading time: {self.util.format_time(page_time_ms*(end_page - start_page))}")
 
-        while (address < iChipSize):
+        result = bytearray((end_page - start_page) * self.PAGE_SIZE)
 
-            buffer = bytes([0 for x in range(self.PAGE_SIZE)])
-            
-            if (iPageSize > iChipSize - address):
-                iPageSize = iChipSize - address
+        if file != None:
+            # Written as it is read, an interrupted read still leaves the pages read so far
+            with open(file, 'wb') as f:
+                bytesRead = 0
+                for _, chunk in self._read_chunks(start_page, end_page, view=memoryview(result)):
+                    self.util.write_chunk(f, chunk)
+                    bytesRead += len(chunk)
+        else:
+            bytesRead = self.read_into(result, start_page, end_page)
+
+        if verbouse: 
+            print(f"Total bytes read:", bytesRead, self.util.convert_size(bytesRead))
+            print(f"Total data bytes:", bytesRead - ((bytesRead//self.PAGE_SIZE)*self.PAGE_OOB_SIZE), self.util.convert_size(bytesRead - ((bytesRead//self.PAGE_SIZE)*self.PAGE_OOB_SIZE)))
+        return result
+
+    def _read_chunks(self, start_page, end_page, chunk_pages=None, view=None):
+        """
+        Read the range chunk_pages at a time (a block by default), yielding (first page, chunk).
+        Chunks are consecutive slices of view when given, otherwise they all share one buffer.
+        """
+        chunk_pages = chunk_pages or self.PAGES_PER_BLOCK
+        if view is None:
+            view = memoryview(bytearray(chunk_pages * self.PAGE_SIZE))
+            reuse = True
+        else:
+            reuse = False
+
+        for first in range(start_page, end_page, chunk_pages):
+            last = min(first + chunk_pages, end_page)
+            offset = 0 if reuse else (first - start_page) * self.PAGE_SIZE
+            chunk = view[offset:offset + (last - first) * self.PAGE_SIZE]
+            self.read_into(chunk, first, last)
+            yield first, chunk
+
+    def split_pages(self, buf):
+        """
+        Split whole raw pages (data area followed by OOB) into one contiguous data image and
+        one contiguous OOB image. Vectorized with numpy when it is installed, otherwise the
+        page slices are memoryviews joined in a single pass.
+        """
+        view = memoryview(buf).cast('B')
+        pages = len(view) // self.PAGE_SIZE
+        view = view[:pages * self.PAGE_SIZE]
+
+        numpy = _optional("numpy")
+        if numpy is not None:
+            array = numpy.frombuffer(view, numpy.uint8).reshape(pages, self.PAGE_SIZE)
+            return array[:, :self.PAGE_DATA_SIZE].tobytes(), array[:, self.PAGE_DATA_SIZE:].tobytes()
+
+        offsets = range(0, len(view), self.PAGE_SIZE)
+        data = b''.join([view[offset:offset + self.PAGE_DATA_SIZE] for offset in offsets])
+        oob = b''.join([view[offset + self.PAGE_DATA_SIZE:offset + self.PAGE_SIZE] for offset in offsets])
+        return data, oob
+
+    def read_split(self, start_page, end_page):
+        """
+        Read pages [start_page, end_page) and return (data, oob, ecc): the data areas and
+        the OOB areas as two separate images, and the ECC status of every page.
+        """
+        raw = bytearray((end_page - start_page) * self.PAGE_SIZE)
+        ecc = bytearray(end_page - start_page)
+        self.read_into(raw, start_page, end_page, ecc)
+        data, oob = self.split_pages(raw)
+        return data, oob, ecc
 
-            if (self.CHIP_SIZE > FLASH_SIZE_128BIT):
-                bytesRead += self.read_32bit_address_spi25_341(address, iPageSize, buffer)
+    def read_split_to_file(self, file, start_page=0, end_page=None, oob_file=None, chunk_pages=None):
+        """
+        Like read_to_file, but file only gets the data areas and oob_file (when given) the OOB
+        areas. Returns the ECC status of every page.
+        """
+        if end_page is None:
+            end_page = self.CHIP_SIZE // self.PAGE_SIZE
+        chunk_pages = chunk_pages or self.PAGES_PER_BLOCK
+
+        ecc = bytearray(end_page - start_page)
+        raw = memoryview(bytearray(chunk_pages * self.PAGE_SIZE))
+
+        with open(file, 'wb') as f, (open(oob_file, 'wb') if oob_file else contextlib.nullcontext()) as o:
+            for first in range(start_page, end_page, chunk_pages):
+                last = min(first + chunk_pages, end_page)
+                chunk = raw[:(last - first) * self.PAGE_SIZE]
+                self.read_into(chunk, first, last, memoryview(ecc)[first - start_page:last - start_page])
+                data, oob = self.split_pages(chunk)
+                self.util.write_chunk(f, data)
+                if o is not None:
+                    self.util.write_chunk(o, oob)
+
+        return ecc
+
+    def scan_bad_blocks(self, start_block=0, end_block=None):
+        """
+        Read only the bad block marker (first OOB byte of the first page) of every block
+        and return the numbers of the bad ones. The markers are kept in self.bbt_markers.
+        """
+        if end_block is None:
+            end_block = self.CHIP_SIZE // self.BLOCK_SIZE
+
+        markers = bytearray(end_block - start_block)
+        marker = memoryview(markers)
+        for block in range(start_block, end_block):
+            self._retry(self._read_marker, block, marker[block - start_block:block - start_block + 1])
+
+        self.bbt_markers = markers
+        # Any marker other than 0xFF is bad: find them all with one scan over the table
+        bad = markers.translate(bytes([1] * BAD_BLOCK_MARKER_OK + [0]))
+        return [start_block + i for i in _find_all(bad, 1)]
+
+    def _read_marker(self, block, buffer):
+        self.page_read_to_cache(block * self.PAGES_PER_BLOCK)
+        self.read_from_cache(buffer, column=self.PAGE_DATA_SIZE)
+
+    def read_jedec_id(self):
+        """Manufacturer and device ID (Read ID, 0x9F with a dummy byte) as a hex string."""
+        return self._retry(self._read_id).hex()
+
+    def _read_id(self):
+        # Queued again on every attempt, a retry of spi_execute alone would send an empty batch
+        self.batch.add(bytes([READ_ID, 0]), read=2)
+        return self.spi_execute()[0]
+
+    def bad_block_table(self, rescan=False):
+        """
+        Set of bad blocks, scanned with scan_bad_blocks() on the first call after open()
+        and kept until the next open() or rescan. Nothing tells two chips of the same type
+        apart, so a table is only reused across sessions when bbt_file is set: it is then
+        saved per programmer (device name), chip ID and block count, and taken as current
+        while the blocks it lists still read bad. Only set it for a programmer that stays
+        wired to the same chip.
+        """
+        if self.bad_blocks is not None and not rescan:
+            return self.bad_blocks
+
+        bad = None
+        if self.bbt_file:
+            chip_id = self.jedec_id or self.read_jedec_id()
+            programmer = CH341.getDeviceName(self.index) or f"#{self.index}"
+            blocks = self.CHIP_SIZE // self.BLOCK_SIZE
+            if not rescan:
+                bad = self.util.load_bbt(self.bbt_file, programmer, chip_id, blocks)
+
+        if bad is not None:
+            marker = bytearray(1)
+            for block in bad:
+                self._retry(self._read_marker, block, marker)
+                if marker[0] == BAD_BLOCK_MARKER_OK:
+                    bad = None
+                    break
+
+        if bad is None:
+            bad = set(self.scan_bad_blocks())
+            if self.bbt_file:
+                self.util.save_bbt(self.bbt_file, programmer, chip_id, blocks, bad)
+
+        self.bad_blocks = bad
+        return bad
+
+    def good_runs(self, start_page, pages=None):
+        """
+        Physical page ranges [first, last) holding pages logical pages from start_page on
+        (all of the good pages up to the end of the chip when pages is None), skipping bad
+        blocks the way the bootloader does: a bad block is passed over and the data
+        continues in the next good one.
+        """
+        bad = self.bad_block_table()
+        blocks = self.CHIP_SIZE // self.BLOCK_SIZE
+        runs = []
+        page = start_page
+        end_of_chip = pages is None
+        if end_of_chip:
+            pages = blocks * self.PAGES_PER_BLOCK - start_page
+
+        while pages > 0:
+            block = page // self.PAGES_PER_BLOCK
+            if block >= blocks:
+                if end_of_chip:
+                    break
+                raise ValueError(f"Not enough good blocks after page {start_page}")
+            if block in bad:
+                page = (block + 1) * self.PAGES_PER_BLOCK
+                continue
+
+            last = min((block + 1) * self.PAGES_PER_BLOCK, page + pages)
+            if runs and runs[-1][1] == page:
+                runs[-1] = (runs[-1][0], last)
             else:
-                bytesRead += self.read_16bit_address_spi25_341(address, iPageSize, buffer);
-            
-            ms.write(buffer)
-            address += iPageSize
+                runs.append((page, last))
+            pages -= last - page
+            page = last
 
-            del buffer
+        return runs
 
-            
+    def stream_read(self, start_page=0, end_page=None, chunk_pages=None):
+        """
+        Generator of (page_no, data, oob) for every page of the range, read chunk_pages
+        (a block by default) at a time into one reused buffer. data and oob are memoryviews
+        into that buffer, valid until the next chunk is read: copy them to keep them.
+        """
+        if end_page is None:
+            end_page = self.CHIP_SIZE // self.PAGE_SIZE
 
-        if (self.CHIP_SIZE > FLASH_SIZE_128BIT):
-            self.disable_4bit_mode()
+        for first, chunk in self._read_chunks(start_page, end_page, chunk_pages):
+            for offset in range(0, len(chunk), self.PAGE_SIZE):
+                page = chunk[offset:offset + self.PAGE_SIZE]
+                yield first + offset // self.PAGE_SIZE, page[:self.PAGE_DATA_SIZE], page[self.PAGE_DATA_SIZE:]
 
-        result = ms.getvalue()
-        ms.close()
+    def read_to_file(self, file, start_page=0, end_page=None, chunk_pages=None):
+        """
+        Dump the range (pages with their OOB) to file, a path or a binary file object,
+        chunk_pages at a time through one fixed buffer. Every chunk is flushed as soon as it
+        is read, so an interrupted dump leaves a file of whole pages from start_page on.
+        Returns the number of bytes written.
+        """
+        if end_page is None:
+            end_page = self.CHIP_SIZE // self.PAGE_SIZE
 
-        if file != None:
-            self.util.write_to(file, data=result)
-        if verbouse: 
-            print(f"Total bytes read:", bytesRead, self.util.convert_size(bytesRead))
-            print(f"Total data bytes:", bytesRead - ((bytesRead//self.PAGE_SIZE)*self.PAGE_OOB_SIZE), self.util.convert_size(bytesRead - ((bytesRead//self.PAGE_SIZE)*self.PAGE_OOB_SIZE)))
-        return result
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, 'wb') as f:
+                return self.read_to_file(f, start_page, end_page, chunk_pages)
 
-    def write_page(self, start_page=None, file=None, verify_write=True):
-        
-        FLASH_SIZE_128BIT = 16777216;
-        bytesWrite = 0
+        written = 0
+        for _, chunk in self._read_chunks(start_page, end_page, chunk_pages):
+            self.util.write_chunk(file, chunk)
+            written += len(chunk)
+        return written
 
-        if start_page == None or file == None:
-            raise ValueError("Did you forgot something?")
+    def verify(self, source, start_page=None, stop_on_mismatch=False):
+        """
+        Compare source (anything Util.iter_pages takes) with the flash from start_page on
+        (by default the start page of a DumpImage, otherwise 0), page by page as each block is read back, without holding either image. Stops at the
+        first differing page when stop_on_mismatch is set. Raises ValueError when source
+        is longer than the flash from start_page on.
+        Returns {page: number of flipped bits} for the pages that differ.
+        """
+        if start_page is None:
+            start_page = self.util.image_start(source) or 0
+
+        mismatched = {}
+        end_page = self.CHIP_SIZE // self.PAGE_SIZE
+        chunks = self._read_chunks(start_page, end_page)
+        first, chunk = start_page, b''
+
+        try:
+            for page, expected in enumerate(self.util.iter_pages(source, self.PAGE_SIZE), start_page):
+                if page >= end_page:
+                    raise ValueError("source extends past the end of the chip")
+                offset = (page - first) * self.PAGE_SIZE
+                if offset >= len(chunk):
+                    first, chunk = next(chunks)
+                    offset = 0
+                data = chunk[offset:offset + len(expected)]
+                if data != expected:
+                    mismatched[page] = bit_flips(data, expected)
+                    if stop_on_mismatch:
+                        break
+        finally:
+            chunks.close()
+
+        return mismatched
+
+    def verify_checksums(self, checksums, start_page=0, stop_on_mismatch=False):
+        """
+        Compare the flash from start_page on with page_checksum() values of the source pages,
+        for when only those were kept (see page_checksums()). Returns the differing pages.
+        """
+        mismatched = []
+        end_page = start_page + len(checksums)
+
+        for first, chunk in self._read_chunks(start_page, end_page):
+            for page in range(first, first + len(chunk) // self.PAGE_SIZE):
+                offset = (page - first) * self.PAGE_SIZE
+                if page_checksum(chunk[offset:offset + self.PAGE_SIZE]) != checksums[page - start_page]:
+                    mismatched.append(page)
+                    if stop_on_mismatch:
+                        return mismatched
+
+        return mismatched
+
+    def page_checksums(self, source):
+        """page_checksum() of every page of source (anything Util.iter_pages takes), padded with 0xFF."""
+        erased = b'\xff' * self.PAGE_SIZE
+        return [page_checksum(bytes(page) + erased[len(page):] if len(page) < self.PAGE_SIZE else page)
+                for page in self.util.iter_pages(source, self.PAGE_SIZE)]
+
+    def dump(self, file, start_block=0, end_block=None, journal=None):
+        """
+        Resumable dump of blocks [start_block, end_block) with their OOB to file.
+
+        Every block is written at its place in file and synced, then its CRC32 is appended to
+        the journal (file + ".journal" by default). Running the same dump again skips the
+        blocks the journal lists whose data in file still matches their CRC, so after an
+        interruption only the missing or damaged blocks are read from the chip.
+        Returns a dict with the number of blocks read and skipped.
+        """
+        if end_block is None:
+            end_block = self.CHIP_SIZE // self.BLOCK_SIZE
+        journal = journal or f"{file}.journal"
 
-        data_stream = BytesIO(self.util.read_from(file))
+        block_bytes = self.PAGES_PER_BLOCK * self.PAGE_SIZE
+        header = f"ch341 dump page_size={self.PAGE_SIZE} pages_per_block={self.PAGES_PER_BLOCK} start_block={start_block}"
+        done = self.util.load_journal(journal, header)
+        if not done:
+            with open(journal, 'w') as f:
+                f.write(header + '\n')
 
-        data_stream.seek(0, SEEK_END)
-        iDataSize = data_stream.tell()
-        data_stream.seek(0, SEEK_SET)
-            
-        address = start_page * self.PAGE_SIZE
-        iPageSize = self.PAGE_SIZE
-        iDataSize = address + iDataSize
+        buffer = memoryview(bytearray(block_bytes))
+        stats = {"read": 0, "skipped": 0}
+
+        with open(file, 'r+b' if os.path.exists(file) else 'w+b') as f, open(journal, 'a') as log_file:
+            for block in range(start_block, end_block):
+                offset = (block - start_block) * block_bytes
+
+                if block in done:
+                    f.seek(offset)
+                    if f.readinto(buffer) == block_bytes and zlib.crc32(buffer) == done[block]:
+                        stats["skipped"] += 1
+                        continue
+
+                first = block * self.PAGES_PER_BLOCK
+                self.read_into(buffer, first, first + self.PAGES_PER_BLOCK)
+                f.seek(offset)
+                self.util.write_chunk(f, buffer)
+                os.fsync(f.fileno())
+
+                log_file.write(f"{block:x} {zlib.crc32(buffer):08x}\n")
+                log_file.flush()
+                stats["read"] += 1
+
+            f.truncate((end_block - start_block) * block_bytes)
+
+        return stats
+
+    def dump_image(self, file, start_page=0, end_page=None, chunk_pages=DUMP_CHUNK_PAGES, level=6):
+        """
+        Read pages [start_page, end_page) into a DumpImage file: erased pages are left out
+        and the rest is zlib compressed chunk_pages at a time. Returns the number of pages,
+        elided pages and bytes written.
+        """
+        if end_page is None:
+            end_page = self.CHIP_SIZE // self.PAGE_SIZE
+
+        def pages():
+            for _, chunk in self._read_chunks(start_page, end_page):
+                yield from self.util.iter_pages(chunk, self.PAGE_SIZE)
 
-        if verify_write:
-            # print(f"reading from page {start_page} to {int(iDataSize/self.PAGE_SIZE)}")
-            before_write = self.read_page(start_page, int(iDataSize/self.PAGE_SIZE), None, False)
+        return DumpImage.write(file, pages(), self.PAGE_SIZE, self.PAGE_OOB_SIZE, self.PAGES_PER_BLOCK,
+                               self.CHIP_SIZE // self.BLOCK_SIZE, self.jedec_id, start_page, chunk_pages, level)
 
+    def write_page(self, start_page=None, file=None, verify_write=True, differential=False, manifest=None):
+        """
+        Write file (anything Util.iter_pages takes, padded to whole pages with 0xFF) from
+        start_page on, by default the start page of a DumpImage. Erased pages, such as the
+        ones a DumpImage elides, are not programmed. Only the blocks the range touches are erased, one at a time: erase,
+        program, then read back and verify against the data just programmed, block by block.
+        Nothing is read before writing except the pages of a partial first or last block
+        outside the range, which are programmed back. Blocks in the bad block table are
+        left alone, their part of file is skipped as in a raw dump of the chip.
+
+        Returns a dict with the number of programmed pages, erased blocks, the time spent
+        programming (program_s, the sustained program rate is programmed / program_s), the
+        list of pages that failed verification and their total number of flipped bits,
+        and the list of bad blocks skipped.
+        """
+        if start_page == None:
+            start_page = self.util.image_start(file)
+
+        if start_page == None or file == None:
+            raise ValueError("Did you forgot something?")
+
+        if differential:
+            stats = self.write_differential(start_page, file, manifest, verify_write)
+            print(f"Programmed {stats['programmed']} pages, skipped {stats['skipped']}, erased {stats['erased_blocks']} blocks")
+            if stats["mismatched"]:
+                print(f"Verify failed for {len(stats['mismatched'])} pages, {stats['bit_flips']} bits flipped")
+            return stats
+
+        stats = {"programmed": 0, "erased_blocks": 0, "program_s": 0.0, "mismatched": [], "bit_flips": 0,
+                 "bad_blocks": []}
+        bad = self.bad_block_table()
+
+        erased = b'\xff' * self.PAGE_SIZE
+        data = memoryview(bytearray(self.PAGES_PER_BLOCK * self.PAGE_SIZE))
+        readback = memoryview(bytearray(self.PAGES_PER_BLOCK * self.PAGE_SIZE)) if verify_write else None
+        pages = self.util.iter_pages(file, self.PAGE_SIZE)
+        page = start_page
+
+        print(f"Start writing from page {start_page}")
+
+        self.unlock()
+        while True:
+            first = page - page % self.PAGES_PER_BLOCK
+            start = page
+            for chunk in itertools.islice(pages, first + self.PAGES_PER_BLOCK - page):
+                offset = (page - first) * self.PAGE_SIZE
+                data[offset:offset + len(chunk)] = chunk
+                data[offset + len(chunk):offset + self.PAGE_SIZE] = erased[len(chunk):]
+                page += 1
+
+            if page == start:
+                break
+
+            if first // self.PAGES_PER_BLOCK in bad:
+                stats["bad_blocks"].append(first // self.PAGES_PER_BLOCK)
+            else:
+                self._write_block(first, start, page, data, readback, stats)
+
+            if page < first + self.PAGES_PER_BLOCK:
+                break
+
+        rate = stats["programmed"] / stats["program_s"] if stats["program_s"] else 0.0
+        print(f"Programmed {stats['programmed']} pages ({rate:.0f} pages/s), erased {stats['erased_blocks']} blocks")
+        if stats["bad_blocks"]:
+            print(f"Skipped bad blocks: {' '.join(map(str, stats['bad_blocks']))}")
+        if stats["mismatched"]:
+            print(f"Verify failed for {len(stats['mismatched'])} pages, {stats['bit_flips']} bits flipped")
+
+        return stats
+
+    def _write_block(self, first, start, end, data, readback, stats):
+
+        last = first + self.PAGES_PER_BLOCK
+        erased = b'\xff' * self.PAGE_SIZE
+
+        # Pages outside [start, end) are lost with the erase, keep their current contents
+        if start > first:
+            self.read_into(data, first, start)
+        if end < last:
+            self.read_into(data[(end - first) * self.PAGE_SIZE:], end, last)
+
+        self.erase_block(first // self.PAGES_PER_BLOCK)
+        stats["erased_blocks"] += 1
+
+        programmed = self.program_pages(
+            (page, data[offset:offset + self.PAGE_SIZE])
+            for page, offset in zip(range(first, last), range(0, len(data), self.PAGE_SIZE))
+            if data[offset:offset + self.PAGE_SIZE] != erased
+        )
+        stats["programmed"] += programmed["pages"]
+        stats["program_s"] += programmed["seconds"]
+
+        if readback is not None:
+            self.read_into(readback, first, last)
+            if readback != data:
+                for page in range(first, last):
+                    offset = (page - first) * self.PAGE_SIZE
+                    flipped = bit_flips(readback[offset:offset + self.PAGE_SIZE], data[offset:offset + self.PAGE_SIZE])
+                    if flipped:
+                        stats["mismatched"].append(page)
+                        stats["bit_flips"] += flipped
+
+    def program_page(self, page, data):
+        """Program Load data into the cache register, then Program Execute it into page."""
+        self._page_at = time.perf_counter()
+        if self.page_cache is not None:
+            self.page_cache.invalidate(page)
+        self._retry(self._program_page, page, data)
+        self._page_done(page)
+
+    def _program_page(self, page, data):
         self.enable_write()
+        self.batch.add(bytes([PROGRAM_LOAD, 0, 0]), write=data)
+        self.spi_execute()
+        self.spi_command(PROGRAM_EXECUTE, (page >> 16) & 0xFF, (page >> 8) & 0xFF, page & 0xFF)
+        self.check_status(self.wait_ready("program"), STATUS_P_FAIL, f"Program of page {page}")
 
-        if (self.CHIP_SIZE > FLASH_SIZE_128BIT):
-            self.enable_4bit_mode()
+    def program_pages(self, pages):
+        """
+        Program (page, data) pairs, pipelined. The status poll of the page being programmed,
+        Write Enable, Program Load and Program Execute of the next page go out in a single
+        USB transfer, encoded while the chip is still busy with the previous page. If the
+        poll still finds it busy, the chip has ignored the rest and it is sent again once
+        ready. Pages must be erased. Returns the number of pages, seconds and pages_per_sec.
+        """
+        previous = None
+        count = 0
+        t_start = self._page_at = time.perf_counter()
+
+        for page, data in pages:
+            if self.page_cache is not None:
+                self.page_cache.invalidate(page)
+            prepared = self._prepare_program(page, data, poll=previous is not None)
+            self._retry(self._program_next, previous, page, prepared)
+            if previous is not None:
+                self._page_done(previous)
+            previous = page
+            count += 1
+
+        if previous is not None:
+            self._retry(self._program_last, previous)
+            self._page_done(previous)
+
+        seconds = time.perf_counter() - t_start
+        return {"pages": count, "seconds": seconds, "pages_per_sec": count / seconds if seconds else 0.0}
+
+    def _prepare_program(self, page, data, poll):
+        if poll:
+            self.batch.add(bytes([GET_FEATURE, FEATURE_STATUS]), read=1)
+        # One extra clock byte on each transaction lets them share a CH341WriteRead. The chip
+        # ignores it after a command, and clocks in 0xFF past the data, which Program Load
+        # has already filled the rest of the cache with.
+        self.batch.add(bytes([WRITE_ENABLE]), read=1)
+        self.batch.add(bytes([PROGRAM_LOAD, 0, 0]), write=data, read=1)
+        self.batch.add(bytes([PROGRAM_EXECUTE, (page >> 16) & 0xFF, (page >> 8) & 0xFF, page & 0xFF]), read=1)
+        return self.batch.prepare()
+
+    def _program_next(self, previous, page, prepared):
+
+        if previous is None:
+            self.spi_execute(prepared)
+            self._issued_at = time.perf_counter()
+            return
+
+        issued_at = self._issued_at
+        delay = issued_at + self.typical_times["program"] - time.perf_counter()
+        if delay >= POLL_SLEEP_MIN:
+            time.sleep(delay)
+
+        status = self.spi_execute(prepared)[0][0]
+        if status & STATUS_OIP:
+            # Still busy, so the chip ignored the rest: wait, then send it all again
+            self._issued_at = issued_at
+            self.check_status(self.wait_ready("program"), STATUS_P_FAIL, f"Program of page {previous}")
+            self.spi_execute(prepared)
+        else:
+            self._record_wait("program", 1, issued_at)
+            self.check_status(status, STATUS_P_FAIL, f"Program of page {previous}")
+        self._issued_at = time.perf_counter()
 
-        print(f"Start writing {iDataSize-address} bytes from address {address}")
+    def _program_last(self, page):
+        self.check_status(self.wait_ready("program"), STATUS_P_FAIL, f"Program of page {page}")
 
-        while (address < iDataSize):
-            
-            if (iPageSize > iDataSize - address):
-                iPageSize = iDataSize - address
+    def erase_block(self, block):
+        if self.page_cache is not None:
+            self.page_cache.invalidate(block * self.PAGES_PER_BLOCK, (block + 1) * self.PAGES_PER_BLOCK)
+        self._retry(self._erase_block, block)
 
-            buffer = data_stream.read(iPageSize)
+    def _erase_block(self, block):
+        page = block * self.PAGES_PER_BLOCK
+        self.enable_write()
+        self.spi_command(BLOCK_ERASE, (page >> 16) & 0xFF, (page >> 8) & 0xFF, page & 0xFF)
+        self.check_status(self.wait_ready("erase"), STATUS_E_FAIL, f"Erase of block {block}")
 
-            if (self.CHIP_SIZE > FLASH_SIZE_128BIT):
-                bytesWrite += self.write_32bit_address_spi25_341(address, iPageSize, buffer)
-            
-            while (self.is_spi_25_busy()):
-                print(self.is_spi_25_busy())
-                time.sleep(0.5)
-            
+    def unlock(self):
+        """Clear the block protection bits, set on every power-up."""
+        self._retry(self.set_feature, FEATURE_PROTECTION, 0)
 
-            address += iPageSize
-            # print(f"Wrote {bytesWrite} bytes. Current address {address}")
+    def page_digests(self, start_page, end_page):
+        """Digest of every page in the range, read one block at a time."""
+        buffer = bytearray(self.PAGES_PER_BLOCK * self.PAGE_SIZE)
+        view = memoryview(buffer)
+        digests = {}
 
-        if (self.CHIP_SIZE > FLASH_SIZE_128BIT):
-            self.disable_4bit_mode()
+        for first in range(start_page, end_page, self.PAGES_PER_BLOCK):
+            last = min(first + self.PAGES_PER_BLOCK, end_page)
+            self.read_into(buffer, first, last)
+            for page in range(first, last):
+                offset = (page - first) * self.PAGE_SIZE
+                digests[page] = page_digest(view[offset:offset + self.PAGE_SIZE])
 
+        return digests
 
-        print(f"Total bytes write:", bytesWrite)
-        self.disable_write()
+    def plan_write(self, start_page, source, current):
+        """
+        Work out what writing the source page digests (page -> digest, from start_page on)
+        over the current flash contents (page -> digest for every page of the blocks
+        touched) takes. Returns a list of (block, erase, pages to program), only for
+        blocks with changes.
+
+        Pages already holding their new content are skipped. A changed page that is still
+        erased is just programmed; anything else needs the block erased, after which every
+        page of the block that isn't meant to stay erased is programmed again, including
+        pages outside the written range.
+        """
+        erased = page_digest(b'\xff' * self.PAGE_SIZE)
+        plan = []
 
-        if verify_write:
-            # print(f"reading from page {start_page} to {int(iDataSize/self.PAGE_SIZE)}")
-            after_write = self.read_page(start_page, int(iDataSize/self.PAGE_SIZE), None, False)
+        first_block = start_page // self.PAGES_PER_BLOCK
+        last_block = (start_page + len(source) - 1) // self.PAGES_PER_BLOCK
 
-            if before_write != after_write:
-                print("Something changed")
+        for block in range(first_block, last_block + 1):
+            pages = range(block * self.PAGES_PER_BLOCK, (block + 1) * self.PAGES_PER_BLOCK)
+            target = {page: source.get(page, current[page]) for page in pages}
+            changed = [page for page in pages if target[page] != current[page]]
+
+            if not changed:
+                continue
+
+            if all(current[page] == erased for page in changed):
+                plan.append((block, False, changed))
             else:
-                print("Nothing changed")
+                plan.append((block, True, [page for page in pages if target[page] != erased]))
 
-        return
+        return plan
 
+    def write_differential(self, start_page, source, manifest=None, verify_write=True):
+        """
+        Program only the pages of source (starting at start_page, padded to whole pages with
+        0xFF) that differ from the flash, erasing only the blocks that can't be programmed
+        over. source is anything Util.iter_pages takes and is consumed one block at a time.
+        The current contents come from manifest (a file written by the previous
+        write_differential) when it has them, otherwise they are read from the chip.
+        A manifest saved for another programmer (device name) or chip ID is ignored; it is
+        only valid as long as the chip isn't written by anything else or swapped for
+        another of the same type. Bad blocks are left alone as in write_page(). With verify_write, the pages programmed
+        are read back and compared, pages that fail are left out of the manifest.
+
+        Returns a dict with the number of programmed and skipped pages, erased blocks, the
+        list of bad blocks skipped, the list of pages that failed verification and their
+        total number of flipped bits.
+        """
+        if manifest:
+            # Only trusted for the programmer and chip it was written for
+            programmer = CH341.getDeviceName(self.index) or f"#{self.index}"
+            chip_id = self.jedec_id or self.read_jedec_id()
+            known = self.util.load_manifest(manifest, self.PAGE_SIZE, programmer, chip_id)
+        else:
+            known = None
+        stats = {"programmed": 0, "skipped": 0, "erased_blocks": 0, "bad_blocks": [], "mismatched": [], "bit_flips": 0}
+        readback = memoryview(bytearray(self.PAGES_PER_BLOCK * self.PAGE_SIZE)) if verify_write else None
+        bad = self.bad_block_table()
+
+        erased = b'\xff' * self.PAGE_SIZE
+        data = memoryview(bytearray(self.PAGES_PER_BLOCK * self.PAGE_SIZE))
+        pages = self.util.iter_pages(source, self.PAGE_SIZE)
+        page = start_page
+
+        self.unlock()
+        while True:
+            first = page - page % self.PAGES_PER_BLOCK
+            digests = {}
+            for chunk in itertools.islice(pages, first + self.PAGES_PER_BLOCK - page):
+                offset = (page - first) * self.PAGE_SIZE
+                data[offset:offset + len(chunk)] = chunk
+                data[offset + len(chunk):offset + self.PAGE_SIZE] = erased[len(chunk):]
+                digests[page] = page_digest(data[offset:offset + self.PAGE_SIZE])
+                page += 1
+
+            if not digests:
+                break
+
+            if first // self.PAGES_PER_BLOCK in bad:
+                stats["bad_blocks"].append(first // self.PAGES_PER_BLOCK)
+                stats["skipped"] += len(digests)
+            else:
+                self._write_block_differential(first, digests, data, known, stats, readback)
+
+            if page < first + self.PAGES_PER_BLOCK:
+                break
+
+        if manifest:
+            self.util.save_manifest(manifest, self.PAGE_SIZE, known, programmer, chip_id)
+
+        return stats
+
+    def _write_block_differential(self, first, source, data, known, stats, readback=None):
+
+        current = {page: known[page] for page in range(first, first + self.PAGES_PER_BLOCK) if page in (known or ())}
+        if len(current) < self.PAGES_PER_BLOCK:
+            current = self.page_digests(first, first + self.PAGES_PER_BLOCK)
+
+        programmed = 0
+        for block, erase, pages in self.plan_write(min(source), source, current):
+            kept = {}
+            if erase:
+                # Pages outside the written range are lost with the block, keep them
+                kept = {page: bytes(self.read_page(page, page + 1, None, False))
+                        for page in pages if page not in source}
+                self.erase_block(block)
+                stats["erased_blocks"] += 1
+
+            expected = {page: kept[page] if page in kept else data[(page - first) * self.PAGE_SIZE:(page - first + 1) * self.PAGE_SIZE]
+                        for page in pages}
+            self.program_pages(expected.items())
+            programmed += len(pages) - len(kept)
+
+            if readback is not None and pages:
+                self.read_into(readback, first, first + self.PAGES_PER_BLOCK)
+                for page in pages:
+                    offset = (page - first) * self.PAGE_SIZE
+                    flipped = bit_flips(readback[offset:offset + self.PAGE_SIZE], expected[page])
+                    if flipped:
+                        stats["mismatched"].append(page)
+                        stats["bit_flips"] += flipped
+
+        stats["programmed"] += programmed
+        stats["skipped"] += len(source) - programmed
+
+        if known is not None:
+            known.update(current)
+            known.update(source)
+            # What failed to verify is unknown, the next write reads it from the chip
+            for page in stats["mismatched"]:
+                known.pop(page, None)
 
     def read_bytes(self, from_offset, to_offset, exclude_oob=True, out=None):
 
@@ -627,9 +2850,24 @@ class Device:
             start_page = from_offset // self.PAGE_SIZE
             end_page = (from_offset + to_offset) // self.PAGE_SIZE
 
-        return self.read_page(start_page, end_page, out)
+        # Bad blocks inside the range are skipped, the data continues in the next good block
+        raw = bytearray((end_page - start_page) * self.PAGE_SIZE)
+        ecc = bytearray(end_page - start_page)
+        offset = 0
+        for first, last in self.good_runs(start_page, end_page - start_page):
+            self.read_into(memoryview(raw)[offset * self.PAGE_SIZE:], first, last, memoryview(ecc)[offset:])
+            offset += last - first
+
+        if ECC_UNCORRECTABLE in ecc:
+            log.warning("uncorrectable ECC errors in %d pages", ecc.count(ECC_UNCORRECTABLE))
+
+        # Data areas only: the OOB is dropped without a per-page copy loop
+        data = self.split_pages(raw)[0] if exclude_oob else raw
+        if out:
+            self.util.write_to(out, data)
+        return data
 
-    def write_bytes(self, from_offset, file=None, exclude_oob=True):
+    def write_bytes(self, from_offset, file=None, exclude_oob=True, differential=False, manifest=None):
 
         start_page, end_page = None, None
         if exclude_oob:
@@ -637,66 +2875,104 @@ class Device:
         else:
             start_page = from_offset // self.PAGE_SIZE
 
-        return self.write_page(start_page, file)
+        if file is None:
+            raise ValueError("Did you forgot something?")
+
+        # Written around bad blocks, one write_page per run of good blocks
+        if exclude_oob:
+            pages = self._data_pages(file)
+        else:
+            pages = self.util.iter_pages(file, self.PAGE_SIZE)
+        result = None
+        for first, last in self.good_runs(start_page):
+            head = next(pages, None)
+            if head is None:
+                break
+            run = itertools.chain([head], itertools.islice(pages, last - first - 1))
+            stats = self.write_page(first, run, differential=differential, manifest=manifest)
+            if result is None:
+                result = stats
+            else:
+                for key in result:
+                    result[key] += stats[key]
+
+        if next(pages, None) is not None:
+            raise ValueError(f"Not enough good blocks after page {start_page}")
+        return result
+
 
+    def _data_pages(self, source):
+        # Data areas (as read_bytes returns them) made into raw pages with an erased OOB,
+        # the data of the last page padded with 0xFF
+        page = bytearray(b'\xff' * self.PAGE_SIZE)
+        for data in self.util.iter_pages(source, self.PAGE_DATA_SIZE):
+            page[:len(data)] = data
+            page[len(data):] = b'\xff' * (self.PAGE_SIZE - len(data))
+            yield page
 
     def read_flash_bytes(self):
 
         buffer = bytes([32, 00, 00, 00, 00])
-        self.write_spi_341(0, 0, 5, buffer);
+        self.write_spi_341(0, self.index, 5, buffer);
 
-        buffer = bytes([0]*2112)
-        self.read_spi_341(1, 0, 2112, buffer);
+        buffer = bytearray(2112)
+        self.read_spi_341(1, self.index, 2112, buffer);
 
         print(self.byte_to_hex_string(buffer[0:10]), self.byte_to_hex_string(buffer[-10:]), zlib.crc32(buffer))
 
         buffer = bytes([32, 00, 00, 0x08, 0x40])
-        self.write_spi_341(0, 0, 5, buffer);
+        self.write_spi_341(0, self.index, 5, buffer);
 
-        buffer = bytes([0]*2112)
-        self.read_spi_341(1, 0, 2112, buffer);
+        buffer = bytearray(2112)
+        self.read_spi_341(1, self.index, 2112, buffer);
 
         print(self.byte_to_hex_string(buffer[0:10]), self.byte_to_hex_string(buffer[-10:]), zlib.crc32(buffer))
 
 
 
-    def open(self, i_index, speed=SPEED_HIGH, spi_io=SPI_IO_SINGLE, spi_bit_order=SPI_BIT_ORDER_BIG):
+    def open(self, i_index, speed=SPEED_HIGH, spi_io=SPI_IO_SINGLE, spi_bit_order=SPI_BIT_ORDER_BIG, probe=True):
+        """
+        Open programmer i_index and set up its SPI stream. With probe, the chip is identified
+        and page reads are timed (see probe()); without it the geometry given to Device()
+        is used as it is and nothing is sent to the chip.
+        """
+
+        if spi_io & SPI_IO_DOUBLE and not getattr(_dll(), "supports_dual_io", True):
+            raise ValueError("This backend can't do dual I/O, open the device with SPI_IO_SINGLE")
 
         print("="*35)
-        print(f"Chip size :", self.CHIP_SIZE, f"{int(self.CHIP_SIZE/1024/1024)}MBit")
-        print(f"Block size:", self.BLOCK_SIZE, f"({self.PAGES_PER_BLOCK} pages)")
-        print(f"Page size :", self.PAGE_SIZE, f"({self.PAGE_DATA_SIZE} + {self.PAGE_OOB_SIZE})")
-        print("-"*35)
 
-        if CH341DLL.CH341OpenDevice(c_uint(i_index)) > 0:
+        if CH341.openDevice(i_index):
 
-            if not CH341DLL.CH341SetExclusive(c_uint(i_index), c_uint(1)):
-                raise RuntimeError("CH341SetExclusive")
+            self.index = self.batch.index = i_index
+            self.is_open = True
+            CH341.setExclusive(i_index, 1)
+            # Another chip may be in the socket now
+            self.bad_blocks = None
 
-            CH341ChipVer = CH341DLL.CH341GetVerIC(c_uint(i_index))
+            CH341ChipVer = CH341.getVerIC(i_index)
             CH341SPIBit = False
 
             if CH341ChipVer >= 48:
                 CH341SPIBit = True
 
-                CH341.setStream(i_index, 129)
+                self.spi_mode = speed | spi_io | spi_bit_order
+                CH341.setStream(i_index, self.spi_mode)
                 CH341.setD5D0(i_index, 63, 0)
                 CH341.setDelaymS(i_index, 4)
 
-                # ptr = CH341DLL.CH341GetDeviceName(c_ulong(i_index))
-                # device_name = cast(ptr, c_char_p).value
-                # print("Dev Name: ", device_name.decode('utf-8'))
-
-                print(f"DLL Version: {CH341DLL.CH341GetVersion()}")
-                print(f"Driver Version: {CH341DLL.CH341GetDrvVersion()}")
-                self.read_spi_chip_id_341()
+                # Before the probe, whose calibration read would go through the cache
+                if self.page_cache is not None:
+                    self._bind_page_cache()
+                cached = self.probe() if probe else None
 
-                t_start = time.time_ns()
-                self.read_page(0, 10, None, False)
-                t_end = time.time_ns()
-                elapsed_time_ns = t_end - t_start
-                self.page_time_ms = (elapsed_time_ns / 1e6)/10
-                print(f"Page time: {self.page_time_ms:.1f} ms")
+                if probe:
+                    print(f"Chip      : {self.chip_name or 'unknown'} ({self.jedec_id})")
+                print(f"Chip size :", self.CHIP_SIZE, f"{int(self.CHIP_SIZE/1024/1024)}MBit")
+                print(f"Block size:", self.BLOCK_SIZE, f"({self.PAGES_PER_BLOCK} pages)")
+                print(f"Page size :", self.PAGE_SIZE, f"({self.PAGE_DATA_SIZE} + {self.PAGE_OOB_SIZE})")
+                if probe:
+                    print(f"Page time: {self.page_time_ms:.1f} ms" + (" (cached)" if cached else ""))
 
                 print("-"*35)
                 
@@ -704,9 +2980,48 @@ class Device:
         else:
             raise RuntimeError("Failed to open the device.")
 
+    def probe(self):
+        """
+        Read the JEDEC ID, take geometry and timing from CHIPS unless they were given to
+        Device(), and calibrate page_time_ms by timing a 10 page read. The calibration is
+        saved in probe_file per programmer (device name) and reused while the chip ID and
+        SPI mode are the same, which is what makes reopening a known device quick.
+        Returns True when the calibration came from probe_file.
+        """
+        self.jedec_id = self.read_jedec_id()
+        chip = CHIPS.get(self.jedec_id)
+        if chip is not None and not self.geometry_given:
+            self.apply_chip(chip)
+        elif chip is not None:
+            self.chip_name = chip["name"]
+
+        programmer = CH341.getDeviceName(self.index) or f"#{self.index}"
+        probe = self.util.load_probe(self.probe_file, programmer) if self.probe_file else None
+        if probe and probe.get("jedec_id") == self.jedec_id and probe.get("spi_mode") == self.spi_mode:
+            self.page_time_ms = probe["page_time_ms"]
+            return True
+
+        print(f"DLL Version: {CH341.getVersion()}")
+        print(f"Driver Version: {CH341.getDrvVersion()}")
+
+        t_start = time.time_ns()
+        self.read_page(0, 10, None, False)
+        t_end = time.time_ns()
+        elapsed_time_ns = t_end - t_start
+        self.page_time_ms = (elapsed_time_ns / 1e6)/10
+
+        if self.probe_file:
+            self.util.save_probe(self.probe_file, programmer, {
+                "jedec_id": self.jedec_id,
+                "spi_mode": self.spi_mode,
+                "page_time_ms": self.page_time_ms,
+            })
+        return False
+
     def close(self):
         print("-"*35)
-        CH341DLL.CH341CloseDevice(c_uint(0))
+        self.is_open = False
+        CH341.closeDevice(self.index)
         print("Device disconnected")
 
     """
@@ -722,29 +3037,136 @@ class Device:
     Basically, for the MiniProgrammer this is the only bit you have to configure, therefore iMode can be 0x80 or 0x00.
     """
 
-        
-device = Device(BLOCKS_COUNT=1024)
-device.open(0, spi_io=SPI_IO_DOUBLE)
-
-MemSize = 134217728
-
-# device.start_spi_mode_25()
-# device.read_spi_chip_id_341()
-# device.unlock_spi_chip_25()
-
-
-device.read_flash_bytes()
-
-# device.write_page(0, 'out.bin')
-# device.read_page(0, 2, None)
 
-# device.start_spi_mode_25()
-# device.read_bytes(0, 1024*128, True, 'zloader')
-# device.read_bytes(1024*128, 1024*1024, True, 'uboot')
-# device.read_bytes(1024*128 + 1024*1024, 1024*1024, True, 'uboot_mirr')
-
-# device.write_bytes(1024*128, 'uboot')
-
-# data = device.read_page(0, 1, None)
-# print(data, len(data))
-device.close()
+def cli(argv=None):
+    """
+    Command line front-end, see python -m main --help.
+
+        python -m main id
+        python -m main read dump.bin --start 0 --end 64
+        python -m main write uboot.bin --start 64 --differential --manifest uboot.manifest
+        python -m main verify uboot.bin --start 64
+        python -m main erase --start 1 --end 9
+        python -m main bbt
+
+    Passing any of the geometry options skips the chip probe and calibration on open.
+    Returns the exit status: 0, 1 when verify finds differences, 2 when the arguments don't
+    fit the chip (e.g. a file running past its end).
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m main", description="SPI-NAND flash through a CH341 programmer")
+    parser.add_argument("--backend", help="dll, libusb or sim (default: $CH341_BACKEND, then by platform)")
+    parser.add_argument("--index", type=int, default=0, help="CH341 device index")
+    parser.add_argument("--dual", action="store_true", help="read with dual I/O (0x3B); slower on the CH341, which needs an extra status poll per page")
+    parser.add_argument("--bbt-file", help="keep the bad block table in this file, for a programmer wired to one chip")
+    geometry = parser.add_argument_group("geometry (skips probing when any is given)")
+    geometry.add_argument("--page-size", type=int, help="data bytes per page")
+    geometry.add_argument("--oob-size", type=int, help="OOB bytes per page")
+    geometry.add_argument("--pages-per-block", type=int)
+    geometry.add_argument("--blocks", type=int)
+
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("id", help="print the JEDEC ID and geometry")
+
+    read = commands.add_parser("read", help="dump pages with their OOB to a file")
+    read.add_argument("file")
+    read.add_argument("--start", type=int, default=0, help="first page")
+    read.add_argument("--end", type=int, help="page after the last one (default: end of chip)")
+    read.add_argument("--oob", help="write the data areas to file and the OOB areas to this file")
+    read.add_argument("--image", action="store_true", help="write a compressed dump image, erased pages left out")
+
+    write = commands.add_parser("write", help="write a raw image (pages with OOB)")
+    write.add_argument("file")
+    write.add_argument("--start", type=int, help="first page (default: 0, or where a dump image starts)")
+    write.add_argument("--differential", action="store_true", help="only program the pages that differ")
+    write.add_argument("--manifest", help="page digests of the last differential write")
+    write.add_argument("--no-verify", action="store_true")
+
+    verify = commands.add_parser("verify", help="compare the flash with a raw image")
+    verify.add_argument("file")
+    verify.add_argument("--start", type=int, help="first page (default: 0, or where a dump image starts)")
+    verify.add_argument("--first", action="store_true", help="stop at the first difference")
+
+    erase = commands.add_parser("erase", help="erase blocks, bad blocks are left alone")
+    erase.add_argument("--start", type=int, default=0, help="first block")
+    erase.add_argument("--end", type=int, help="block after the last one (default: end of chip)")
+
+    bbt = commands.add_parser("bbt", help="print the bad block table")
+    bbt.add_argument("--rescan", action="store_true", help="scan the markers even if --bbt-file has a table")
+
+    args = parser.parse_args(argv)
+
+    if args.backend:
+        load_backend(args.backend)
+
+    sizes = (args.page_size, args.oob_size, args.pages_per_block, args.blocks)
+    if any(size is not None for size in sizes):
+        chip = CHIPS[DEFAULT_CHIP]
+        page_size, oob_size, pages_per_block, blocks = (
+            chip[key] if size is None else size
+            for key, size in zip(("page_size", "oob_size", "pages_per_block", "blocks"), sizes)
+        )
+        device = Device(OOB_SIZE=oob_size, PAGE_SIZE=page_size + oob_size,
+                        BLOCK_SIZE=(page_size + oob_size) * pages_per_block, BLOCKS_COUNT=blocks)
+    else:
+        device = Device()
+
+    device.bbt_file = args.bbt_file
+    device.open(args.index, spi_io=SPI_IO_DOUBLE if args.dual else SPI_IO_SINGLE, probe=not device.geometry_given)
+    status = 0
+    try:
+        if args.command == "id":
+            jedec_id = device.jedec_id or device.read_jedec_id()
+            print(f"JEDEC ID: {jedec_id} ({CHIPS.get(jedec_id, {}).get('name', 'unknown')})")
+            print(f"Geometry: {device.PAGE_DATA_SIZE}+{device.PAGE_OOB_SIZE} bytes/page, "
+                  f"{device.PAGES_PER_BLOCK} pages/block, {device.CHIP_SIZE // device.BLOCK_SIZE} blocks")
+
+        elif args.command == "read":
+            if args.image:
+                stats = device.dump_image(args.file, args.start, args.end)
+                print(f"{stats['pages']} pages, {stats['elided']} erased, {device.util.convert_size(stats['bytes'])}")
+            elif args.oob:
+                device.read_split_to_file(args.file, args.start, args.end, args.oob)
+            else:
+                device.read_to_file(args.file, args.start, args.end)
+
+        elif args.command == "write":
+            start = args.start if args.start is not None else device.util.image_start(args.file) or 0
+            stats = device.write_page(start, args.file, verify_write=not args.no_verify,
+                                      differential=args.differential, manifest=args.manifest)
+            if stats.get("mismatched"):
+                status = 1
+
+        elif args.command == "verify":
+            mismatched = device.verify(args.file, args.start, args.first)
+            for page, flipped in mismatched.items():
+                print(f"page {page}: {flipped} bits differ")
+            print(f"{len(mismatched)} pages differ" if mismatched else "Flash matches")
+            status = 1 if mismatched else 0
+
+        elif args.command == "erase":
+            end = device.CHIP_SIZE // device.BLOCK_SIZE if args.end is None else args.end
+            bad = device.bad_block_table()
+            device.unlock()
+            for block in range(args.start, end):
+                if block not in bad:
+                    device.erase_block(block)
+            print(f"Erased {sum(block not in bad for block in range(args.start, end))} blocks")
+
+        elif args.command == "bbt":
+            bad = sorted(device.bad_block_table(rescan=args.rescan))
+            print(f"{len(bad)} bad blocks" + (": " + " ".join(map(str, bad)) if bad else ""))
+
+    except ValueError as error:
+        print(f"error: {error}", file=sys.stderr)
+        status = 2
+    finally:
+        device.close()
+
+    return status
+
+
+if __name__ == "__main__":
+
+    sys.exit(cli())
@@ -0,0 +1,591 @@
+"""
+In-process model of a CH341 programmer with a DS35M1GA SPI-NAND on its SPI bus.
+
+SimulatedCH341 exposes the same functions as CH341.DLL, so it can be bound with
+main.load_backend("sim") (or load_backend(SimulatedCH341(...))) and the whole
+Device read/write path runs on machines without a programmer attached.
+
+Only the SPI side of the CH341 is modeled: D0 is chip select (driven through
+CH341Set_D5_D0 or the iChipSelect argument of CH341StreamSPI4), every byte that
+is clocked out on DOUT is fed to the NAND and the bytes it answers on DIN are
+written back into the caller's buffer. Buffers that can't be written (bytes)
+are treated as output-only, exactly like a read-only page would be.
+"""
+import random
+import time
+
+# SPI-NAND command set (DS35M1GA datasheet)
+NAND_RESET = 0xFF
+NAND_GET_FEATURE = 0x0F
+NAND_SET_FEATURE = 0x1F
+NAND_READ_ID = 0x9F
+NAND_PAGE_READ = 0x13
+NAND_PAGE_READ_CACHE_SEQUENTIAL = 0x31
+NAND_PAGE_READ_CACHE_LAST = 0x3F
+NAND_READ_CACHE = 0x03
+NAND_READ_CACHE_FAST = 0x0B
+NAND_READ_CACHE_X2 = 0x3B
+NAND_READ_CACHE_X4 = 0x6B
+NAND_WRITE_ENABLE = 0x06
+NAND_WRITE_DISABLE = 0x04
+NAND_PROGRAM_LOAD = 0x02
+NAND_PROGRAM_LOAD_X4 = 0x32
+NAND_PROGRAM_LOAD_RANDOM = 0x84
+NAND_PROGRAM_LOAD_RANDOM_X4 = 0x34
+NAND_PROGRAM_EXECUTE = 0x10
+NAND_BLOCK_ERASE = 0xD8
+
+# Feature registers
+FEATURE_PROTECTION = 0xA0
+FEATURE_CONFIG = 0xB0
+FEATURE_STATUS = 0xC0
+
+# Status register bits
+STATUS_OIP = 0x01
+STATUS_WEL = 0x02
+STATUS_E_FAIL = 0x04
+STATUS_P_FAIL = 0x08
+STATUS_ECCS = 0x30
+
+# Number of bytes (opcode included) before the data phase starts
+_HEADER_LEN = {
+    NAND_GET_FEATURE: 2,
+    NAND_SET_FEATURE: 2,
+    NAND_READ_ID: 2,
+    NAND_PAGE_READ: 4,
+    NAND_READ_CACHE: 4,
+    NAND_READ_CACHE_FAST: 4,
+    NAND_READ_CACHE_X2: 4,
+    NAND_READ_CACHE_X4: 4,
+    NAND_PROGRAM_LOAD: 3,
+    NAND_PROGRAM_LOAD_X4: 3,
+    NAND_PROGRAM_LOAD_RANDOM: 3,
+    NAND_PROGRAM_LOAD_RANDOM_X4: 3,
+    NAND_PROGRAM_EXECUTE: 4,
+    NAND_BLOCK_ERASE: 4,
+}
+
+# CH341A command stream (CH341DLL.H)
+mCH341_PACKET_LENGTH = 32
+mCH341A_CMD_SPI_STREAM = 0xA8
+mCH341A_CMD_I2C_STREAM = 0xAA
+mCH341A_CMD_UIO_STREAM = 0xAB
+mCH341A_CMD_UIO_STM_IN = 0x00
+mCH341A_CMD_UIO_STM_DIR = 0x40
+mCH341A_CMD_UIO_STM_OUT = 0x80
+mCH341A_CMD_UIO_STM_US = 0xC0
+mCH341A_CMD_UIO_STM_END = 0x20
+
+# Raw stream bytes go out LSB first
+_REVERSE_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+_READ_CACHE_OPS = (NAND_READ_CACHE, NAND_READ_CACHE_FAST, NAND_READ_CACHE_X2, NAND_READ_CACHE_X4)
+_PROGRAM_LOAD_OPS = (NAND_PROGRAM_LOAD, NAND_PROGRAM_LOAD_X4, NAND_PROGRAM_LOAD_RANDOM, NAND_PROGRAM_LOAD_RANDOM_X4)
+
+
+# Dual I/O: IO1 carries bits 7,5,3,1 and IO0 bits 6,4,2,0 of every byte, each line packs
+# the four bits of two consecutive bytes into one buffer byte (first byte in the high nibble)
+_IO1_BITS = bytes(sum(((i >> (7 - 2 * k)) & 1) << (3 - k) for k in range(4)) for i in range(256))
+_IO0_BITS = bytes(sum(((i >> (6 - 2 * k)) & 1) << (3 - k) for k in range(4)) for i in range(256))
+
+
+def _view(buffer, length):
+    return memoryview(buffer).cast('B')[:length]
+
+
+class SimulatedNand:
+    """
+    DS35M1GA-like SPI-NAND: 1024 blocks of 64 pages of 2048 + 64 bytes by default.
+
+    Pages are stored sparsely, an absent page reads back as erased (0xFF).
+    bad_blocks get a factory bad-block marker (0x00) in the first OOB byte of their
+    first page. Blocks start locked (protection register 0x38) as on power-up.
+    cache_read enables Page Read Cache Sequential/Last (0x31/0x3F): the page in the cache
+    register moves to the data register read by Read From Cache while the next one loads.
+
+    Array operations keep OIP set in the status register for their datasheet time (seconds,
+    wall clock); commands other than Get Feature and Reset are ignored while it is set.
+    store=False drops programmed data, for writing large images without keeping them in memory.
+    """
+
+    def __init__(self, page_size=2048+64, oob_size=64, block_size=135168, blocks_count=1024,
+                 jedec_id=(0xE5, 0x21), bad_blocks=(), locked=True, cache_read=False,
+                 t_rd=25e-6, t_rcbsy=5e-6, t_prog=300e-6, t_bers=3e-3, store=True):
+
+        self.page_size = page_size
+        self.oob_size = oob_size
+        self.data_size = page_size - oob_size
+        self.pages_per_block = block_size // page_size
+        self.blocks_count = blocks_count
+        self.pages_count = self.pages_per_block * blocks_count
+        self.jedec_id = bytes(jedec_id)
+        self.cache_read = cache_read
+        self.t_rd = t_rd
+        self.t_rcbsy = t_rcbsy
+        self.t_prog = t_prog
+        self.t_bers = t_bers
+        self.store = store
+
+        self.pages = {}
+        self.cache = bytearray(b'\xff' * page_size)
+        self.features = {
+            FEATURE_PROTECTION: 0x38 if locked else 0x00,
+            FEATURE_CONFIG: 0x10,  # ECC_EN
+            FEATURE_STATUS: 0x00,
+        }
+        self.ecc_status = {}
+        self.bad_blocks = set(bad_blocks)
+
+        for block in self.bad_blocks:
+            page = bytearray(b'\xff' * page_size)
+            page[self.data_size] = 0x00
+            self.pages[block * self.pages_per_block] = page
+
+        self._header = bytearray()
+        self._column = 0
+        self._cache_row = 0
+        self._busy_until = 0.0
+        self._array_ready_at = 0.0
+
+    @property
+    def busy(self):
+        return time.perf_counter() < self._busy_until
+
+    @property
+    def status(self):
+        return self.features[FEATURE_STATUS] | (STATUS_OIP if self.busy else 0)
+
+    def feature(self, address):
+        if address == FEATURE_STATUS:
+            return self.status
+        return self.features.get(address, 0)
+
+    def _start(self, duration, not_before=0.0):
+        start = max(time.perf_counter(), not_before)
+        self._busy_until = start + duration
+        return self._busy_until
+
+    def _set_status(self, mask, value):
+        status = self.features[FEATURE_STATUS] & ~mask
+        self.features[FEATURE_STATUS] = status | (value & mask)
+
+    def _row(self):
+        return ((self._header[1] << 16) | (self._header[2] << 8) | self._header[3]) % self.pages_count
+
+    def page(self, page_no):
+        return bytes(self.pages.get(page_no, b'\xff' * self.page_size))
+
+    def select(self):
+        self._header = bytearray()
+        self._column = 0
+
+    def deselect(self):
+
+        if not self._header:
+            return
+
+        op = self._header[0]
+        if len(self._header) < _HEADER_LEN.get(op, 1):
+            return  # aborted command
+
+        if self.busy and op not in (NAND_GET_FEATURE, NAND_RESET):
+            return
+
+        if op == NAND_WRITE_ENABLE:
+            self._set_status(STATUS_WEL, STATUS_WEL)
+        elif op == NAND_WRITE_DISABLE:
+            self._set_status(STATUS_WEL, 0)
+        elif op == NAND_RESET:
+            self._set_status(STATUS_OIP | STATUS_WEL | STATUS_E_FAIL | STATUS_P_FAIL, 0)
+            self._busy_until = self._array_ready_at = 0.0
+        elif op == NAND_PAGE_READ:
+            self._cache_row = self._row()
+            self._load(self._cache_row)
+            self._array_ready_at = self._start(self.t_rd)
+        elif op == NAND_PAGE_READ_CACHE_SEQUENTIAL and self.cache_read:
+            # Waits for the previous array read, then the next one runs in the background
+            self._load(self._cache_row)
+            self._cache_row = (self._cache_row + 1) % self.pages_count
+            self._array_ready_at = self._start(self.t_rcbsy, self._array_ready_at) + self.t_rd
+        elif op == NAND_PAGE_READ_CACHE_LAST and self.cache_read:
+            self._load(self._cache_row)
+            self._start(self.t_rcbsy, self._array_ready_at)
+        elif op == NAND_PROGRAM_EXECUTE:
+            self._program(self._row())
+        elif op == NAND_BLOCK_ERASE:
+            self._erase(self._row() // self.pages_per_block)
+
+    def _load(self, row):
+        self.cache[:] = self.pages.get(row, b'\xff' * self.page_size)
+        self._set_status(STATUS_ECCS, self.ecc_status.get(row, 0) << 4)
+
+    def _locked(self):
+        return self.features[FEATURE_PROTECTION] & 0x38
+
+    def _program(self, row):
+
+        if not self.status & STATUS_WEL:
+            return
+
+        if self._locked() or row // self.pages_per_block in self.bad_blocks:
+            self._set_status(STATUS_P_FAIL | STATUS_WEL, STATUS_P_FAIL)
+            return
+
+        page = self.pages.get(row)
+        if not self.store:
+            pass  # programmed data is dropped, the page keeps reading back erased
+        elif page is None:
+            self.pages[row] = bytearray(self.cache)
+        else:
+            # Programming can only clear bits
+            value = int.from_bytes(page, 'big') & int.from_bytes(self.cache, 'big')
+            page[:] = value.to_bytes(self.page_size, 'big')
+
+        self._set_status(STATUS_P_FAIL | STATUS_WEL, 0)
+        self._start(self.t_prog)
+
+    def _erase(self, block):
+
+        if not self.status & STATUS_WEL:
+            return
+
+        if self._locked() or block in self.bad_blocks:
+            self._set_status(STATUS_E_FAIL | STATUS_WEL, STATUS_E_FAIL)
+            return
+
+        first = block * self.pages_per_block
+        for page_no in range(first, first + self.pages_per_block):
+            self.pages.pop(page_no, None)
+            self.ecc_status.pop(page_no, None)
+
+        self._set_status(STATUS_E_FAIL | STATUS_WEL, 0)
+        self._start(self.t_bers)
+
+    def transfer(self, mosi, miso=None):
+        """
+        Clock len(mosi) bytes through the chip while it is selected.
+        The bytes driven on DIN are written into miso when it is given.
+        """
+        length = len(mosi)
+        pos = 0
+
+        while pos < length and (not self._header or len(self._header) < _HEADER_LEN.get(self._header[0], 1)):
+            self._header.append(mosi[pos])
+            if miso is not None:
+                miso[pos] = 0xFF
+            pos += 1
+
+            if len(self._header) == _HEADER_LEN.get(self._header[0], 1):
+                if self._header[0] in _READ_CACHE_OPS or self._header[0] in _PROGRAM_LOAD_OPS:
+                    self._column = ((self._header[1] << 8) | self._header[2]) & 0x0FFF
+                if self._header[0] in (NAND_PROGRAM_LOAD, NAND_PROGRAM_LOAD_X4) and not self.busy:
+                    self.cache[:] = b'\xff' * self.page_size
+
+        if pos == length:
+            return
+
+        op = self._header[0]
+        count = length - pos
+
+        if op in _READ_CACHE_OPS:
+            if miso is not None:
+                data = self.cache[self._column:self._column + count]
+                miso[pos:pos + len(data)] = data
+                miso[pos + len(data):length] = b'\xff' * (count - len(data))
+            self._column += count
+
+        elif op in _PROGRAM_LOAD_OPS:
+            # Ignored while an array operation is in progress, like any command but Get Feature.
+            # Bytes past the end of the cache are dropped.
+            if not self.busy:
+                data = mosi[pos:pos + max(0, min(count, self.page_size - self._column))]
+                self.cache[self._column:self._column + len(data)] = data
+            self._column += count
+            if miso is not None:
+                miso[pos:length] = b'\xff' * count
+
+        elif op == NAND_GET_FEATURE:
+            if miso is not None:
+                miso[pos:length] = bytes([self.feature(self._header[1])]) * count
+
+        elif op == NAND_SET_FEATURE:
+            if self._header[1] in (FEATURE_PROTECTION, FEATURE_CONFIG) and self._column == 0:
+                self.features[self._header[1]] = mosi[pos]
+            self._column += count
+            if miso is not None:
+                miso[pos:length] = b'\xff' * count
+
+        elif op == NAND_READ_ID:
+            if miso is not None:
+                for i in range(count):
+                    miso[pos + i] = self.jedec_id[(self._column + i) % len(self.jedec_id)]
+            self._column += count
+
+        elif miso is not None:
+            miso[pos:length] = b'\xff' * count
+
+
+class SimulatedCH341:
+    """
+    CH341.DLL look-alike driving one SimulatedNand per device index.
+
+    calls counts the API calls issued per function name, usb_calls the ones that
+    would cause a USB transaction on a real programmer. usb_latency (seconds) is
+    spent on each of those to model the USB round trip time, and with spi_clock (Hz)
+    set, every SPI clock of a transfer takes 1 / spi_clock as well. link_s adds up the
+    modeled USB and SPI time.
+    error_rate is the probability of a data transfer (CH341StreamSPI4/5, CH341WriteRead)
+    failing before anything reaches the chip, as a flaky USB link would; errors counts them.
+    """
+
+    def __init__(self, chips=None, ic_version=0x30, usb_latency=0.0, error_rate=0.0, seed=None, spi_clock=None):
+
+        if chips is None:
+            chips = [SimulatedNand()]
+
+        self.chips = list(chips)
+        self.ic_version = ic_version
+
+        self.opened = [False] * len(self.chips)
+        self.modes = [0] * len(self.chips)
+        self.pins = [(0, 0)] * len(self.chips)
+
+        self.calls = {}
+        self.usb_calls = 0
+        self.usb_latency = usb_latency
+        self.spi_clock = spi_clock
+        self.link_s = 0.0
+
+        self.error_rate = error_rate
+        self.errors = 0
+        self._random = random.Random(seed)
+
+    def _fails(self):
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def _count(self, name, usb=True):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if usb:
+            self.usb_calls += 1
+            if self.usb_latency:
+                self.link_s += self.usb_latency
+                time.sleep(self.usb_latency)
+
+    def _clock(self, clocks):
+        if self.spi_clock:
+            self.link_s += clocks / self.spi_clock
+            time.sleep(clocks / self.spi_clock)
+
+    def _valid(self, iIndex):
+        return 0 <= iIndex < len(self.chips) and self.opened[iIndex]
+
+    def _selected(self, iIndex):
+        direction, data = self.pins[iIndex]
+        return bool(direction & 1) and not data & 1
+
+    def CH341OpenDevice(self, iIndex):
+        self._count("CH341OpenDevice")
+        if not 0 <= iIndex < len(self.chips):
+            return -1
+        self.opened[iIndex] = True
+        return iIndex + 1
+
+    def CH341CloseDevice(self, iIndex):
+        self._count("CH341CloseDevice")
+        if 0 <= iIndex < len(self.chips):
+            self.opened[iIndex] = False
+
+    def CH341GetDeviceName(self, iIndex):
+        self._count("CH341GetDeviceName", usb=False)
+        return f"sim:{iIndex}".encode() if 0 <= iIndex < len(self.chips) else None
+
+    def CH341GetVersion(self):
+        self._count("CH341GetVersion", usb=False)
+        return 0x22
+
+    def CH341GetDrvVersion(self):
+        self._count("CH341GetDrvVersion", usb=False)
+        return 0x30
+
+    def CH341GetVerIC(self, iIndex):
+        self._count("CH341GetVerIC")
+        return self.ic_version if self._valid(iIndex) else 0
+
+    def CH341SetExclusive(self, iIndex, iExclusive):
+        self._count("CH341SetExclusive", usb=False)
+        return self._valid(iIndex)
+
+    def CH341SetStream(self, iIndex, iMode):
+        self._count("CH341SetStream")
+        if not self._valid(iIndex):
+            return False
+        self.modes[iIndex] = iMode
+        return True
+
+    def CH341SetDelaymS(self, iIndex, iDelay):
+        self._count("CH341SetDelaymS")
+        return self._valid(iIndex)
+
+    def CH341Set_D5_D0(self, iIndex, iSetDirOut, iSetDataOut):
+        self._count("CH341Set_D5_D0")
+        if not self._valid(iIndex):
+            return False
+
+        self._set_pins(iIndex, iSetDirOut, iSetDataOut)
+        return True
+
+    def _set_pins(self, iIndex, direction, data):
+
+        was_selected = self._selected(iIndex)
+        self.pins[iIndex] = (direction & 0x3F, data & 0x3F)
+        selected = self._selected(iIndex)
+
+        if selected and not was_selected:
+            self.chips[iIndex].select()
+        elif was_selected and not selected:
+            self.chips[iIndex].deselect()
+
+    def CH341StreamSPI4(self, iIndex, iChipSelect, iLength, ioBuffer):
+        self._count("CH341StreamSPI4")
+        if not self._valid(iIndex) or self._fails():
+            return False
+        self._clock(iLength * 8)
+
+        view = _view(ioBuffer, iLength)
+        miso = None if view.readonly else view
+        mosi = bytes(view)
+        chip = self.chips[iIndex]
+
+        if iChipSelect & 0x80:
+            # Only D0 is wired to the flash chip
+            if iChipSelect & 0x03 == 0:
+                chip.select()
+                chip.transfer(mosi, miso)
+                chip.deselect()
+            elif miso is not None:
+                miso[:] = b'\xff' * iLength
+        elif self._selected(iIndex):
+            chip.transfer(mosi, miso)
+        elif miso is not None:
+            miso[:] = b'\xff' * iLength
+
+        return True
+
+    def CH341StreamSPI5(self, iIndex, iChipSelect, iLength, ioBuffer, ioBuffer2):
+        self._count("CH341StreamSPI5")
+        if not self._valid(iIndex) or self._fails():
+            return False
+        self._clock(iLength * 8)
+
+        io1 = _view(ioBuffer, iLength)
+        io0 = _view(ioBuffer2, iLength)
+        chip = self.chips[iIndex]
+
+        if iChipSelect & 0x80:
+            if iChipSelect & 0x03 != 0:
+                io1[:] = b'\xff' * iLength
+                io0[:] = b'\xff' * iLength
+                return True
+            chip.select()
+        elif not self._selected(iIndex):
+            io1[:] = b'\xff' * iLength
+            io0[:] = b'\xff' * iLength
+            return True
+
+        # Opcode, address and dummy bytes are single line on DOUT, only the data in phase
+        # of Read From Cache x2 uses both lines
+        header = min(iLength, _HEADER_LEN.get(io1[0], 1))
+        mosi = bytes(io1)
+        chip.transfer(mosi[:header], io1[:header])
+        io0[:header] = b'\xff' * header
+
+        if chip._header and chip._header[0] == NAND_READ_CACHE_X2:
+            count = iLength - header
+            data = bytearray(2 * count)
+            chip.transfer(b'\xff' * len(data), data)
+            high, low = data[0::2], data[1::2]
+            io1[header:] = bytes(h << 4 | l for h, l in zip(high.translate(_IO1_BITS), low.translate(_IO1_BITS)))
+            io0[header:] = bytes(h << 4 | l for h, l in zip(high.translate(_IO0_BITS), low.translate(_IO0_BITS)))
+        else:
+            chip.transfer(mosi[header:], io1[header:])
+            io0[header:] = b'\xff' * (iLength - header)
+
+        if iChipSelect & 0x80:
+            chip.deselect()
+
+        return True
+
+    def CH341ResetRead(self, iIndex):
+        self._count("CH341ResetRead")
+        return self._valid(iIndex)
+
+    def CH341ResetWrite(self, iIndex):
+        self._count("CH341ResetWrite")
+        return self._valid(iIndex)
+
+    def CH341FlushBuffer(self, iIndex):
+        self._count("CH341FlushBuffer")
+        return self._valid(iIndex)
+
+    def CH341AbortRead(self, iIndex):
+        self._count("CH341AbortRead", usb=False)
+        return self._valid(iIndex)
+
+    def CH341AbortWrite(self, iIndex):
+        self._count("CH341AbortWrite", usb=False)
+        return self._valid(iIndex)
+
+    def CH341WriteRead(self, iIndex, iWriteLength, iWriteBuffer, iReadStep, iReadTimes, oReadLength, oReadBuffer):
+        """
+        Runs a raw CH341A command stream: UIO packets drive D5-D0 (and so CS), SPI stream
+        packets are clocked through the chip. oReadLength is a ctypes byref() to a c_ulong.
+        """
+        self._count("CH341WriteRead")
+        if not self._valid(iIndex) or self._fails():
+            return False
+
+        stream = bytes(_view(iWriteBuffer, iWriteLength))
+        answer = bytearray()
+        chip = self.chips[iIndex]
+
+        offset = 0
+        while offset < len(stream):
+            packet = stream[offset:offset + mCH341_PACKET_LENGTH]
+
+            if packet[0] == mCH341A_CMD_SPI_STREAM:
+                # Consecutive SPI packets are one uninterrupted run of clocks
+                end = offset
+                while end < len(stream) and stream[end] == mCH341A_CMD_SPI_STREAM:
+                    end += mCH341_PACKET_LENGTH
+                mosi = b''.join(stream[start + 1:start + mCH341_PACKET_LENGTH]
+                                for start in range(offset, end, mCH341_PACKET_LENGTH)).translate(_REVERSE_BITS)
+                miso = bytearray(b'\xff' * len(mosi))
+                self._clock(len(mosi) * 8)
+                if self._selected(iIndex):
+                    chip.transfer(mosi, miso)
+                answer += miso.translate(_REVERSE_BITS)
+                offset = end
+                continue
+
+            if packet[0] == mCH341A_CMD_UIO_STREAM:
+                for command in packet[1:]:
+                    if command == mCH341A_CMD_UIO_STM_END:
+                        break
+                    direction, data = self.pins[iIndex]
+                    kind = command & 0xC0
+                    if kind == mCH341A_CMD_UIO_STM_OUT:
+                        self._set_pins(iIndex, direction, command)
+                    elif kind == mCH341A_CMD_UIO_STM_DIR:
+                        self._set_pins(iIndex, command, data)
+                    elif kind == mCH341A_CMD_UIO_STM_IN:
+                        answer.append(data)
+
+            offset += mCH341_PACKET_LENGTH
+
+        length = min(len(answer), iReadStep * iReadTimes)
+        _view(oReadBuffer, length)[:] = answer[:length]
+        oReadLength._obj.value = length
+        return True
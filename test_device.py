@@ -0,0 +1,447 @@
+"""
+Read/write paths of Device against the simulated programmer, no hardware needed.
+
+    python -m pytest -q
+"""
+import os
+import time
+
+import pytest
+
+import main
+from simulator import SimulatedCH341, SimulatedNand
+
+
+def open_device(sim):
+    main.load_backend(sim)
+    device = main.Device()
+    device.probe_file = None
+    device.open(0)
+    return device
+
+
+@pytest.fixture
+def device(tmp_path, monkeypatch):
+    # Anything the device writes relative to the working directory ends up in tmp_path
+    monkeypatch.chdir(tmp_path)
+    device = open_device(SimulatedCH341([SimulatedNand(locked=False)]))
+    yield device
+    device.close()
+
+
+def pattern(pages, page_size, oob=True):
+    """Distinct non-erased pages, the OOB left 0xFF so no page looks like a bad block marker."""
+    data_size = page_size - 64
+    page_data = [bytes((page * 7 + i) & 0xFF for i in range(data_size)) for page in range(pages)]
+    if not oob:
+        return b''.join(page_data)
+    return b''.join(data + b'\xff' * 64 for data in page_data)
+
+
+def test_write_page_read_back(device, tmp_path):
+    image = pattern(70, device.PAGE_SIZE)
+    path = tmp_path / "image.bin"
+    path.write_bytes(image)
+
+    stats = device.write_page(60, str(path))
+
+    assert stats["mismatched"] == []
+    assert stats["erased_blocks"] == 3
+    assert device.read_page(60, 130, None, False) == image
+
+
+def test_write_page_keeps_rest_of_partial_blocks(device):
+    before = pattern(3, device.PAGE_SIZE)
+    device.write_page(10, before)
+    device.write_page(11, b'\x00' * device.PAGE_SIZE)
+
+    after = device.read_page(10, 13, None, False)
+    assert after[:device.PAGE_SIZE] == before[:device.PAGE_SIZE]
+    assert after[device.PAGE_SIZE:2 * device.PAGE_SIZE] == b'\x00' * device.PAGE_SIZE
+    assert after[2 * device.PAGE_SIZE:] == before[2 * device.PAGE_SIZE:]
+
+
+def test_transient_usb_errors_are_retried():
+    sim = SimulatedCH341([SimulatedNand(locked=False)], seed=1)
+    device = open_device(sim)
+    image = pattern(64, device.PAGE_SIZE)
+    device.write_page(0, image)
+
+    sim.error_rate = 0.05
+    assert device.read_page(0, 64, None, False) == image
+    assert device.recovery_stats["recovered"] > 0
+    assert device.recovery_stats["failed"] == 0
+    device.close()
+
+
+def test_persistent_usb_errors_raise():
+    sim = SimulatedCH341([SimulatedNand(locked=False)])
+    device = open_device(sim)
+    sim.error_rate = 1.0
+    with pytest.raises(main.CH341Error):
+        device.read_page(0, 1, None, False)
+    assert device.recovery_stats["failed"] == 1
+    device.close()
+
+
+def test_libusb_transfer_errors_fail_the_call(monkeypatch):
+    import types
+    import libusb_backend
+
+    class USBError(IOError):
+        pass
+
+    class TimingOut:
+        def write(self, *args):
+            raise USBError("timeout")
+
+    monkeypatch.setattr(libusb_backend, "usb", types.SimpleNamespace(core=types.SimpleNamespace(USBError=USBError)))
+    backend = libusb_backend.LibusbCH341()
+    backend.devices[0], backend.modes[0], backend.pins[0] = TimingOut(), 0x80, (0, 0)
+
+    assert backend.CH341StreamSPI4(0, 0x80, 4, bytearray(4)) is False
+    assert backend.CH341WriteRead(0, 4, bytes(4), 31, 1, None, bytearray(31)) is False
+
+    main.load_backend(backend)
+    with pytest.raises(main.CH341Error):
+        main.CH341.streamSPI4(0, 0x80, 4, bytearray(4))
+
+
+def test_read_bytes_write_bytes_round_trip(device, tmp_path):
+    # The partition workflow: data areas only, read out to a file and written back
+    data = pattern(20, device.PAGE_SIZE, oob=False)[:-1000]
+    device.write_bytes(1024 * 128, data)
+
+    out = tmp_path / "uboot"
+    assert device.read_bytes(1024 * 128, len(data) + 1000, True, str(out))[:len(data)] == data
+
+    # uboot_mirr, a block further on
+    mirror = 1024 * 128 + device.PAGE_DATA_SIZE * device.PAGES_PER_BLOCK
+    device.write_bytes(mirror, str(out))
+    assert device.read_bytes(mirror, len(data) + 1000) == out.read_bytes()
+    assert device.read_page(128, 129, None, False) == data[:device.PAGE_DATA_SIZE] + b'\xff' * device.PAGE_OOB_SIZE
+
+
+def test_bad_block_table_is_not_shared_between_chips(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    device = open_device(SimulatedCH341([SimulatedNand()]))
+    assert device.bad_block_table() == set()
+    device.close()
+
+    # Same chip type, same programmer, a factory bad block this time
+    device = open_device(SimulatedCH341([SimulatedNand(bad_blocks=(3,))]))
+    assert device.bad_block_table() == {3}
+    device.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_bbt_file_is_reused_while_its_bad_blocks_read_bad(tmp_path):
+    sim = SimulatedCH341([SimulatedNand(bad_blocks=(3, 700))])
+    device = open_device(sim)
+    device.bbt_file = str(tmp_path / "board.bbt")
+    assert device.bad_block_table() == {3, 700}
+
+    device.open(0)
+    calls = sim.usb_calls
+    assert device.bad_block_table() == {3, 700}
+    assert sim.usb_calls - calls < 10
+    device.close()
+
+
+def test_read_write_bytes_skip_bad_blocks():
+    device = open_device(SimulatedCH341([SimulatedNand(bad_blocks=(3,), locked=False)]))
+    block = device.PAGES_PER_BLOCK * device.PAGE_SIZE
+    image = pattern(2 * device.PAGES_PER_BLOCK, device.PAGE_SIZE)
+
+    device.write_bytes(2 * block, image, exclude_oob=False)
+
+    assert device.read_bytes(2 * block, len(image), exclude_oob=False) == image
+    assert device.read_page(4 * device.PAGES_PER_BLOCK, 5 * device.PAGES_PER_BLOCK, None, False) == image[block:]
+    assert device.scan_bad_blocks() == [3]
+    device.close()
+
+
+@pytest.mark.parametrize("differential", [False, True])
+def test_write_page_leaves_bad_blocks_alone(differential):
+    device = open_device(SimulatedCH341([SimulatedNand(bad_blocks=(3,), locked=False)]))
+    block = device.PAGES_PER_BLOCK * device.PAGE_SIZE
+    image = pattern(3 * device.PAGES_PER_BLOCK, device.PAGE_SIZE)
+
+    stats = device.write_page(2 * device.PAGES_PER_BLOCK, image, differential=differential)
+
+    assert stats["bad_blocks"] == [3]
+    assert device.scan_bad_blocks() == [3]
+    pages = device.read_page(2 * device.PAGES_PER_BLOCK, 5 * device.PAGES_PER_BLOCK, None, False)
+    assert pages[:block] == image[:block]
+    assert pages[2 * block:] == image[2 * block:]
+    device.close()
+
+
+def test_differential_write_verifies(device, monkeypatch):
+    image = pattern(8, device.PAGE_SIZE)
+    program_pages = device.program_pages
+
+    def flip_a_bit(pages):
+        # Page 5 comes out of programming with one bit flipped
+        return program_pages((page, bytes([data[0] ^ 1]) + bytes(data[1:]) if page == 5 else data) for page, data in pages)
+
+    monkeypatch.setattr(device, "program_pages", flip_a_bit)
+    stats = device.write_page(0, image, differential=True)
+    assert stats["mismatched"] == [5]
+    assert stats["bit_flips"] == 1
+
+    monkeypatch.setattr(device, "program_pages", program_pages)
+    assert device.write_page(0, image, differential=True)["mismatched"] == []
+    assert device.write_page(0, image, verify_write=False, differential=True)["mismatched"] == []
+
+
+def test_probe_cache_goes_to_the_user_cache_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(main.sys, "platform", "linux")
+    main.load_backend(SimulatedCH341([SimulatedNand()]))
+
+    device = main.Device()
+    device.open(0)
+    assert device.probe()  # calibrated by open(), read back from the cache now
+    device.close()
+    assert os.listdir(tmp_path) == ["cache"]
+    assert os.listdir(tmp_path / "cache" / "ch341") == ["probe.json"]
+
+
+def test_dump_image_round_trip(device, tmp_path):
+    image = pattern(10, device.PAGE_SIZE)
+    device.write_page(64, image)
+    path = str(tmp_path / "p.img")
+
+    stats = device.dump_image(path, 64, 84)
+
+    assert stats["pages"] == 20 and stats["elided"] == 10
+    with main.DumpImage(path) as dump:
+        assert dump.start_page == 64 and dump.jedec_id == "e521"
+        assert dump.page(65) == image[device.PAGE_SIZE:2 * device.PAGE_SIZE]
+        assert dump.oob(66) == b'\xff' * device.PAGE_OOB_SIZE
+        assert dump.elided(80)
+    assert device.verify(path) == {}
+    assert device.verify(path, 0) != {}
+
+    device.erase_block(1)
+    assert len(device.verify(path)) == 10
+    assert device.write_page(file=path)["programmed"] == 10
+    assert device.verify(path) == {}
+
+
+def test_trace_times_each_usb_call(device):
+    events = []
+    device.set_trace(main.TRACE_TRANSACTIONS, events.append)
+    # Two status reads packed into one CH341WriteRead, then Write Disable on its own
+    device.batch.add(bytes([main.GET_FEATURE, main.FEATURE_STATUS]), read=1)
+    device.batch.add(bytes([main.GET_FEATURE, main.FEATURE_STATUS]), read=1)
+    device.batch.add(bytes([main.WRITE_DISABLE]))
+    start = time.perf_counter_ns()
+    device.spi_execute()
+    elapsed = time.perf_counter_ns() - start
+    device.set_trace(main.TRACE_OFF)
+
+    assert [event["opcode"] for event in events] == [main.GET_FEATURE, main.GET_FEATURE, main.WRITE_DISABLE]
+    assert events[0]["duration_ns"] == events[1]["duration_ns"]
+    assert events[1]["duration_ns"] + events[2]["duration_ns"] <= elapsed
+
+
+def test_dual_io_is_refused_without_backend_support(monkeypatch):
+    import types
+    import libusb_backend
+
+    monkeypatch.setattr(libusb_backend, "usb", types.SimpleNamespace(core=types.SimpleNamespace(USBError=IOError)))
+    main.load_backend(libusb_backend.LibusbCH341())
+    device = main.Device()
+    with pytest.raises(ValueError):
+        device.open(0, spi_io=main.SPI_IO_DOUBLE)
+    assert device.recovery_stats["errors"] == 0
+    with pytest.raises(NotImplementedError):
+        main.CH341.streamSPI5(0, 0x80, 4, bytearray(4), bytearray(4))
+
+
+def test_manifest_is_not_trusted_for_another_chip(tmp_path):
+    sim = SimulatedCH341([SimulatedNand(locked=False), SimulatedNand(locked=False)])
+    main.load_backend(sim)
+    manifest = str(tmp_path / "m.json")
+    image = pattern(8, 2112)
+
+    for index in (0, 1):
+        device = main.Device()
+        device.probe_file = None
+        device.open(index)
+        stats = device.write_page(0, image, differential=True, manifest=manifest)
+        assert stats["programmed"] == 8
+        assert device.verify(image) == {}
+        # Same chip again: the manifest saves reading it back
+        assert device.write_page(0, image, differential=True, manifest=manifest)["programmed"] == 0
+        device.close()
+
+
+def test_dump_resumes_after_an_interruption(device, tmp_path):
+    image = pattern(4 * device.PAGES_PER_BLOCK, device.PAGE_SIZE)
+    device.write_page(0, image)
+    path = str(tmp_path / "dump.bin")
+    block = device.PAGES_PER_BLOCK * device.PAGE_SIZE
+
+    def unplug(page):
+        if page == 2 * device.PAGES_PER_BLOCK + 10:
+            raise main.CH341Error("CH341WriteRead", "device gone")
+
+    device.progress = unplug
+    with pytest.raises(main.CH341Error):
+        device.dump(path, 0, 4)
+    device.progress = None
+
+    assert device.dump(path, 0, 4) == {"read": 2, "skipped": 2}
+    with open(path, 'rb') as f:
+        assert f.read() == image
+
+    # A block damaged on disk is read again, the rest is left alone
+    with open(path, 'r+b') as f:
+        f.seek(block + 100)
+        f.write(b'\x00')
+    assert device.dump(path, 0, 4) == {"read": 1, "skipped": 3}
+    with open(path, 'rb') as f:
+        assert f.read() == image
+
+
+def test_async_progress_and_cancellation():
+    import asyncio
+    from async_device import AsyncDevice
+
+    sim = SimulatedCH341([SimulatedNand(locked=False)], usb_latency=0.0005)
+    device = open_device(sim)
+    image = pattern(8, device.PAGE_SIZE)
+    device.write_page(0, image)
+
+    async def run():
+        async_device = AsyncDevice(device)
+        events = []
+        assert await async_device.read_pages(0, 8, progress=events.append) == image
+        assert [event["done"] for event in events] == list(range(1, 9))
+        assert {event["total"] for event in events} == {8}
+
+        started = asyncio.Event()
+        task = asyncio.ensure_future(async_device.read_pages(0, 4096, progress=lambda event: started.set()))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        # The worker stopped after the current page and takes the next job right away
+        pages = sim.usb_calls
+        assert await async_device.read_pages(0, 1) == image[:device.PAGE_SIZE]
+        assert sim.usb_calls - pages < 10
+        await async_device.close()
+
+    asyncio.run(run())
+
+
+def test_command_line(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    main.load_backend(SimulatedCH341([SimulatedNand(bad_blocks=(3,))]))
+    image = pattern(8, 2112)
+    (tmp_path / "image.bin").write_bytes(image)
+
+    assert main.cli(["id"]) == 0
+    assert "JEDEC ID: e521 (DS35M1GA)" in capsys.readouterr().out
+
+    assert main.cli(["write", "image.bin", "--start", "64"]) == 0
+    assert main.cli(["verify", "image.bin", "--start", "64"]) == 0
+    assert "Flash matches" in capsys.readouterr().out
+
+    assert main.cli(["read", "out.bin", "--start", "64", "--end", "72"]) == 0
+    assert (tmp_path / "out.bin").read_bytes() == image
+    assert main.cli(["read", "out.img", "--image", "--start", "64", "--end", "128"]) == 0
+    assert main.cli(["verify", "out.img"]) == 0
+
+    assert main.cli(["erase", "--start", "1", "--end", "2"]) == 0
+    assert main.cli(["verify", "image.bin", "--start", "64"]) == 1
+    assert main.cli(["write", "out.img"]) == 0
+    assert main.cli(["verify", "image.bin", "--start", "64"]) == 0
+
+    capsys.readouterr()
+    assert main.cli(["--page-size", "2048", "bbt"]) == 0
+    out = capsys.readouterr().out
+    assert "1 bad blocks: 3" in out and "Page time" not in out  # geometry given, no probe
+
+
+def test_import_has_no_side_effects():
+    import subprocess
+    import sys
+
+    code = "import sys, main; assert main.CH341DLL is None; assert not {'numpy', 'xxhash', 'usb'} & set(sys.modules)"
+    subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(main.__file__)), check=True)
+
+
+def test_read_jedec_id_survives_a_transfer_error(device, monkeypatch):
+    sim = main._dll()
+    failures = iter([True])
+    monkeypatch.setattr(sim, "_fails", lambda: next(failures, False))
+    assert device.read_jedec_id() == "e521"
+    assert device.recovery_stats["recovered"] == 1
+
+
+def test_verify_past_the_end_of_the_chip(device):
+    pages = device.CHIP_SIZE // device.PAGE_SIZE
+    with pytest.raises(ValueError, match="past the end of the chip"):
+        device.verify(b'\xff' * (2 * device.PAGE_SIZE), pages - 1)
+    assert device.verify(b'\xff' * device.PAGE_SIZE, pages - 1) == {}
+
+
+def test_command_line_verify_past_the_end_of_the_chip(device, tmp_path, capsys):
+    (tmp_path / "tail.bin").write_bytes(b'\xff' * (2 * device.PAGE_SIZE))
+    last = str(device.CHIP_SIZE // device.PAGE_SIZE - 1)
+    assert main.cli(["--page-size", "2048", "verify", "tail.bin", "--start", last]) == 2
+    assert "error: source extends past the end of the chip" in capsys.readouterr().err
+
+
+def test_page_cache_invalidation(device):
+    cache = device.enable_page_cache()
+    image = pattern(2, device.PAGE_SIZE)
+    device.program_page(0, image[:device.PAGE_SIZE])
+    assert device.read_page(0, 1, None, False) == image[:device.PAGE_SIZE]
+    assert device.read_page(0, 1, None, False) == image[:device.PAGE_SIZE]
+    assert cache.hits == 1
+
+    # Programming a page drops it
+    device.read_page(1, 2, None, False)
+    device.program_page(1, image[device.PAGE_SIZE:])
+    assert device.read_page(1, 2, None, False) == image[device.PAGE_SIZE:]
+
+    # Erasing drops the whole block
+    device.erase_block(0)
+    assert device.read_page(0, 2, None, False) == b'\xff' * 2 * device.PAGE_SIZE
+
+
+def test_page_cache_starts_over_for_another_chip(tmp_path):
+    sim = SimulatedCH341([SimulatedNand(locked=False), SimulatedNand(locked=False)])
+    main.load_backend(sim)
+    page = pattern(1, 2112)
+    directory = str(tmp_path / "pages")
+
+    device = main.Device()
+    device.probe_file = None
+    device.open(0)
+    device.program_page(0, page)
+    device.enable_page_cache(directory=directory)
+    assert device.read_page(0, 1, None, False) == page
+
+    device.open(1)
+    assert device.read_page(0, 1, None, False) == b'\xff' * 2112
+    device.close()
+
+    # A new run on chip 0 may use what is on disk, on chip 1 it may not
+    device = main.Device()
+    device.probe_file = None
+    cache = device.enable_page_cache(directory=directory)
+    device.open(0)
+    assert device.read_page(0, 1, None, False) == page
+    assert cache.hits == 1
+    device.open(1)
+    assert device.read_page(0, 1, None, False) == b'\xff' * 2112
+    device.close()